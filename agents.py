@@ -3,10 +3,14 @@ Módulo de agentes de IA con funciones/tools
 Contiene el agente de onboarding y el agente de diálogo
 """
 import os
+import re
+import time
+import asyncio
 import logging
 import json
 import traceback
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Dict, Any, Optional, List
 from datetime import datetime
 from openai import AsyncOpenAI
@@ -30,6 +34,14 @@ except ImportError:  # pragma: no cover
 load_dotenv()
 
 from database import database
+from request_context import RequestContext
+from streaming import StreamedReply
+from metrics import TokenUsage
+from token_budget import HistoryBuilder
+from generation_profiles import GenerationProfile, get_generation_profile
+from model_router import model_router, normalize_message, ROUTE_CANNED, ROUTE_FAST
+from response_cache import response_cache
+from interest_clusters import interest_clusters, InterestCluster
 
 logger = logging.getLogger(__name__)
 
@@ -68,7 +80,7 @@ def get_system_prompt(prompt_key: str, fallback: str) -> str:
 class Agent:
     """Clase base para agentes de IA"""
     
-    def __init__(self, system_prompt: str, model: str = None):
+    def __init__(self, system_prompt: str, model: str = None, profile_key: str = "default"):
         self.system_prompt = system_prompt
         self.provider = os.getenv("AI_PROVIDER", "openai").lower()
         
@@ -78,6 +90,40 @@ class Agent:
         else:
             self.model = model or os.getenv("OPENAI_MODEL", "gpt-4o")
             
+        # Límites de generación (generation_profiles.json)
+        self.generation_profile = get_generation_profile(profile_key)
+        
+        # Máximo de rondas de tools por mensaje antes de forzar una respuesta de texto
+        self.max_tool_iterations = int(os.getenv("MAX_TOOL_ITERATIONS", "3"))
+        
+        # Tools con respuesta predecible: nombre -> plantilla (campos del usuario,
+        # argumentos y resultado). Evitan la segunda completion cuando la tool tiene éxito
+        self.fast_responses: Dict[str, str] = {}
+        self.fast_responses_enabled = os.getenv("FAST_TOOL_RESPONSES", "true").lower() in ("1", "true", "yes")
+        self.fast_responses_used = 0
+        
+        # Si el router puede contestar agradecimientos y despedidas sin llamar al modelo
+        self.allow_canned_replies = False
+        
+        # Mensajes (normalizados) que probablemente lleven a una tool: no usan la caché de respuestas
+        self.cache_bypass_pattern: Optional[re.Pattern] = None
+        
+        # Conversiones a tipos de Gemini reutilizables entre mensajes
+        self._gemini_tools_cache: Dict[tuple, tuple] = {}
+        self._gemini_system_cache = None
+        
+        # Caché del prefijo estático: prompt_cache_key en OpenAI, CachedContent en Gemini
+        self.prompt_cache_key = os.getenv("OPENAI_PROMPT_CACHE_KEY_PREFIX", "whatsapp-bot") + f"-{self.__class__.__name__}"
+        self.gemini_context_cache = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() in ("1", "true", "yes")
+        self.gemini_cache_ttl = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+        self._gemini_context_caches: Dict[tuple, tuple] = {}
+        self._gemini_cache_lock = asyncio.Lock()
+        self._gemini_cache_retry_at = 0.0
+        self.token_usage = TokenUsage()
+        
+        # Historial recortado por tokens según el presupuesto del modelo
+        self.history_builder = HistoryBuilder(self.model)
+        
         self.client = None
         self._init_client()
     
@@ -149,127 +195,133 @@ class Agent:
         *,
         tools: Optional[List[Dict[str, Any]]] = None,
         tool_choice: Optional[str] = None,
-        context: str = "default"
+        context: str = "default",
+        profile: Optional[GenerationProfile] = None,
+        model: Optional[str] = None
     ):
         """Crea una completion usando OpenAI"""
+        model = model or self.model
         kwargs: Dict[str, Any] = {
-            "model": self.model,
+            "model": model,
             "messages": messages,
+            **(profile or self.generation_profile).openai_kwargs(model)
         }
         if tools:
             kwargs["tools"] = tools
             if tool_choice:
                 kwargs["tool_choice"] = tool_choice
 
+        if self.prompt_cache_key:
+            kwargs["extra_body"] = {"prompt_cache_key": self.prompt_cache_key}
+
         def _kwargs_to_log(kwargs: Dict[str, Any]) -> Dict[str, Any]:
             return {k: v for k, v in kwargs.items() if k not in {"messages", "tools"}}
 
         try:
             logger.debug("Enviando completion OpenAI (%s)", context)
-            return await self.client.chat.completions.create(**kwargs)
+            response = await self.client.chat.completions.create(**kwargs)
+            self._record_openai_usage(getattr(response, "usage", None))
+            return response
         except Exception as e:
             logger.error(f"Error en completion OpenAI ({context}): {str(e)}")
             raise
 
-    async def _create_gemini_completion(
+    async def _stream_chat_completion(
         self,
         messages: List[Dict[str, Any]],
+        reply: StreamedReply,
         *,
         tools: Optional[List[Dict[str, Any]]] = None,
         tool_choice: Optional[str] = None,
-        context: str = "default"
+        context: str = "default",
+        profile: Optional[GenerationProfile] = None,
+        model: Optional[str] = None
     ):
-        """Crea una completion usando Gemini"""
+        """
+        Completion de OpenAI con stream=True
+        
+        Envía el texto a reply a medida que llega y devuelve un objeto con la
+        misma forma que choices[0].message (content y tool_calls)
+        """
+        model = model or self.model
+        kwargs: Dict[str, Any] = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            # El último chunk trae el uso de tokens (incluidos los cacheados)
+            "stream_options": {"include_usage": True},
+            **(profile or self.generation_profile).openai_kwargs(model)
+        }
+        if tools:
+            kwargs["tools"] = tools
+            if tool_choice:
+                kwargs["tool_choice"] = tool_choice
+        if self.prompt_cache_key:
+            kwargs["extra_body"] = {"prompt_cache_key": self.prompt_cache_key}
+
         try:
-            logger.debug("Enviando completion Gemini (%s)", context)
-            
-            # 1. Convertir mensajes
-            gemini_contents = []
-            system_instruction = None
+            logger.debug("Enviando completion OpenAI en streaming (%s)", context)
+            stream = await self.client.chat.completions.create(**kwargs)
             
-            for msg in messages:
-                role = msg["role"]
-                content = msg["content"]
-                
-                if role == "system":
-                    # Gemini 2.0/3.0 soporta system_instruction en config,
-                    # o system role si se usa la API v1beta rest, pero SDK v0.x lo maneja en config
-                    if system_instruction:
-                         system_instruction += "\n" + content
-                    else:
-                         system_instruction = content
-                elif role == "tool":
-                     # Respuesta de tool
-                     # Gemini espera role='tool' y partes con function_response
-                     # OpenAI: content es JSON string, tool_call_id es ID
-                     # Necesitamos reconstruir la parte de function response
-                     # Nota: En la implementación simple, asumiremos que el historial 
-                     # ya viene con el formato correcto o lo adaptamos.
-                     # Para simplificar la interoperabilidad, procesaremos esto con cuidado.
-                     
-                     # Hack: si es tool response, el SDK de Gemini espera un formato específico.
-                     # Por ahora, si estamos en modo Gemini, asumiremos que convertimos
-                     # los mensajes de historial de OpenAI a Gemini "Parts".
-                     
-                     # Si el mensaje es simple texto:
-                     gemini_contents.append(types.Content(
-                         role="user" if role == "tool" else role, # 'tool' role en Gemini es específico
-                         parts=[types.Part.from_text(text=f"[Tool Response] {content}")] 
-                     ))
-                     # TODO: Implementar conversión nativa de Tool Response si es crítico
-                else:
-                     # user o assistant
-                     gemini_role = "user" if role == "user" else "model"
-                     gemini_contents.append(types.Content(
-                         role=gemini_role,
-                         parts=[types.Part.from_text(text=str(content))]
-                     ))
-
-            # 2. Configurar tools
-            gemini_tools = None
-            gemini_tool_config = None
+            content = ""
+            tool_calls: Dict[int, Dict[str, str]] = {}
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    self._record_openai_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content += delta.content
+                    await reply.on_delta(delta.content)
+                # Los tool calls llegan fragmentados por índice
+                for tool_call_delta in delta.tool_calls or []:
+                    call = tool_calls.setdefault(tool_call_delta.index, {"id": "", "name": "", "arguments": ""})
+                    if tool_call_delta.id:
+                        call["id"] = tool_call_delta.id
+                    if tool_call_delta.function:
+                        call["name"] += tool_call_delta.function.name or ""
+                        call["arguments"] += tool_call_delta.function.arguments or ""
+            await reply.finish()
             
-            if tools:
-                # Convertir definiciones de tools OpenAI a Gemini
-                # tools = [{"type": "function", "function": {...}}]
-                function_declarations = []
-                for t in tools:
-                    if t.get("type") == "function":
-                        func_def = t["function"]
-                        # Crear FunctionDeclaration
-                        # Nota: types.FunctionDeclaration toma parameters como Schema
-                        # Esto requiere mapeo del JSON schema. 
-                        # Para simplificar, pasamos el dict directamente si el SDK lo permite
-                        # o construimos un objeto compatible.
-                        
-                        # El SDK google-genai suele aceptar dicts si coinciden con la estructura
-                        function_declarations.append(func_def)
-                
-                if function_declarations:
-                    gemini_tools = [types.Tool(function_declarations=function_declarations)]
-                    gemini_tool_config = types.ToolConfig(
-                        function_calling_config=types.FunctionCallingConfig(
-                            mode="AUTO" if not tool_choice or tool_choice == "auto" else "ANY"
-                        )
+            return SimpleNamespace(
+                content=content or None,
+                tool_calls=[
+                    SimpleNamespace(
+                        id=call["id"],
+                        type="function",
+                        function=SimpleNamespace(name=call["name"], arguments=call["arguments"])
                     )
-
-            # 3. Configuración de generación
-            config = types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                temperature=1.0, # Default para chat
-                max_output_tokens=65536,
-                tools=gemini_tools,
-                tool_config=gemini_tool_config,
-                thinking_config=types.ThinkingConfig(include_thoughts=True) if "gemini-3" in self.model or "thinking" in self.model else None
+                    for _, call in sorted(tool_calls.items())
+                ] or None
             )
+        except Exception as e:
+            logger.error(f"Error en completion OpenAI en streaming ({context}): {str(e)}")
+            raise
+
+    async def _create_gemini_completion(
+        self,
+        messages: List[Dict[str, Any]],
+        *,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tool_choice: Optional[str] = None,
+        context: str = "default",
+        profile: Optional[GenerationProfile] = None,
+        model: Optional[str] = None
+    ):
+        """Crea una completion usando Gemini"""
+        try:
+            logger.debug("Enviando completion Gemini (%s)", context)
+            gemini_contents, config = await self._build_gemini_request(messages, tools=tools, tool_choice=tool_choice, profile=profile, model=model)
 
-            # 4. Llamada a la API (usando aio)
+            # Llamada a la API (usando aio)
             # Usamos client.aio.models.generate_content
             response = await self.client.aio.models.generate_content(
-                model=self.model,
+                model=model or self.model,
                 contents=gemini_contents,
                 config=config
             )
+            self._record_gemini_usage(response.usage_metadata)
             
             return response
 
@@ -277,18 +329,270 @@ class Agent:
             logger.error(f"Error en completion Gemini ({context}): {str(e)}")
             raise
 
-    async def _call_function(self, function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    async def _stream_gemini_completion(
+        self,
+        messages: List[Dict[str, Any]],
+        reply: StreamedReply,
+        *,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tool_choice: Optional[str] = None,
+        context: str = "default",
+        profile: Optional[GenerationProfile] = None,
+        model: Optional[str] = None
+    ):
+        """
+        Completion de Gemini en streaming
+        
+        Envía el texto a reply a medida que llega y devuelve (texto, partes function_call)
+        """
+        try:
+            logger.debug("Enviando completion Gemini en streaming (%s)", context)
+            gemini_contents, config = await self._build_gemini_request(messages, tools=tools, tool_choice=tool_choice, profile=profile, model=model)
+            
+            text = ""
+            function_call_parts = []
+            stream = await self.client.aio.models.generate_content_stream(
+                model=model or self.model,
+                contents=gemini_contents,
+                config=config
+            )
+            usage_metadata = None
+            async for chunk in stream:
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                    continue
+                for part in chunk.candidates[0].content.parts:
+                    if part.function_call:
+                        function_call_parts.append(part)
+                    elif part.text and not part.thought:
+                        text += part.text
+                        await reply.on_delta(part.text)
+            await reply.finish()
+            self._record_gemini_usage(usage_metadata)
+            return text, function_call_parts
+
+        except Exception as e:
+            logger.error(f"Error en completion Gemini en streaming ({context}): {str(e)}")
+            raise
+
+    def _gemini_tools(self, tools: List[Dict[str, Any]], tool_choice: Optional[str]):
+        """
+        Declaraciones de tools y tool_config de Gemini, cacheadas por agente
+        
+        get_tools() devuelve siempre las mismas definiciones, así que la conversión
+        (y la validación de los modelos del SDK) solo se hace una vez
+        """
+        mode = "AUTO" if not tool_choice or tool_choice == "auto" else "ANY"
+        function_defs = [t["function"] for t in tools if t.get("type") == "function"]
+        cache_key = (tuple(func_def["name"] for func_def in function_defs), mode)
+        
+        cached = self._gemini_tools_cache.get(cache_key)
+        if cached is None:
+            if function_defs:
+                cached = (
+                    [types.Tool(function_declarations=[types.FunctionDeclaration(**func_def) for func_def in function_defs])],
+                    types.ToolConfig(function_calling_config=types.FunctionCallingConfig(mode=mode))
+                )
+            else:
+                cached = (None, None)
+            self._gemini_tools_cache[cache_key] = cached
+        return cached
+
+    def _gemini_system_instruction(self, system_instruction: Optional[str]):
+        """System instruction de Gemini; el prompt estático del agente se convierte una sola vez"""
+        if not system_instruction:
+            return None
+        if system_instruction == self.system_prompt:
+            if self._gemini_system_cache is None:
+                self._gemini_system_cache = types.Content(parts=[types.Part.from_text(text=system_instruction)])
+            return self._gemini_system_cache
+        return types.Content(parts=[types.Part.from_text(text=system_instruction)])
+
+    async def _gemini_cached_content(self, system_instruction, gemini_tools, gemini_tool_config, cache_key: tuple) -> Optional[str]:
+        """
+        Nombre de un CachedContent de Gemini con el prefijo estático (system instruction + tools)
+        para el modelo de cache_key[0]
+        
+        Se crea bajo demanda y se renueva antes de expirar. Si la creación falla
+        (p.ej. el prefijo no llega al mínimo de tokens del modelo) se desactiva
+        durante un tiempo y se envía el prefijo completo como siempre
+        """
+        if not self.gemini_context_cache or system_instruction is None:
+            return None
+        
+        now = time.monotonic()
+        entry = self._gemini_context_caches.get(cache_key)
+        if entry and entry[1] > now:
+            return entry[0]
+        if self._gemini_cache_retry_at > now:
+            return None
+        
+        async with self._gemini_cache_lock:
+            entry = self._gemini_context_caches.get(cache_key)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            try:
+                cache = await self.client.aio.caches.create(
+                    model=cache_key[0],
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"{self.__class__.__name__}-prefix",
+                        system_instruction=system_instruction,
+                        tools=gemini_tools,
+                        tool_config=gemini_tool_config,
+                        ttl=f"{self.gemini_cache_ttl}s"
+                    )
+                )
+                # Renovar un minuto antes de que Gemini lo expire
+                self._gemini_context_caches[cache_key] = (cache.name, time.monotonic() + max(self.gemini_cache_ttl - 60, 60))
+                logger.info(f"Caché de contexto Gemini creada: {cache.name}")
+                return cache.name
+            except Exception as e:
+                logger.warning(f"No se pudo crear la caché de contexto Gemini: {str(e)}")
+                self._gemini_cache_retry_at = time.monotonic() + 600
+                return None
+
+    async def _build_gemini_request(
+        self,
+        messages: List[Dict[str, Any]],
+        *,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        tool_choice: Optional[str] = None,
+        profile: Optional[GenerationProfile] = None,
+        model: Optional[str] = None
+    ):
+        """
+        Convierte mensajes y tools en formato OpenAI a (contents, config) de Gemini
+        
+        Las llamadas a tools del asistente se convierten en partes function_call
+        (reutilizando las partes originales de Gemini, que llevan la thought_signature)
+        y los mensajes role="tool" en partes function_response nativas
+        """
+        gemini_contents = []
+        system_text = None
+        pending_context = []
+        pending_responses = []
+
+        def _flush_responses():
+            # Gemini espera todas las respuestas de un turno de tools en un único Content
+            if pending_responses:
+                gemini_contents.append(types.Content(role="user", parts=list(pending_responses)))
+                pending_responses.clear()
+
+        for msg in messages:
+            role = msg["role"]
+            content = msg.get("content")
+
+            if role == "system":
+                if system_text is None:
+                    system_text = content
+                else:
+                    # Contexto dinámico: va en el turno del usuario para no romper la caché del prefijo
+                    pending_context.append(content)
+                continue
+
+            if role == "tool":
+                try:
+                    response = json.loads(content) if content else {}
+                except (TypeError, json.JSONDecodeError):
+                    response = {"result": content}
+                if not isinstance(response, dict):
+                    response = {"result": response}
+                pending_responses.append(types.Part.from_function_response(name=msg.get("name", ""), response=response))
+                continue
+
+            _flush_responses()
+            if role == "assistant" and msg.get("gemini_parts"):
+                gemini_contents.append(types.Content(role="model", parts=msg["gemini_parts"]))
+            elif role == "assistant" and msg.get("tool_calls"):
+                parts = [types.Part.from_text(text=str(content))] if content else []
+                for tool_call in msg["tool_calls"]:
+                    arguments = tool_call["function"].get("arguments") or "{}"
+                    parts.append(types.Part.from_function_call(
+                        name=tool_call["function"]["name"],
+                        args=json.loads(arguments) if isinstance(arguments, str) else arguments
+                    ))
+                gemini_contents.append(types.Content(role="model", parts=parts))
+            else:
+                # user o assistant
+                gemini_role = "user" if role == "user" else "model"
+                parts = [types.Part.from_text(text=str(content))]
+                if gemini_role == "user" and pending_context:
+                    parts = [types.Part.from_text(text=text) for text in pending_context] + parts
+                    pending_context.clear()
+                gemini_contents.append(types.Content(role=gemini_role, parts=parts))
+        _flush_responses()
+
+        gemini_tools, gemini_tool_config = self._gemini_tools(tools, tool_choice) if tools else (None, None)
+        system_instruction = self._gemini_system_instruction(system_text)
+
+        # El prefijo estático puede ir en una caché de contexto en lugar de reenviarse
+        model = model or self.model
+        cache_key = (model, system_text, tuple(t["function"]["name"] for t in tools or [] if t.get("type") == "function"), tool_choice)
+        cached_content = None
+        if system_text == self.system_prompt:
+            cached_content = await self._gemini_cached_content(system_instruction, gemini_tools, gemini_tool_config, cache_key)
+        prefix_config = {"cached_content": cached_content} if cached_content else {
+            "system_instruction": system_instruction,
+            "tools": gemini_tools,
+            "tool_config": gemini_tool_config,
+        }
+
+        # Configuración de generación según el perfil del agente
+        config = types.GenerateContentConfig(
+            **(profile or self.generation_profile).gemini_config(model),
+            **prefix_config
+        )
+
+        return gemini_contents, config
+
+    async def _call_function(self, function_name: str, arguments: Dict[str, Any], context: RequestContext) -> Dict[str, Any]:
         """Ejecuta una función del agente"""
         raise NotImplementedError("Subclases deben implementar _call_function")
     
+    def build_system_prompt(self, context: RequestContext) -> str:
+        """
+        System prompt para este mensaje
+        
+        Los agentes son instancias compartidas entre peticiones concurrentes:
+        todo lo que dependa del usuario se calcula a partir del contexto,
+        nunca se guarda en atributos de la instancia
+        """
+        return self.system_prompt
+    
+    def build_context_message(self, context: RequestContext) -> Optional[str]:
+        """
+        Información dinámica del usuario para este mensaje
+        
+        Se envía al final (justo antes del mensaje del usuario) y no dentro del
+        system prompt, para que el prefijo system prompt + tools sea idéntico en
+        todas las peticiones y los proveedores puedan cachearlo
+        """
+        return None
+    
+    def _build_messages(self, user_message: str, conversation_history, context: RequestContext) -> List[Dict[str, Any]]:
+        """Prefijo estático, historial, contexto dinámico y mensaje del usuario, en ese orden"""
+        messages = [
+            {"role": "system", "content": self.build_system_prompt(context)}
+        ]
+        messages.extend(self.history_builder.build(conversation_history))
+        context_message = self.build_context_message(context)
+        if context_message:
+            messages.append({"role": "system", "content": context_message})
+        messages.append({"role": "user", "content": user_message})
+        return messages
+    
     async def process_message(
         self, 
         user_message: str, 
         phone_number: str,
-        conversation_history: List[Dict[str, str]] = None
+        conversation_history: List[Dict[str, str]] = None,
+        context: Optional[RequestContext] = None
     ) -> str:
         """
         Procesa un mensaje del usuario y genera una respuesta
+        
+        El contexto lleva el snapshot del usuario ya cargado; las tools lo leen
+        y lo actualizan en lugar de volver a consultar Firestore
         """
         if not self._ensure_client():
             return "Lo siento, el servicio de IA no está configurado."
@@ -299,53 +603,210 @@ class Agent:
         if conversation_history is None:
             conversation_history = []
         
+        if context is None:
+            context = RequestContext(phone_number, conversation_history=conversation_history)
+        
+        # Mensajes triviales: respuesta predefinida o modelo rápido (model_router.py)
+        started_at = time.perf_counter()
+        route, canned_category = model_router.classify(user_message, allow_canned=self.allow_canned_replies)
+        if route == ROUTE_CANNED:
+            model_router.record(self.__class__.__name__, route, time.perf_counter() - started_at)
+            return model_router.canned_reply(canned_category)
+        if route == ROUTE_FAST:
+            context.model = model_router.fast_model(self.provider)
+        
+        # Preguntas repetidas: respuesta cacheada salvo que el mensaje pueda necesitar una tool
+        cache_key = None
+        if self.cache_bypass_pattern and self.cache_bypass_pattern.search(normalize_message(user_message)):
+            response_cache.bypass()
+        else:
+            cache_key = response_cache.key(
+                self.__class__.__name__,
+                user_message,
+                conversation_history,
+                self.build_context_message(context)
+            )
+        if cache_key:
+            cached = await response_cache.lookup(cache_key)
+            if cached:
+                model_router.record(self.__class__.__name__, route, time.perf_counter() - started_at)
+                return cached
+        
         # Lógica específica según proveedor
         if self.provider == "gemini":
-            return await self._process_message_gemini(user_message, phone_number, conversation_history)
+            response_text = await self._process_message_gemini(user_message, phone_number, conversation_history, context)
         else:
-            return await self._process_message_openai(user_message, phone_number, conversation_history)
+            response_text = await self._process_message_openai(user_message, phone_number, conversation_history, context)
+        model_router.record(self.__class__.__name__, route, time.perf_counter() - started_at)
+        
+        # Solo respuestas de texto puro (si hubo tools la respuesta depende de su efecto)
+        # y que no repitan datos del usuario, porque la entrada la pueden leer otros
+        profile_values = [context.user.get("name"), phone_number] if context.user else []
+        if (
+            cache_key and response_text and not context.tool_calls and not context.failed
+            and response_cache.shareable(response_text, conversation_history, profile_values)
+        ):
+            counter = self.history_builder.counter
+            tokens = counter.count(self.system_prompt) + counter.count(user_message) + counter.count(response_text)
+            await response_cache.store(cache_key, response_text, tokens)
+        return response_text
 
-    async def _process_message_openai(self, user_message, phone_number, conversation_history):
-        # ... (Lógica original de OpenAI) ...
-        # Copiada del process_message original pero encapsulada
+    async def complete_text(
+        self,
+        messages: List[Dict[str, Any]],
+        stage: str = "auxiliary",
+        profile: Optional[GenerationProfile] = None
+    ) -> Optional[str]:
+        """Completion de solo texto, sin tools ni streaming, para tareas internas (p.ej. resúmenes)"""
+        if not self._ensure_client():
+            return None
         
-        # Construir mensajes
-        messages = [
-            {"role": "system", "content": self.system_prompt}
-        ]
-        for msg in conversation_history[-10:]:
-            messages.append(msg)
-        messages.append({"role": "user", "content": user_message})
+        if self.provider == "gemini":
+            response = await self._create_gemini_completion(messages, context=stage, profile=profile)
+            if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+                return None
+            return "".join(p.text for p in response.candidates[0].content.parts if p.text and not p.thought) or None
         
-        try:
-            tools = self.get_tools()
-            logger.debug(f"Llamando a OpenAI con modelo {self.model}")
+        response = await self._create_chat_completion(messages, context=stage, profile=profile)
+        return response.choices[0].message.content
+
+    async def _execute_tool_calls(self, calls: List[tuple], context: RequestContext) -> List[Dict[str, Any]]:
+        """
+        Ejecuta en paralelo todas las tools pedidas en un turno del modelo
+        
+        Args:
+            calls: Lista de (nombre, argumentos); argumentos es None si no se pudieron parsear
             
-            response = await self._create_chat_completion(
+        Returns:
+            Resultados en el mismo orden que calls
+        """
+        context.tool_calls += len(calls)
+        
+        async def _run(function_name: str, arguments: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+            if arguments is None:
+                return {"success": False, "error": "Error procesando argumentos de función"}
+            try:
+                return await self._call_function(function_name, arguments, context)
+            except Exception as e:
+                return {"success": False, "error": str(e)}
+        
+        return list(await asyncio.gather(*(_run(name, args) for name, args in calls)))
+
+    def _fast_response(
+        self,
+        calls: List[tuple],
+        results: List[Dict[str, Any]],
+        model_text: Optional[str],
+        context: RequestContext
+    ) -> Optional[str]:
+        """
+        Respuesta sin segunda completion para tools declaradas en fast_responses
+        
+        Si el modelo ya escribió el mensaje junto con la llamada se usa ese texto;
+        si no, se rellenan las plantillas. Devuelve None si alguna tool no tiene
+        plantilla, falló, o la plantilla no se puede completar
+        """
+        if not self.fast_responses_enabled or not calls:
+            return None
+        if any(name not in self.fast_responses for name, _ in calls):
+            return None
+        if any(not result.get("success") for result in results):
+            return None
+        
+        self.fast_responses_used += 1
+        if model_text and model_text.strip():
+            return model_text
+        
+        rendered = []
+        for (name, arguments), result in zip(calls, results):
+            values = dict(context.user or {})
+            values.update(arguments or {})
+            values.update(result)
+            try:
+                rendered.append(self.fast_responses[name].format(**values))
+            except (KeyError, IndexError, ValueError):
+                self.fast_responses_used -= 1
+                return None
+        return "\n\n".join(rendered)
+
+    def _record_openai_usage(self, usage):
+        if not usage:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.token_usage.record(
+            usage.prompt_tokens,
+            getattr(details, "cached_tokens", 0) if details else 0,
+            usage.completion_tokens
+        )
+
+    def _record_gemini_usage(self, usage_metadata):
+        if not usage_metadata:
+            return
+        self.token_usage.record(
+            usage_metadata.prompt_token_count,
+            usage_metadata.cached_content_token_count,
+            usage_metadata.candidates_token_count
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "generation_profile": self.generation_profile.name,
+            "fast_tool_responses": self.fast_responses_used,
+            "tokens": self.token_usage.snapshot(),
+            "history": self.history_builder.stats()
+        }
+
+    async def _openai_turn(self, messages, tools, context: RequestContext, stage: str):
+        """Una completion de OpenAI (en streaming si el contexto lo pide); devuelve el mensaje"""
+        if context.reply:
+            return await self._stream_chat_completion(
                 messages,
+                context.reply,
                 tools=tools if tools else None,
                 tool_choice="auto" if tools else None,
-                context="primary"
+                context=stage,
+                model=context.model
             )
+        response = await self._create_chat_completion(
+            messages,
+            tools=tools if tools else None,
+            tool_choice="auto" if tools else None,
+            context=stage,
+            model=context.model
+        )
+        return response.choices[0].message
+
+    async def _process_message_openai(self, user_message, phone_number, conversation_history, context):
+        messages = self._build_messages(user_message, conversation_history, context)
+        
+        try:
+            tools = self.get_tools()
+            logger.debug(f"Llamando a OpenAI con modelo {context.model or self.model}")
             
-            message = response.choices[0].message
+            message = await self._openai_turn(messages, tools, context, "primary")
             
-            if message.tool_calls:
-                tool_call = message.tool_calls[0]
-                function_name = tool_call.function.name
-                try:
-                    function_args = json.loads(tool_call.function.arguments)
-                except json.JSONDecodeError:
-                    return "Error procesando argumentos de función."
+            # Bucle de tools: todas las llamadas de un turno se ejecutan a la vez y sus
+            # resultados vuelven al modelo en una sola completion, hasta max_tool_iterations
+            iteration = 0
+            while message.tool_calls and iteration < self.max_tool_iterations:
+                iteration += 1
+                calls = []
+                for tool_call in message.tool_calls:
+                    try:
+                        arguments = json.loads(tool_call.function.arguments or "{}")
+                    except json.JSONDecodeError:
+                        arguments = None
+                    calls.append((tool_call.function.name, arguments))
                 
-                # Ejecutar función
-                try:
-                    function_result = await self._call_function(function_name, function_args)
-                except Exception as e:
-                    function_result = {"success": False, "error": str(e)}
+                results = await self._execute_tool_calls(calls, context)
                 
+                fast_reply = self._fast_response(calls, results, message.content, context)
+                if fast_reply:
+                    return fast_reply
                 
-                # Agregar el mensaje del asistente con la llamada a la función
+                # Agregar el mensaje del asistente con las llamadas a funciones
                 messages.append({
                     "role": "assistant",
                     "content": message.content,
@@ -356,114 +817,126 @@ class Agent:
                             "name": tool_call.function.name,
                             "arguments": tool_call.function.arguments
                         }
-                    }]
-                })
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "name": function_name,
-                    "content": json.dumps(function_result, default=self._json_default)
+                    } for tool_call in message.tool_calls]
                 })
+                for tool_call, function_result in zip(message.tool_calls, results):
+                    messages.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call.id,
+                        "name": tool_call.function.name,
+                        "content": json.dumps(function_result, default=self._json_default)
+                    })
                 
-                final_response = await self._create_chat_completion(messages, context="post_function")
-                return final_response.choices[0].message.content
-            else:
-                return message.content
+                # En la última iteración ya no se ofrecen tools para forzar una respuesta de texto
+                follow_up_tools = tools if iteration < self.max_tool_iterations else None
+                message = await self._openai_turn(messages, follow_up_tools, context, "post_function")
+            
+            return message.content
                 
         except Exception as e:
             logger.error(f"Error en process_message_openai: {e}")
+            context.failed = True
             return "Lo siento, ocurrió un error al procesar tu mensaje."
 
-    async def _process_message_gemini(self, user_message, phone_number, conversation_history):
-        # Lógica para Gemini
+    async def _gemini_turn(self, messages, tools, context: RequestContext, stage: str):
+        """Una completion de Gemini (en streaming si el contexto lo pide); devuelve (texto, partes function_call)"""
+        if context.reply:
+            return await self._stream_gemini_completion(
+                messages,
+                context.reply,
+                tools=tools if tools else None,
+                tool_choice="auto" if tools else None,
+                context=stage,
+                model=context.model
+            )
+        
+        response = await self._create_gemini_completion(
+            messages,
+            tools=tools if tools else None,
+            tool_choice="auto" if tools else None,
+            context=stage,
+            model=context.model
+        )
         
+        # Gemini response tiene candidates[0].content.parts con texto o function_call
+        if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+            return None, []
+        parts = response.candidates[0].content.parts
+        text = "".join(p.text for p in parts if p.text and not p.thought)
+        return text or None, [p for p in parts if p.function_call]
+
+    async def _process_message_gemini(self, user_message, phone_number, conversation_history, context):
         # Construir mensajes (lista plana para el helper que los convierte luego)
         # Nota: Para Gemini, system prompt se maneja aparte, pero lo pasamos en la lista
-        # y _create_gemini_completion lo extraerá.
-        messages = [
-            {"role": "system", "content": self.system_prompt}
-        ]
-        for msg in conversation_history[-10:]:
-            messages.append(msg)
-        messages.append({"role": "user", "content": user_message})
+        # y _build_gemini_request lo extraerá.
+        messages = self._build_messages(user_message, conversation_history, context)
         
         try:
             tools = self.get_tools()
-            logger.debug(f"Llamando a Gemini con modelo {self.model}")
-            print(f"[AGENT] Llamando a Gemini - Modelo: {self.model}", flush=True)
-            
-            response = await self._create_gemini_completion(
-                messages,
-                tools=tools if tools else None,
-                tool_choice="auto" if tools else None,
-                context="primary"
-            )
-            
-            # Analizar respuesta
-            # Gemini response tiene candidates[0].content.parts...
-            # O response.text si es texto simple
+            logger.debug(f"Llamando a Gemini con modelo {context.model or self.model}")
+            print(f"[AGENT] Llamando a Gemini - Modelo: {context.model or self.model}", flush=True)
             
-            # Verificar si hay llamadas a función
-            # En SDK google-genai, response.function_calls puede estar disponible o en parts
+            response_text, function_call_parts = await self._gemini_turn(messages, tools, context, "primary")
+            if not response_text and not function_call_parts:
+                # Texto de relleno, no del modelo: no debe acabar en la caché de respuestas
+                context.failed = True
+                return "No se recibió respuesta del modelo."
             
-            # Acceder a la primera parte
-            if not response.candidates or not response.candidates[0].content.parts:
-                 return "No se recibió respuesta del modelo."
-
-            parts = response.candidates[0].content.parts
-            function_calls = [p.function_call for p in parts if p.function_call]
-            
-            if function_calls:
-                fc = function_calls[0]
-                function_name = fc.name
-                function_args = fc.args # Esto ya es un dict usualmente
-                
-                # Ejecutar función
-                try:
-                    # function_args podría ser un objeto Map/Struct, convertir a dict si es necesario
-                    if hasattr(function_args, "items"): 
-                        args_dict = {k: v for k, v in function_args.items()}
-                    else:
-                        args_dict = function_args # Asumir dict
-                        
-                    function_result = await self._call_function(function_name, args_dict)
-                except Exception as e:
-                    function_result = {"success": False, "error": str(e)}
+            iteration = 0
+            while function_call_parts and iteration < self.max_tool_iterations:
+                iteration += 1
+                calls = []
+                for part in function_call_parts:
+                    fc = part.function_call
+                    # fc.args podría ser un objeto Map/Struct, convertir a dict si es necesario
+                    function_args = fc.args or {}
+                    args_dict = {k: v for k, v in function_args.items()} if hasattr(function_args, "items") else function_args
+                    calls.append((fc.name, args_dict))
                 
-                # Segunda llamada con el resultado
-                # Para Gemini, necesitamos pasar historial + llamada + respuesta
+                results = await self._execute_tool_calls(calls, context)
                 
-                # Agregamos la respuesta del modelo (function call) al historial de mensajes
-                # Nota: Esto es delicado porque _create_gemini_completion reconstruye desde messages
-                # Necesitamos simular el formato OpenAI para que _create_gemini_completion lo entienda
-                # O construir los Contents manualmente aquí.
+                fast_reply = self._fast_response(calls, results, response_text, context)
+                if fast_reply:
+                    return fast_reply
                 
-                # Simplificación: Agregamos mensaje de asistente con tool call (simulado)
+                # Mismo formato que OpenAI; _build_gemini_request lo convierte en partes
+                # function_call / function_response nativas
+                tool_call_ids = [
+                    part.function_call.id or f"{name}_{index}"
+                    for index, (part, (name, _)) in enumerate(zip(function_call_parts, calls))
+                ]
+                model_parts = ([types.Part.from_text(text=response_text)] if response_text else []) + function_call_parts
                 messages.append({
-                    "role": "assistant", 
-                    "content": f"Function Call: {function_name}({args_dict})" 
-                })
-                # Agregamos resultado
-                messages.append({
-                    "role": "user", # Usamos user para simular respuesta de tool en este esquema simple
-                    "content": f"Function Result: {json.dumps(function_result, default=self._json_default)}"
+                    "role": "assistant",
+                    "content": response_text,
+                    "tool_calls": [{
+                        "id": tool_call_id,
+                        "type": "function",
+                        "function": {"name": name, "arguments": json.dumps(args, default=self._json_default)}
+                    } for tool_call_id, (name, args) in zip(tool_call_ids, calls)],
+                    "gemini_parts": model_parts
                 })
+                for tool_call_id, (name, _), result in zip(tool_call_ids, calls, results):
+                    messages.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call_id,
+                        "name": name,
+                        "content": json.dumps(result, default=self._json_default)
+                    })
                 
-                print(f"[AGENT] Haciendo segunda llamada a Gemini después de función", flush=True)
-                final_response = await self._create_gemini_completion(
-                    messages, 
-                    context="post_function"
-                )
-                
-                # Asumimos respuesta de texto final
-                return final_response.text if final_response.text else "Completado."
+                print(f"[AGENT] Haciendo llamada a Gemini después de {len(calls)} función(es)", flush=True)
+                follow_up_tools = tools if iteration < self.max_tool_iterations else None
+                response_text, function_call_parts = await self._gemini_turn(messages, follow_up_tools, context, "post_function")
             
-            else:
-                return response.text
+            if not response_text:
+                context.failed = True
+                return "Completado."
+            return response_text
 
         except Exception as e:
             logger.error(f"Error en process_message_gemini: {e}")
             traceback.print_exc()
+            context.failed = True
             return "Lo siento, ocurrió un error al procesar tu mensaje con Gemini."
 
     def get_tools(self) -> List[Dict[str, Any]]:
@@ -489,7 +962,11 @@ Tu misión es ayudar a los usuarios a registrarse en el sistema de retos diarios
 IMPORTANTE: Solo debes llamar a register_user cuando tengas tanto el nombre como los intereses del usuario claramente identificados. Si falta alguno, continúa la conversación de forma natural hasta obtenerlo."""
         )
 
-        super().__init__(system_prompt)
+        super().__init__(system_prompt, profile_key="onboarding_agent")
+        self.fast_responses = {
+            "register_user": "Perfecto, {name}. Ya sé cómo piensas. Prepárate para ver el mundo diferente."
+        }
+        self.cache_bypass_pattern = re.compile(r"\b(me llamo|mi nombre|soy|me gusta|me interesa|prefiero|elijo|elegiria)\b")
     
     def get_tools(self) -> List[Dict[str, Any]]:
         """Herramientas disponibles para el agente de onboarding"""
@@ -498,7 +975,7 @@ IMPORTANTE: Solo debes llamar a register_user cuando tengas tanto el nombre como
                 "type": "function",
                 "function": {
                     "name": "register_user",
-                    "description": "Registra un nuevo usuario en el sistema con su nombre y párrafo de intereses. Solo debes llamar esta función cuando tengas tanto el nombre como los intereses del usuario claramente identificados.",
+                    "description": "Registra un nuevo usuario en el sistema con su nombre y párrafo de intereses. Solo debes llamar esta función cuando tengas tanto el nombre como los intereses del usuario claramente identificados. Escribe el mensaje de cierre para el usuario en el mismo turno en que llamas a la función.",
                     "parameters": {
                         "type": "object",
                         "properties": {
@@ -517,22 +994,10 @@ IMPORTANTE: Solo debes llamar a register_user cuando tengas tanto el nombre como
             }
         ]
     
-    async def process_message(
-        self, 
-        user_message: str, 
-        phone_number: str,
-        conversation_history: List[Dict[str, str]] = None
-    ) -> str:
-        """Procesa mensaje con el agente de onboarding, inyectando phone_number en las funciones"""
-        # Guardar phone_number para usarlo en las funciones
-        self._current_phone_number = phone_number
-        return await super().process_message(user_message, phone_number, conversation_history)
-    
-    async def _call_function(self, function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    async def _call_function(self, function_name: str, arguments: Dict[str, Any], context: RequestContext) -> Dict[str, Any]:
         """Ejecuta las funciones del agente de onboarding"""
         if function_name == "register_user":
-            # Usar el phone_number guardado
-            phone_number = getattr(self, '_current_phone_number', None)
+            phone_number = context.phone_number
             if not phone_number:
                 return {
                     "success": False,
@@ -551,6 +1016,14 @@ IMPORTANTE: Solo debes llamar a register_user cuando tengas tanto el nombre como
             success = await database.create_user(phone_number, name, interests)
             
             if success:
+                interest_clusters.after_interests_update(phone_number, interests)
+                context.set_user({
+                    "name": name,
+                    "interests": interests,
+                    "onboarding_completed": True,
+                    "last_challenge_date": None,
+                    "challenges_completed": 0
+                })
                 return {
                     "success": True,
                     "message": f"Usuario {name} registrado exitosamente"
@@ -588,7 +1061,15 @@ IMPORTANTE:
 - Celebra los avances y crea confianza para que el usuario comparta su experiencia."""
         )
 
-        super().__init__(system_prompt)
+        super().__init__(system_prompt, profile_key="dialogue_agent")
+        self.fast_responses = {
+            "mark_challenge_completed": "¡Reto completado! 🎉 Ya llevas {challenges_completed} retos superados. Mañana llega el siguiente."
+        }
+        self.allow_canned_replies = True
+        self.cache_bypass_pattern = re.compile(
+            r"^[abc]$|\b(hice|he hecho|complete|termine|hecho|listo|respuesta|opcion|interes|me gusta|"
+            r"me interesa|cuantos|llevo|mi perfil|mis datos|cambi)"
+        )
     
     def get_tools(self) -> List[Dict[str, Any]]:
         """Herramientas disponibles para el agente de diálogo"""
@@ -626,7 +1107,7 @@ IMPORTANTE:
                 "type": "function",
                 "function": {
                     "name": "mark_challenge_completed",
-                    "description": "Marca un reto como completado cuando el usuario indica que lo ha terminado o logrado.",
+                    "description": "Marca un reto como completado cuando el usuario indica que lo ha terminado o logrado. Escribe tu respuesta al usuario en el mismo turno en que llamas a la función.",
                     "parameters": {
                         "type": "object",
                         "properties": {},
@@ -636,9 +1117,9 @@ IMPORTANTE:
             }
         ]
     
-    async def _call_function(self, function_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    async def _call_function(self, function_name: str, arguments: Dict[str, Any], context: RequestContext) -> Dict[str, Any]:
         """Ejecuta las funciones del agente de diálogo"""
-        phone_number = getattr(self, '_current_phone_number', None)
+        phone_number = context.phone_number
         
         if function_name == "update_interests":
             if not phone_number:
@@ -651,6 +1132,8 @@ IMPORTANTE:
             success = await database.update_user_interests(phone_number, interests)
             
             if success:
+                interest_clusters.after_interests_update(phone_number, interests, (context.user or {}).get("interest_cluster"))
+                context.update_user(interests=interests)
                 return {
                     "success": True,
                     "message": "Intereses actualizados correctamente"
@@ -665,7 +1148,8 @@ IMPORTANTE:
             if not phone_number:
                 return {"success": False, "error": "phone_number no disponible"}
             
-            user = await database.get_user(phone_number)
+            # Reutilizar el snapshot del contexto en lugar de otra lectura
+            user = context.user or await database.get_user(phone_number)
             if user:
                 return {
                     "success": True,
@@ -689,6 +1173,8 @@ IMPORTANTE:
             success = await database.increment_challenges_completed(phone_number)
             
             if success:
+                if context.user is not None:
+                    context.update_user(challenges_completed=context.user.get("challenges_completed", 0) + 1)
                 return {
                     "success": True,
                     "message": "Reto marcado como completado"
@@ -705,81 +1191,161 @@ IMPORTANTE:
         self, 
         user_message: str, 
         phone_number: str,
-        conversation_history: List[Dict[str, str]] = None
+        conversation_history: List[Dict[str, str]] = None,
+        context: Optional[RequestContext] = None
     ) -> str:
-        """Procesa mensaje con el agente de diálogo, cargando información del usuario primero"""
-        # Guardar phone_number para las funciones
-        self._current_phone_number = phone_number
-        
-        # Obtener información del usuario para contexto
-        user = await database.get_user(phone_number)
-        if user:
-            # Agregar contexto del usuario al system prompt
-            user_context = f"\n\nInformación del usuario:\n- Nombre: {user.get('name')}\n- Intereses: {user.get('interests')}\n- Retos completados: {user.get('challenges_completed', 0)}\n"
+        """Procesa mensaje con el agente de diálogo usando el usuario del contexto"""
+        # Solo se consulta Firestore si el llamador no trae el usuario ya cargado
+        if context is None:
+            context = await RequestContext.load(phone_number, conversation_history)
+        
+        if not context.user:
+            return "Parece que no estás registrado. Por favor, contacta al servicio de onboarding."
+        
+        if conversation_history is None:
+            conversation_history = []
+        
+        # Usar una copia del historial para no modificar el original si se usa en otro lado;
+        # el recorte lo decide el presupuesto de tokens en _build_messages
+        augmented_history = list(conversation_history)
+        
+        # Delegar al padre (Agent.process_message) que maneja el ruteo por proveedor;
+        # build_context_message añade la información del usuario del contexto
+        return await super().process_message(user_message, phone_number, augmented_history, context)
+    
+    def build_context_message(self, context: RequestContext) -> Optional[str]:
+        """Información del usuario del contexto (perfil y reto actual)"""
+        user = context.user
+        if not user:
+            return None
+        
+        user_context = f"Información del usuario:\n- Nombre: {user.get('name')}\n- Intereses: {user.get('interests')}\n- Retos completados: {user.get('challenges_completed', 0)}\n"
+        
+        # Memoria de conversaciones anteriores (ver conversation_summary.py)
+        if user.get("conversation_summary"):
+            user_context += f"- Resumen de conversaciones anteriores: {user['conversation_summary']}\n"
+        
+        # Copia del último reto enviado; el histórico está en users/{phone}/challenges
+        latest_challenge = user.get("current_challenge")
+        challenges = user.get("challenges_sent")
+        if latest_challenge is None and isinstance(challenges, list):
+            # Usuario aún sin migrar (ver migrate_challenges.py); los retos pregenerados
+            # ("ready") aún no los ha recibido el usuario
+            sent = [c for c in challenges if not (isinstance(c, dict) and c.get("status") == "ready")]
+            latest_challenge = sent[-1] if sent else None
+        
+        latest_challenge_text = None
+        if isinstance(latest_challenge, dict):
+            latest_challenge_text = latest_challenge.get("question") or latest_challenge.get("text")
+        
+        if latest_challenge_text:
+            user_context += f"- Reto actual: {latest_challenge_text}\n"
             
-            # Construir mensajes con contexto
-            if conversation_history is None:
-                conversation_history = []
-
-            challenges = user.get("challenges_sent") or []
-            latest_challenge = None
-            if isinstance(challenges, list) and challenges:
-                latest_challenge = challenges[-1]
-
-            latest_challenge_text = None
-            latest_challenge_label = None
-            if isinstance(latest_challenge, dict):
-                latest_challenge_text = latest_challenge.get("question") or latest_challenge.get("text")
-                latest_challenge_label = latest_challenge.get("sent_at") or latest_challenge.get("date")
-
-            if latest_challenge_text:
-                user_context += f"- Reto actual: {latest_challenge_text}\n"
-                
-                # Añadir opciones del reto
-                if isinstance(latest_challenge, dict):
-                    options = latest_challenge.get("options")
-                    if options:
-                        user_context += f"- Opciones: A) {options.get('A', '')}, B) {options.get('B', '')}, C) {options.get('C', '')}\n"
-                    
-                    # Añadir respuesta del usuario
-                    user_answer = latest_challenge.get("user_answer")
-                    if user_answer:
-                        user_context += f"- Usuario eligió: {user_answer}\n"
-                    
-                    # Añadir respuesta correcta
-                    correct_answer = latest_challenge.get("correct_answer")
-                    if correct_answer:
-                        user_context += f"- Respuesta correcta: {correct_answer}\n"
-
-                    # Añadir estado
-                    if latest_challenge.get("completed"):
-                         user_context += "- Estado del reto: completado ✅\n"
-
-            # Usar una copia del historial para no modificar el original si se usa en otro lado
-            augmented_history = list(conversation_history[-10:])
+            # Añadir opciones del reto
+            options = latest_challenge.get("options")
+            if options:
+                user_context += f"- Opciones: A) {options.get('A', '')}, B) {options.get('B', '')}, C) {options.get('C', '')}\n"
             
-            # Inyectar mensaje del reto si no está
-            if latest_challenge_text:
-                 # ... (Lógica de inyección de contexto visual del reto, opcional para el agente) ...
-                 pass
-
-            # Actualizar system prompt de la instancia (hack temporal para este request)
-            original_system = self.system_prompt
-            self.system_prompt = original_system + user_context
+            # Añadir respuesta del usuario
+            user_answer = latest_challenge.get("user_answer")
+            if user_answer:
+                user_context += f"- Usuario eligió: {user_answer}\n"
             
-            try:
-                # Delegar al padre (Agent.process_message) que maneja el ruteo por proveedor
-                response = await super().process_message(user_message, phone_number, augmented_history)
-            finally:
-                # Restaurar system prompt
-                self.system_prompt = original_system
-                
-            return response
-        else:
-            return "Parece que no estás registrado. Por favor, contacta al servicio de onboarding."
+            # Añadir respuesta correcta
+            correct_answer = latest_challenge.get("correct_answer")
+            if correct_answer:
+                user_context += f"- Respuesta correcta: {correct_answer}\n"
+            
+            # Añadir estado
+            if latest_challenge.get("completed"):
+                user_context += "- Estado del reto: completado ✅\n"
+        
+        return user_context
+
+
+class ChallengeCreatorAgent(Agent):
+    """Agente que genera el reto diario de un usuario (JSON con pregunta, opciones y explicación)"""
+    
+    def __init__(self):
+        system_prompt = get_system_prompt(
+            "challenge_creator",
+            """Eres un creador de retos diarios que enseñan modelos mentales.
+
+Genera un JSON con: "mental_model", "question" (máximo 25 palabras), "options" con claves A, B y C
+(máximo 20 caracteres cada una), "correct_answer" (A, B o C) y "explanation" con "core_insight".
+Adapta el tema a los intereses del usuario. Responde solo con el JSON."""
+        )
+        super().__init__(system_prompt, profile_key="challenge_creator")
+    
+    def get_tools(self) -> List[Dict[str, Any]]:
+        """El creador de retos no usa herramientas"""
+        return []
+    
+    def build_challenge_request(self, user: Dict[str, Any], date: Optional[datetime] = None) -> str:
+        """Mensaje con los datos del usuario que se envía junto al system prompt"""
+        date = date or datetime.now()
+        weekdays = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+        request = (
+            f"Crea el reto de hoy ({weekdays[date.weekday()]}) para este usuario:\n"
+            f"- Nombre: {user.get('name')}\n"
+            f"- Intereses: {user.get('interests')}\n"
+            f"- Retos completados: {user.get('challenges_completed', 0)}\n"
+        )
+        if user.get("conversation_summary"):
+            request += f"- Resumen de conversaciones anteriores: {user['conversation_summary']}\n"
+        return request + "\nResponde solo con el JSON del reto."
+    
+    def build_cluster_challenge_request(self, cluster: InterestCluster, date: Optional[datetime] = None) -> str:
+        """Mensaje para el reto compartido de un grupo de intereses (sin datos personales)"""
+        date = date or datetime.now()
+        weekdays = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+        return (
+            f"Crea el reto de hoy ({weekdays[date.weekday()]}) para un grupo de usuarios con intereses parecidos:\n"
+            f"- Intereses de ejemplo: {cluster.sample_interests}\n"
+            f"- Temas comunes: {', '.join(cluster.keywords)}\n"
+            "\nEl mismo reto lo recibirán todos. Si quieres dirigirte al usuario por su nombre, escribe {nombre}.\n"
+            "Responde solo con el JSON del reto."
+        )
+    
+    def parse_challenge(self, text: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Extrae y valida el JSON del reto (el modelo a veces lo envuelve en ```json)"""
+        if not text:
+            return None
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end <= start:
+            logger.warning("Respuesta del creador de retos sin JSON")
+            return None
+        try:
+            challenge = json.loads(text[start:end + 1])
+        except json.JSONDecodeError as e:
+            logger.warning(f"JSON de reto inválido: {str(e)}")
+            return None
+        
+        options = challenge.get("options")
+        if not challenge.get("question") or not isinstance(options, dict) or not all(options.get(k) for k in ("A", "B", "C")):
+            logger.warning("Reto incompleto: falta la pregunta o alguna opción")
+            return None
+        return challenge
+    
+    async def generate_challenge(self, user: Dict[str, Any], date: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        """Genera el reto de un usuario con una completion síncrona"""
+        text = await self.complete_text([
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": self.build_challenge_request(user, date)}
+        ], stage="challenge")
+        return self.parse_challenge(text)
+    
+    async def generate_cluster_challenge(self, cluster: InterestCluster, date: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        """Genera el reto compartido de un grupo; se personaliza con personalize_challenge"""
+        text = await self.complete_text([
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": self.build_cluster_challenge_request(cluster, date)}
+        ], stage="cluster_challenge")
+        return self.parse_challenge(text)
 
 # Instancias globales
 logger.info("Inicializando agentes...")
 onboarding_agent = OnboardingAgent()
 dialogue_agent = DialogueAgent()
+challenge_creator_agent = ChallengeCreatorAgent()
 logger.info("Agentes inicializados")
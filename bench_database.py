@@ -0,0 +1,76 @@
+"""
+Benchmark de concurrencia del acceso a Firestore
+Compara llamadas bloqueantes dentro del event loop (comportamiento anterior)
+con el pool de threads de Database, usando un cliente simulado con latencia fija
+"""
+import asyncio
+import os
+import time
+
+from database import database
+
+# Latencia simulada de un round-trip a Firestore
+SIMULATED_RTT = float(os.getenv("BENCH_FIRESTORE_RTT", "0.03"))
+CONCURRENT_REQUESTS = int(os.getenv("BENCH_CONCURRENCY", "100"))
+
+
+class _FakeSnapshot:
+    exists = True
+
+    def to_dict(self):
+        return {"name": "Bench", "interests": "benchmark", "onboarding_completed": True}
+
+
+class _FakeDocument:
+    def get(self):
+        time.sleep(SIMULATED_RTT)
+        return _FakeSnapshot()
+
+
+class _FakeCollection:
+    def document(self, _doc_id):
+        return _FakeDocument()
+
+
+class FakeFirestore:
+    """Cliente mínimo que bloquea el thread igual que el cliente síncrono real"""
+
+    def collection(self, _name):
+        return _FakeCollection()
+
+
+async def blocking_get_user(phone_number: str):
+    """Réplica de get_user antes del cambio: llama a Firestore dentro del event loop"""
+    doc = database.db.collection("users").document(phone_number).get()
+    return doc.to_dict() if doc.exists else None
+
+
+async def measure(label: str, coroutine_factory) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(coroutine_factory(f"+34{i:09d}") for i in range(CONCURRENT_REQUESTS)))
+    elapsed = time.perf_counter() - start
+    throughput = CONCURRENT_REQUESTS / elapsed
+    print(f"   {label:<28} {elapsed:6.2f}s  ({throughput:7.1f} lecturas/s)")
+    return throughput
+
+
+async def run_benchmark():
+    print("=" * 60)
+    print("📊 Benchmark de lecturas concurrentes a Firestore")
+    print(f"   RTT simulado: {SIMULATED_RTT * 1000:.0f} ms, peticiones: {CONCURRENT_REQUESTS}, "
+          f"workers: {database.max_workers}")
+    print("=" * 60)
+
+    original_db = database.db
+    database.db = FakeFirestore()
+    try:
+        before = await measure("Bloqueante (antes)", blocking_get_user)
+        after = await measure("Pool de threads (después)", database.get_user)
+    finally:
+        database.db = original_db
+
+    print(f"\n✅ Mejora: x{after / before:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark())
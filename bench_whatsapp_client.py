@@ -0,0 +1,89 @@
+"""
+Micro-benchmark del envío de mensajes de WhatsAppClient
+Levanta un servidor local que imita la Graph API de Meta y compara
+una sesión HTTP por mensaje (comportamiento anterior) con la sesión compartida
+"""
+import asyncio
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+
+from whatsapp_client import WhatsAppClient, SendResult
+
+MESSAGES = int(os.getenv("BENCH_MESSAGES", "500"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "20"))
+STUB_PORT = int(os.getenv("BENCH_STUB_PORT", "8765"))
+
+
+async def _stub_messages(_request):
+    return web.json_response({"messages": [{"id": "wamid.bench"}]})
+
+
+async def start_stub_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_post("/v21.0/{phone_number_id}/messages", _stub_messages)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+    return runner
+
+
+class PerMessageSessionClient(WhatsAppClient):
+    """Réplica del comportamiento anterior: una ClientSession nueva por envío"""
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession()
+
+    async def _send_via_meta(self, to: str, message: str) -> SendResult:
+        url = f"{self.meta_base_url}/{self.phone_number_id}/messages"
+        async with self._get_session() as session:
+            async with session.post(url, json={"to": to, "text": {"body": message}}) as response:
+                await response.json()
+                return SendResult(response.status == 200, status=response.status)
+
+
+async def measure(label: str, client: WhatsAppClient) -> float:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def send(index: int):
+        async with semaphore:
+            return await client.send_message(f"+34{index:09d}", "Reto del día")
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(send(i) for i in range(MESSAGES)))
+    elapsed = time.perf_counter() - start
+    rate = MESSAGES / elapsed
+    print(f"   {label:<26} {rate:8.1f} mensajes/s  ({sum(results)}/{MESSAGES} ok)")
+    return rate
+
+
+async def run_benchmark():
+    os.environ["WHATSAPP_API_BASE_URL"] = f"http://127.0.0.1:{STUB_PORT}/v21.0"
+    os.environ.setdefault("WHATSAPP_API_KEY", "bench-token")
+    os.environ.setdefault("WHATSAPP_PHONE_NUMBER_ID", "123456")
+
+    print("=" * 60)
+    print("📊 Benchmark de envío contra servidor local de Meta")
+    print(f"   Mensajes: {MESSAGES}, concurrencia: {CONCURRENCY}")
+    print("=" * 60)
+
+    runner = await start_stub_server()
+    pooled_client = WhatsAppClient()
+    pooled_client.provider = "meta"
+    legacy_client = PerMessageSessionClient()
+    legacy_client.provider = "meta"
+    try:
+        before = await measure("Sesión por mensaje (antes)", legacy_client)
+        await pooled_client.start()
+        after = await measure("Sesión compartida (después)", pooled_client)
+    finally:
+        await pooled_client.close()
+        await runner.cleanup()
+
+    print(f"\n✅ Mejora: x{after / before:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark())
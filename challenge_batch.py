@@ -0,0 +1,457 @@
+"""
+Pregeneración nocturna de retos por lotes
+Recoge los intereses de los usuarios, genera todos los retos del día siguiente en
+un único trabajo de la Batch API de OpenAI o del modo batch de Gemini (más barato
+que las completions síncronas) y los guarda en ready_challenge con estado "ready".
+Con los grupos de intereses activos (interest_clusters.py) se pide un reto por
+grupo y se personaliza con el nombre de cada usuario. Por la mañana,
+challenge_broadcast.py solo tiene que enviarlos
+
+El batch_id se guarda en el checkpoint de la ejecución: si el proceso se corta o
+el lote aún no ha terminado, volver a lanzarlo sigue esperando el mismo lote en
+vez de enviar otro
+
+Uso (p.ej. como Cloud Run Job programado cada noche):
+    python challenge_batch.py [--date 2025-02-01]
+"""
+import os
+import io
+import json
+import uuid
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+try:
+    from google.genai import types
+    HAS_GEMINI = True
+except ImportError:
+    HAS_GEMINI = False
+
+from database import database
+from agents import challenge_creator_agent, ChallengeCreatorAgent
+from challenge_broadcast import BroadcastCheckpoint, create_checkpoint, ready_challenge
+from interest_clusters import interest_clusters, InterestClusters, personalize_challenge
+
+logger = logging.getLogger(__name__)
+
+BATCH_RUNNING = "running"
+BATCH_COMPLETED = "completed"
+BATCH_FAILED = "failed"
+
+# Campos para construir la petición y saltar a quien ya tiene el reto del día
+USER_FIELDS = [
+    "name", "interests", "challenges_completed", "conversation_summary",
+    "last_challenge_date", "ready_challenge", "interest_cluster"
+]
+
+OPENAI_BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def _openai_request_line(custom_id: str, body: Dict[str, Any]) -> str:
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": OPENAI_BATCH_ENDPOINT, "body": body}, ensure_ascii=False)
+
+
+def _parse_openai_output(text: str) -> Dict[str, Optional[str]]:
+    """custom_id -> texto generado (None si esa petición falló) a partir del JSONL de salida"""
+    results: Dict[str, Optional[str]] = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            logger.warning("Línea de resultados del lote ilegible")
+            continue
+        content = None
+        response = item.get("response") or {}
+        if response.get("status_code") == 200:
+            choices = (response.get("body") or {}).get("choices") or []
+            if choices:
+                content = (choices[0].get("message") or {}).get("content")
+        else:
+            logger.warning(f"Petición {item.get('custom_id')} del lote fallida: {item.get('error') or response.get('status_code')}")
+        results[item.get("custom_id")] = content
+    return results
+
+
+class ChallengeBatchBackend:
+    """Endpoint de generación por lotes: enviar, consultar el estado y descargar los resultados"""
+
+    name = "base"
+
+    def __init__(self, agent: ChallengeCreatorAgent):
+        self.agent = agent
+
+    @property
+    def client(self):
+        if not self.agent._ensure_client():
+            raise RuntimeError(f"Cliente de {self.name} no disponible para el lote de retos")
+        return self.agent.client
+
+    async def submit(self, requests: List[Dict[str, Any]]) -> str:
+        """Envía las peticiones ({"custom_id", "messages"}) y devuelve el id del lote"""
+        raise NotImplementedError("Subclases deben implementar submit")
+
+    async def poll(self, batch_id: str) -> str:
+        """Estado del lote: BATCH_RUNNING, BATCH_COMPLETED o BATCH_FAILED"""
+        raise NotImplementedError("Subclases deben implementar poll")
+
+    async def results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        """custom_id -> texto generado de un lote terminado"""
+        raise NotImplementedError("Subclases deben implementar results")
+
+
+class OpenAIChallengeBatch(ChallengeBatchBackend):
+    """Batch API de OpenAI: JSONL subido como archivo y procesado en la ventana de 24h"""
+
+    name = "openai"
+
+    def _body(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        model = self.agent.model
+        return {"model": model, "messages": messages, **self.agent.generation_profile.openai_kwargs(model)}
+
+    async def submit(self, requests: List[Dict[str, Any]]) -> str:
+        client = self.client
+        payload = "\n".join(_openai_request_line(r["custom_id"], self._body(r["messages"])) for r in requests)
+        input_file = await client.files.create(
+            file=("challenges.jsonl", io.BytesIO(payload.encode("utf-8"))),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=OPENAI_BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata={"job": "challenge_batch"}
+        )
+        return batch.id
+
+    async def poll(self, batch_id: str) -> str:
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status == "completed":
+            return BATCH_COMPLETED
+        # Un lote expirado o cancelado conserva los resultados que sí terminaron
+        if batch.status in ("expired", "cancelled"):
+            return BATCH_COMPLETED if batch.output_file_id else BATCH_FAILED
+        if batch.status == "failed":
+            return BATCH_FAILED
+        return BATCH_RUNNING
+
+    async def results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        client = self.client
+        batch = await client.batches.retrieve(batch_id)
+        if not batch.output_file_id:
+            return {}
+        content = await client.files.content(batch.output_file_id)
+        return _parse_openai_output(content.text)
+
+
+class GeminiChallengeBatch(ChallengeBatchBackend):
+    """Modo batch de Gemini con peticiones inline; el custom_id viaja en metadata"""
+
+    name = "gemini"
+
+    _RUNNING_STATES = {"JOB_STATE_QUEUED", "JOB_STATE_PENDING", "JOB_STATE_RUNNING", "JOB_STATE_UPDATING", "JOB_STATE_UNSPECIFIED"}
+    _COMPLETED_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+
+    def __init__(self, agent: ChallengeCreatorAgent):
+        if not HAS_GEMINI:
+            raise RuntimeError("Librería google-genai no instalada. Ejecuta pip install google-genai")
+        super().__init__(agent)
+
+    def _inlined_request(self, request: Dict[str, Any]) -> "types.InlinedRequest":
+        # Sin CachedContent: el lote puede tardar más que el TTL de la caché
+        system_text = "\n\n".join(m["content"] for m in request["messages"] if m["role"] == "system")
+        user_text = "\n\n".join(m["content"] for m in request["messages"] if m["role"] == "user")
+        return types.InlinedRequest(
+            contents=[types.Content(role="user", parts=[types.Part.from_text(text=user_text)])],
+            config=types.GenerateContentConfig(
+                system_instruction=system_text or None,
+                **self.agent.generation_profile.gemini_config(self.agent.model)
+            ),
+            metadata={"custom_id": request["custom_id"]}
+        )
+
+    async def submit(self, requests: List[Dict[str, Any]]) -> str:
+        job = await self.client.aio.batches.create(
+            model=self.agent.model,
+            src=[self._inlined_request(r) for r in requests],
+            config=types.CreateBatchJobConfig(display_name="challenge_batch")
+        )
+        return job.name
+
+    async def poll(self, batch_id: str) -> str:
+        job = await self.client.aio.batches.get(name=batch_id)
+        state = getattr(job.state, "value", str(job.state))
+        if state in self._COMPLETED_STATES:
+            return BATCH_COMPLETED
+        if state in self._RUNNING_STATES:
+            return BATCH_RUNNING
+        return BATCH_FAILED
+
+    async def results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        job = await self.client.aio.batches.get(name=batch_id)
+        results: Dict[str, Optional[str]] = {}
+        for item in (job.dest.inlined_responses if job.dest else None) or []:
+            custom_id = (item.metadata or {}).get("custom_id")
+            if not custom_id:
+                continue
+            text = None
+            response = item.response
+            if response and response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+                text = "".join(p.text for p in response.candidates[0].content.parts if p.text and not p.thought) or None
+            elif item.error:
+                logger.warning(f"Petición {custom_id} del lote fallida: {item.error}")
+            results[custom_id] = text
+        return results
+
+
+class FileChallengeBatch(ChallengeBatchBackend):
+    """
+    Sustituto local del endpoint de lotes (desarrollo y pruebas)
+
+    Escribe la entrada en el mismo JSONL que la Batch API de OpenAI y, al consultar
+    el estado, lo procesa con completions normales (o con respond) y deja la salida
+    en el formato de OpenAI junto a la entrada
+    """
+
+    name = "file"
+
+    def __init__(
+        self,
+        agent: ChallengeCreatorAgent,
+        directory: Optional[str] = None,
+        respond: Optional[Callable[[List[Dict[str, Any]]], Awaitable[Optional[str]]]] = None,
+        concurrency: int = 8
+    ):
+        super().__init__(agent)
+        self.directory = Path(directory or os.getenv("CHALLENGE_BATCH_DIR", ".challenge_batches"))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.respond = respond or (lambda messages: agent.complete_text(messages, stage="challenge_batch"))
+        self.concurrency = concurrency
+
+    def _path(self, batch_id: str, kind: str) -> Path:
+        return self.directory / f"{batch_id}.{kind}.jsonl"
+
+    async def submit(self, requests: List[Dict[str, Any]]) -> str:
+        batch_id = f"local-{uuid.uuid4().hex[:12]}"
+        payload = "\n".join(_openai_request_line(r["custom_id"], {"messages": r["messages"]}) for r in requests)
+        self._path(batch_id, "input").write_text(payload + "\n", encoding="utf-8")
+        return batch_id
+
+    async def _process(self, batch_id: str):
+        lines = self._path(batch_id, "input").read_text(encoding="utf-8").splitlines()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _one(line: str) -> str:
+            request = json.loads(line)
+            async with semaphore:
+                try:
+                    content = await self.respond(request["body"]["messages"])
+                    response, error = {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}}, None
+                except Exception as e:
+                    response, error = {"status_code": 500, "body": None}, {"message": str(e)}
+            return json.dumps({"custom_id": request["custom_id"], "response": response, "error": error}, ensure_ascii=False)
+
+        output = await asyncio.gather(*(_one(line) for line in lines if line.strip()))
+        tmp_path = self._path(batch_id, "output").with_suffix(".tmp")
+        tmp_path.write_text("\n".join(output) + "\n", encoding="utf-8")
+        tmp_path.replace(self._path(batch_id, "output"))
+
+    async def poll(self, batch_id: str) -> str:
+        if not self._path(batch_id, "input").exists():
+            return BATCH_FAILED
+        if not self._path(batch_id, "output").exists():
+            await self._process(batch_id)
+        return BATCH_COMPLETED
+
+    async def results(self, batch_id: str) -> Dict[str, Optional[str]]:
+        return _parse_openai_output(self._path(batch_id, "output").read_text(encoding="utf-8"))
+
+
+def create_batch_backend(agent: ChallengeCreatorAgent) -> ChallengeBatchBackend:
+    backend = os.getenv("CHALLENGE_BATCH_BACKEND", agent.provider).lower()
+    if backend == "openai":
+        return OpenAIChallengeBatch(agent)
+    if backend == "gemini":
+        return GeminiChallengeBatch(agent)
+    return FileChallengeBatch(agent)
+
+
+class ChallengeBatchJob:
+    """Recoge usuarios, envía un único lote, espera sus resultados y guarda los retos listos"""
+
+    def __init__(
+        self,
+        run_date: Optional[datetime] = None,
+        page_size: Optional[int] = None,
+        poll_interval: Optional[float] = None,
+        max_wait: Optional[float] = None,
+        checkpoint: Optional[BroadcastCheckpoint] = None,
+        backend: Optional[ChallengeBatchBackend] = None,
+        creator: Optional[ChallengeCreatorAgent] = None,
+        clusters: Optional[InterestClusters] = None
+    ):
+        # Por defecto se preparan los retos de mañana
+        self.run_date = run_date or (datetime.now() + timedelta(days=1))
+        self.challenge_date = self.run_date.strftime("%Y-%m-%d")
+        self.page_size = page_size or int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+        self.poll_interval = poll_interval if poll_interval is not None else float(os.getenv("CHALLENGE_BATCH_POLL_SECONDS", "60"))
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv("CHALLENGE_BATCH_MAX_WAIT_SECONDS", "21600"))
+        self.checkpoint = checkpoint or create_checkpoint(f"batch-{self.challenge_date}")
+        self.creator = creator or challenge_creator_agent
+        self.backend = backend or create_batch_backend(self.creator)
+        self.clusters = clusters or interest_clusters
+        self.state: Dict[str, Any] = {}
+
+    def needs_challenge(self, user: Dict[str, Any]) -> bool:
+        """False si el usuario ya recibió el reto de ese día o ya lo tiene preparado"""
+        last = user.get("last_challenge_date")
+        if isinstance(last, str):
+            last = datetime.fromisoformat(last)
+        if last and last.date() >= self.run_date.date():
+            return False
+        return ready_challenge(user, self.challenge_date) is None
+
+    async def collect_users(self) -> List[Dict[str, Any]]:
+        """Usuarios que aún necesitan el reto de la fecha"""
+        pending = []
+        cursor = None
+        while True:
+            users = await database.list_users_page(self.page_size, start_after=cursor, fields=USER_FIELDS)
+            pending.extend(user for user in users if self.needs_challenge(user))
+            if len(users) < self.page_size:
+                return pending
+            cursor = users[-1]["phone_number"]
+
+    def _request(self, custom_id: str, content: str) -> Dict[str, Any]:
+        return {
+            "custom_id": custom_id,
+            "messages": [
+                {"role": "system", "content": self.creator.system_prompt},
+                {"role": "user", "content": content}
+            ]
+        }
+
+    async def build_requests(self, users: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Una petición por grupo de intereses (o por usuario, con los grupos desactivados
+        o si el usuario no tiene intereses), con el mismo prompt que la generación síncrona
+        """
+        requests: Dict[str, Dict[str, Any]] = {}
+        for user in users:
+            cluster = await self.clusters.cluster_of(user)
+            if cluster is None:
+                requests[user["phone_number"]] = self._request(
+                    user["phone_number"], self.creator.build_challenge_request(user, self.run_date)
+                )
+            elif f"cluster:{cluster.cluster_id}" not in requests:
+                custom_id = f"cluster:{cluster.cluster_id}"
+                requests[custom_id] = self._request(custom_id, self.creator.build_cluster_challenge_request(cluster, self.run_date))
+        return list(requests.values())
+
+    async def _wait(self, batch_id: str) -> str:
+        waited = 0.0
+        while True:
+            status = await self.backend.poll(batch_id)
+            if status != BATCH_RUNNING or waited >= self.max_wait:
+                return status
+            await asyncio.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+    async def store_results(self, results: Dict[str, Optional[str]], users: List[Dict[str, Any]]):
+        """Valida cada reto, lo personaliza y lo guarda en ready_challenge para la fecha"""
+        semaphore = asyncio.Semaphore(int(os.getenv("BROADCAST_CONCURRENCY", "50")))
+        generated_at = self.state.get("submitted_at")
+        parsed: Dict[str, Optional[Dict[str, Any]]] = {}
+
+        async def _store(user: Dict[str, Any]):
+            phone_number = user["phone_number"]
+            custom_id = phone_number if phone_number in results else f"cluster:{user.get('interest_cluster')}"
+            if custom_id not in results:
+                # Usuario nuevo o reasignado después de enviar el lote: se generará al enviar
+                self.state["missing"] = self.state.get("missing", 0) + 1
+                return
+            if custom_id not in parsed:
+                parsed[custom_id] = self.creator.parse_challenge(results[custom_id])
+            challenge = parsed[custom_id]
+            if not challenge:
+                self.state["invalid"] = self.state.get("invalid", 0) + 1
+                return
+            challenge = dict(
+                personalize_challenge(challenge, user.get("name")),
+                date=self.challenge_date, status="ready", generated_at=generated_at
+            )
+            async with semaphore:
+                stored = await database.store_ready_challenge(phone_number, challenge)
+            counter = "ready" if stored else "invalid"
+            self.state[counter] = self.state.get(counter, 0) + 1
+
+        await asyncio.gather(*(_store(user) for user in users))
+
+    async def run(self) -> Dict[str, Any]:
+        """Ejecuta (o reanuda) la pregeneración; devuelve el estado final"""
+        self.state = await self.checkpoint.load()
+        if self.state.get("status") in ("completed", "failed"):
+            logger.info(f"La pregeneración del {self.challenge_date} ya terminó ({self.state['status']})")
+            return self.state
+
+        users = await self.collect_users()
+        batch_id = self.state.get("batch_id")
+        if batch_id:
+            logger.info(f"Reanudando el lote {batch_id} del {self.challenge_date}")
+        else:
+            requests = await self.build_requests(users)
+            self.state.update({
+                "challenge_date": self.challenge_date,
+                "backend": self.backend.name,
+                "users": len(users),
+                "requested": len(requests)
+            })
+            if not requests:
+                self.state["status"] = "completed"
+                await self.checkpoint.save(self.state)
+                logger.info(f"Ningún usuario necesita reto pregenerado para el {self.challenge_date}")
+                return self.state
+            batch_id = await self.backend.submit(requests)
+            self.state.update({"batch_id": batch_id, "status": "submitted", "submitted_at": datetime.now().isoformat()})
+            await self.checkpoint.save(self.state)
+            logger.info(f"Lote {batch_id} enviado con {len(requests)} retos para {len(users)} usuarios del {self.challenge_date}")
+
+        status = await self._wait(batch_id)
+        if status == BATCH_RUNNING:
+            # Sigue en cola: la próxima ejecución retoma el mismo lote
+            logger.warning(f"El lote {batch_id} sigue en curso; se reintentará en la próxima ejecución")
+            return self.state
+        if status == BATCH_FAILED:
+            self.state.update({"status": "failed", "finished_at": datetime.now().isoformat()})
+            await self.checkpoint.save(self.state)
+            logger.error(f"El lote {batch_id} falló; el envío generará los retos al momento")
+            return self.state
+
+        await self.store_results(await self.backend.results(batch_id), users)
+        self.state.update({"status": "completed", "finished_at": datetime.now().isoformat()})
+        await self.checkpoint.save(self.state)
+        logger.info(
+            f"Pregeneración del {self.challenge_date} terminada: {self.state.get('ready', 0)} retos listos, "
+            f"{self.state.get('invalid', 0)} inválidos, {self.state.get('missing', 0)} sin reto en el lote"
+        )
+        return self.state
+
+
+async def main(run_date: Optional[datetime] = None):
+    try:
+        return await ChallengeBatchJob(run_date).run()
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(name)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Pregenera por lotes los retos del día siguiente")
+    parser.add_argument("--date", help="Fecha de los retos (YYYY-MM-DD); por defecto mañana")
+    args = parser.parse_args()
+    asyncio.run(main(datetime.strptime(args.date, "%Y-%m-%d") if args.date else None))
@@ -0,0 +1,354 @@
+"""
+Envío del reto diario a todos los usuarios
+Recorre los usuarios de Firestore por páginas (cursor por número de teléfono),
+asigna el reto de cada uno (el pregenerado por challenge_batch.py o, si no hay,
+uno generado al momento para su grupo de intereses) y lo envía con un pool de workers acotado.
+Fuera de la ventana de 24 h desde el último mensaje del usuario WhatsApp solo entrega
+plantillas aprobadas: con WHATSAPP_CHALLENGE_TEMPLATE el reto sale como plantilla; sin
+ella sale como texto libre y esos rechazos se cuentan aparte (outside_window).
+El progreso se guarda por páginas: si la ejecución se interrumpe, la siguiente
+continúa desde la última página terminada
+
+Uso (p.ej. como Cloud Run Job programado cada mañana):
+    python challenge_broadcast.py [--date 2025-01-31]
+"""
+import os
+import json
+import asyncio
+import argparse
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from database import database
+from agents import challenge_creator_agent, ChallengeCreatorAgent
+from interest_clusters import interest_clusters, InterestClusters, personalize_challenge
+from outbound_dispatcher import outbound_dispatcher, OutboundDispatcher
+from whatsapp_client import whatsapp_client, SendResult
+
+logger = logging.getLogger(__name__)
+
+# Campos que necesita el envío; la proyección evita descargar el resto del documento
+USER_FIELDS = [
+    "name", "interests", "challenges_completed", "last_challenge_date",
+    "conversation_summary", "ready_challenge", "interest_cluster"
+]
+
+
+def ready_challenge(user: Dict[str, Any], challenge_date: str) -> Optional[Dict[str, Any]]:
+    """Reto pregenerado (ready_challenge) del usuario para la fecha, si lo hay"""
+    challenge = user.get("ready_challenge")
+    if isinstance(challenge, dict) and challenge.get("date") == challenge_date:
+        return challenge
+    return None
+
+
+def format_challenge_message(challenge: Dict[str, Any], name: Optional[str] = None) -> str:
+    """Texto de WhatsApp del reto: pregunta y opciones A/B/C"""
+    options = challenge.get("options") or {}
+    greeting = f"¡Buenos días, {name}! 🧠" if name else "¡Buenos días! 🧠"
+    return (
+        f"{greeting} Tu reto de hoy:\n\n"
+        f"{challenge.get('question')}\n\n"
+        f"A) {options.get('A', '')}\n"
+        f"B) {options.get('B', '')}\n"
+        f"C) {options.get('C', '')}\n\n"
+        "Responde con A, B o C."
+    )
+
+
+def challenge_template_parameters(challenge: Dict[str, Any], name: Optional[str] = None) -> List[str]:
+    """
+    Variables de la plantilla del reto: {{1}} nombre, {{2}} pregunta, {{3}}-{{5}} opciones A/B/C
+
+    Las variables de una plantilla no admiten saltos de línea ni valores vacíos
+    """
+    options = challenge.get("options") or {}
+    values = [name or "amigo/a", challenge.get("question"), options.get("A"), options.get("B"), options.get("C")]
+    return [" ".join(str(value or "-").split()) for value in values]
+
+
+class BroadcastCheckpoint:
+    """Estado de una ejecución: cursor de la última página terminada y contadores"""
+
+    async def load(self) -> Dict[str, Any]:
+        raise NotImplementedError("Subclases deben implementar load")
+
+    async def save(self, state: Dict[str, Any]):
+        raise NotImplementedError("Subclases deben implementar save")
+
+
+class FirestoreBroadcastCheckpoint(BroadcastCheckpoint):
+    """Checkpoint en broadcast_runs/{run_id}"""
+
+    def __init__(self, run_id: str, collection: str = "broadcast_runs"):
+        self.doc_ref = database.db.collection(collection).document(run_id)
+
+    async def load(self) -> Dict[str, Any]:
+        snapshot = await database.run(self.doc_ref.get)
+        return (snapshot.to_dict() or {}) if snapshot.exists else {}
+
+    async def save(self, state: Dict[str, Any]):
+        await database.run(self.doc_ref.set, dict(state, updated_at=datetime.now()))
+
+
+class FileBroadcastCheckpoint(BroadcastCheckpoint):
+    """Checkpoint en un archivo JSON (desarrollo local y pruebas)"""
+
+    def __init__(self, run_id: str, directory: Optional[str] = None):
+        directory = Path(directory or os.getenv("BROADCAST_CHECKPOINT_DIR", ".broadcast_runs"))
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / f"{run_id}.json"
+
+    async def load(self) -> Dict[str, Any]:
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text(encoding="utf-8"))
+
+    async def save(self, state: Dict[str, Any]):
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state, default=str), encoding="utf-8")
+        tmp_path.replace(self.path)
+
+
+def create_checkpoint(run_id: str) -> BroadcastCheckpoint:
+    backend = os.getenv("BROADCAST_CHECKPOINT", "firestore" if database.is_connected() else "file").lower()
+    if backend == "firestore":
+        return FirestoreBroadcastCheckpoint(run_id)
+    return FileBroadcastCheckpoint(run_id)
+
+
+class ChallengeBroadcast:
+    """Productor de páginas de usuarios + workers que generan, envían y registran cada reto"""
+
+    def __init__(
+        self,
+        run_date: Optional[datetime] = None,
+        page_size: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        checkpoint: Optional[BroadcastCheckpoint] = None,
+        dispatcher: Optional[OutboundDispatcher] = None,
+        creator: Optional[ChallengeCreatorAgent] = None,
+        clusters: Optional[InterestClusters] = None
+    ):
+        self.run_date = run_date or datetime.now()
+        self.run_id = self.run_date.strftime("%Y-%m-%d")
+        self.page_size = page_size or int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+        self.concurrency = concurrency or int(os.getenv("BROADCAST_CONCURRENCY", "50"))
+        self.checkpoint = checkpoint or create_checkpoint(self.run_id)
+        self.dispatcher = dispatcher or outbound_dispatcher
+        # Plantilla aprobada del reto (nombre en Meta, ContentSid en Twilio); sin ella, texto libre
+        self.template = os.getenv("WHATSAPP_CHALLENGE_TEMPLATE")
+        self.creator = creator or challenge_creator_agent
+        self.clusters = clusters or interest_clusters
+        # Reto de cada grupo de intereses generado durante esta ejecución (una sola vez por grupo)
+        self._cluster_challenges: Dict[str, asyncio.Task] = {}
+
+        self.state: Dict[str, Any] = {}
+        # Páginas en vuelo, en orden: [último teléfono, usuarios pendientes, contadores]
+        self._pages: List[list] = []
+        self._checkpoint_lock = asyncio.Lock()
+        # Registros de retos ya enviados; se esperan aunque la ejecución se cancele
+        self._recording: Set[asyncio.Task] = set()
+
+    def _count(self, counter: str, counters: Optional[Dict[str, int]] = None):
+        counters = self.state if counters is None else counters
+        counters[counter] = counters.get(counter, 0) + 1
+
+    def _last_challenge_date(self, user: Dict[str, Any]) -> Optional[datetime]:
+        last = user.get("last_challenge_date")
+        if isinstance(last, str):
+            last = datetime.fromisoformat(last)
+        if last and last.tzinfo is not None:
+            # Firestore devuelve UTC; started_at se guarda en hora local
+            last = last.astimezone().replace(tzinfo=None)
+        return last
+
+    def already_sent(self, user: Dict[str, Any]) -> bool:
+        # Enviados cuyo registro falló: last_challenge_date no se escribió
+        if user["phone_number"] in self.state.get("unrecorded", []):
+            return True
+        last = self._last_challenge_date(user)
+        return bool(last) and last.date() >= self.run_date.date()
+
+    def sent_by_this_run(self, user: Dict[str, Any]) -> bool:
+        """Si el reto se lo envió un intento anterior de esta misma ejecución (antes de un corte)"""
+        if user["phone_number"] in self.state.get("unrecorded", []):
+            return True
+        last = self._last_challenge_date(user)
+        started_at = self.state.get("started_at")
+        return bool(last and started_at) and last >= datetime.fromisoformat(started_at)
+
+    async def assign_challenge(self, user: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Reto del usuario para hoy: el pregenerado por lotes o, si no hay, el de su
+        grupo de intereses (generado una vez por grupo) o uno solo para él
+        """
+        challenge = ready_challenge(user, self.run_id)
+        if challenge:
+            return challenge
+
+        cluster = await self.clusters.cluster_of(user)
+        if cluster is None:
+            return await self.creator.generate_challenge(user, self.run_date)
+        task = self._cluster_challenges.get(cluster.cluster_id)
+        # Si la generación del grupo falló, el siguiente miembro lo vuelve a intentar
+        if task is None or (task.done() and (task.cancelled() or task.exception() or not task.result())):
+            task = self._cluster_challenges[cluster.cluster_id] = asyncio.ensure_future(
+                self.creator.generate_cluster_challenge(cluster, self.run_date)
+            )
+        challenge = await asyncio.shield(task)
+        return personalize_challenge(challenge, user.get("name")) if challenge else None
+
+    async def send_challenge(self, phone_number: str, challenge: Dict[str, Any], name: Optional[str]) -> SendResult:
+        if self.template:
+            return await self.dispatcher.send_template(phone_number, self.template, challenge_template_parameters(challenge, name))
+        return await self.dispatcher.send_result(phone_number, format_challenge_message(challenge, name))
+
+    async def process_user(self, user: Dict[str, Any], counters: Optional[Dict[str, int]] = None):
+        """
+        Envía el reto a un usuario; los contadores son los de su página, que pasan
+        al estado cuando la página termina (así un corte no cuenta a nadie dos veces)
+        """
+        phone_number = user["phone_number"]
+        if self.already_sent(user):
+            # Al reanudar, los usuarios de una página a medias que ya lo recibieron
+            self._count("already_sent" if self.sent_by_this_run(user) else "skipped", counters)
+            return
+
+        challenge = await self.assign_challenge(user)
+        if not challenge:
+            logger.warning(f"Sin reto para {phone_number}")
+            self._count("failed", counters)
+            return
+
+        pregenerated = challenge.get("status") == "ready"
+        if pregenerated:
+            self._count("pregenerated", counters)
+        result = await self.send_challenge(phone_number, challenge, user.get("name"))
+        if not result.ok:
+            # Sin plantilla, el texto libre no llega a quien lleva más de 24 h sin escribir
+            self._count("outside_window" if result.outside_window else "failed", counters)
+            return
+
+        now = datetime.now()
+        challenge = dict(challenge, date=self.run_id, status="sent", sent_at=now, completed=False)
+        record = asyncio.ensure_future(database.record_challenge_sent(phone_number, challenge, now, clear_ready=pregenerated))
+        self._recording.add(record)
+        record.add_done_callback(self._recording.discard)
+        if not await asyncio.shield(record):
+            # El mensaje ya salió: se guarda en el checkpoint para no reenviarlo al reanudar
+            logger.error(f"Reto enviado a {phone_number} pero no registrado")
+            self._count("failed", counters)
+            self.state.setdefault("unrecorded", []).append(phone_number)
+            await self._save_checkpoint()
+            return
+        self._count("sent", counters)
+
+    async def _save_checkpoint(self):
+        async with self._checkpoint_lock:
+            await self.checkpoint.save(self.state)
+
+    async def _page_done(self, page: list):
+        page[1] -= 1
+        advanced = False
+        # El cursor solo avanza hasta la primera página con usuarios pendientes
+        while self._pages and self._pages[0][1] == 0:
+            cursor, _, counters = self._pages.pop(0)
+            for counter, value in counters.items():
+                self.state[counter] = self.state.get(counter, 0) + value
+            self.state["cursor"] = cursor
+            advanced = True
+        if advanced:
+            await self._save_checkpoint()
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            page, user = await queue.get()
+            try:
+                try:
+                    await self.process_user(user, page[2])
+                except Exception as e:
+                    logger.error(f"Error enviando el reto a {user.get('phone_number')}: {str(e)}")
+                    self._count("failed", page[2])
+                # Si se cancela a medias, el usuario no cuenta como hecho y el cursor no lo pasa
+                await self._page_done(page)
+            finally:
+                queue.task_done()
+
+    async def run(self) -> Dict[str, Any]:
+        """Ejecuta (o reanuda) el envío del día; devuelve los contadores finales"""
+        self.state = await self.checkpoint.load()
+        if self.state.get("status") == "completed":
+            logger.info(f"El envío del {self.run_id} ya se completó")
+            return self.state
+        if self.state.get("cursor"):
+            logger.info(f"Reanudando el envío del {self.run_id} después de {self.state['cursor']}")
+        self.state.update({"run_id": self.run_id, "status": "running"})
+        self.state.setdefault("started_at", datetime.now().isoformat())
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        error = None
+        try:
+            cursor = self.state.get("cursor")
+            while True:
+                try:
+                    users = await database.list_users_page(self.page_size, start_after=cursor, fields=USER_FIELDS)
+                except Exception as e:
+                    # Se terminan los usuarios ya encolados; la próxima ejecución sigue desde el cursor
+                    logger.error(f"Error leyendo usuarios después de {cursor}: {str(e)}")
+                    error = str(e)
+                    break
+                if not users:
+                    break
+                cursor = users[-1]["phone_number"]
+                page = [cursor, len(users), {}]
+                self._pages.append(page)
+                for user in users:
+                    await queue.put((page, user))
+                if len(users) < self.page_size:
+                    break
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # Si se cancela a medias, los mensajes ya enviados quedan registrados y no se reenvían
+            if self._recording:
+                await asyncio.gather(*self._recording, return_exceptions=True)
+
+        if error:
+            self.state.update({"status": "failed", "error": error})
+            await self._save_checkpoint()
+            logger.error(f"Envío del {self.run_id} interrumpido; vuelve a lanzarlo para continuar")
+            return self.state
+
+        self.state.update({"status": "completed", "finished_at": datetime.now().isoformat()})
+        self.state.pop("error", None)
+        await self._save_checkpoint()
+        logger.info(
+            f"Envío del {self.run_id} terminado: {self.state.get('sent', 0)} enviados "
+            f"(y {self.state.get('already_sent', 0)} antes de reanudar), "
+            f"{self.state.get('skipped', 0)} ya tenían reto, {self.state.get('failed', 0)} fallidos, "
+            f"{self.state.get('outside_window', 0)} fuera de la ventana de 24 h"
+        )
+        return self.state
+
+
+async def main(run_date: Optional[datetime] = None):
+    await whatsapp_client.start()
+    try:
+        return await ChallengeBroadcast(run_date).run()
+    finally:
+        await whatsapp_client.close()
+        database.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(name)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Envía el reto diario a todos los usuarios")
+    parser.add_argument("--date", help="Fecha del envío (YYYY-MM-DD); por defecto hoy")
+    args = parser.parse_args()
+    asyncio.run(main(datetime.strptime(args.date, "%Y-%m-%d") if args.date else None))
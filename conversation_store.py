@@ -0,0 +1,149 @@
+"""
+Almacenamiento del historial de conversación
+Backend en memoria acotado (LRU + expiración por inactividad) o en Firestore,
+para que cualquier instancia pueda continuar cualquier conversación
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from google.cloud import firestore
+
+from database import database
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore:
+    """Interfaz común de los backends de historial"""
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+
+    async def get_history(self, phone_number: str) -> List[Dict[str, str]]:
+        """Devuelve los últimos mensajes de la conversación (lista nueva, segura de modificar)"""
+        raise NotImplementedError("Subclases deben implementar get_history")
+
+    async def append(self, phone_number: str, messages: List[Dict[str, str]]):
+        """Añade mensajes al final, conservando como máximo max_messages"""
+        raise NotImplementedError("Subclases deben implementar append")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.__class__.__name__, "max_messages": self.max_messages}
+
+
+class InMemoryConversationStore(ConversationStore):
+    """Historial en memoria con límite de conversaciones y expiración por inactividad"""
+
+    def __init__(self, max_messages: int, max_conversations: int, idle_seconds: float):
+        super().__init__(max_messages)
+        self.max_conversations = max_conversations
+        self.idle_seconds = idle_seconds
+        # phone_number -> (último acceso, mensajes); orden LRU
+        self._conversations: "OrderedDict[str, tuple]" = OrderedDict()
+        self.evictions = 0
+
+    def _evict(self, now: float):
+        while self._conversations:
+            _, (last_access, _) = next(iter(self._conversations.items()))
+            if len(self._conversations) <= self.max_conversations and now - last_access < self.idle_seconds:
+                break
+            self._conversations.popitem(last=False)
+            self.evictions += 1
+
+    async def get_history(self, phone_number: str) -> List[Dict[str, str]]:
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._conversations.get(phone_number)
+        if entry is None:
+            return []
+        return list(entry[1])
+
+    async def append(self, phone_number: str, messages: List[Dict[str, str]]):
+        now = time.monotonic()
+        entry = self._conversations.pop(phone_number, None)
+        history = entry[1] if entry else []
+        history = (history + list(messages))[-self.max_messages:]
+        self._conversations[phone_number] = (now, history)
+        self._evict(now)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats.update({
+            "conversations": len(self._conversations),
+            "max_conversations": self.max_conversations,
+            "idle_seconds": self.idle_seconds,
+            "evictions": self.evictions
+        })
+        return stats
+
+
+@firestore.transactional
+def _append_turns(transaction, doc_ref, messages: List[Dict[str, str]], max_messages: int):
+    """Lee y reescribe el anillo de turnos dentro de una transacción"""
+    snapshot = doc_ref.get(transaction=transaction)
+    turns = (snapshot.to_dict() or {}).get("turns", []) if snapshot.exists else []
+    turns = (turns + list(messages))[-max_messages:]
+    transaction.set(doc_ref, {"turns": turns, "updated_at": datetime.now()})
+
+
+class FirestoreConversationStore(ConversationStore):
+    """Historial en conversations/{phone} como un anillo acotado de turnos"""
+
+    def __init__(self, max_messages: int, collection: str = "conversations"):
+        super().__init__(max_messages)
+        self.collection = collection
+
+    async def get_history(self, phone_number: str) -> List[Dict[str, str]]:
+        if not database.is_connected():
+            return []
+        try:
+            doc_ref = database.db.collection(self.collection).document(phone_number)
+            doc = await database.run(doc_ref.get)
+            if not doc.exists:
+                return []
+            return list((doc.to_dict() or {}).get("turns", []))[-self.max_messages:]
+        except Exception as e:
+            logger.error(f"Error obteniendo historial de {phone_number}: {str(e)}")
+            return []
+
+    async def append(self, phone_number: str, messages: List[Dict[str, str]]):
+        if not database.is_connected():
+            return
+        try:
+            doc_ref = database.db.collection(self.collection).document(phone_number)
+            await database.run(_append_turns, database.db.transaction(), doc_ref, messages, self.max_messages)
+        except Exception as e:
+            logger.error(f"Error guardando historial de {phone_number}: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["collection"] = self.collection
+        return stats
+
+
+def create_conversation_store(backend: Optional[str] = None) -> ConversationStore:
+    """Crea el backend configurado en CONVERSATION_STORE (memory o firestore)"""
+    backend = (backend or os.getenv("CONVERSATION_STORE", "memory")).lower()
+    max_messages = int(os.getenv("CONVERSATION_MAX_MESSAGES", "20"))
+
+    if backend == "firestore":
+        if database.is_connected():
+            return FirestoreConversationStore(
+                max_messages,
+                collection=os.getenv("CONVERSATION_COLLECTION", "conversations")
+            )
+        logger.warning("Firestore no disponible, usando historial en memoria")
+
+    return InMemoryConversationStore(
+        max_messages,
+        max_conversations=int(os.getenv("CONVERSATION_MAX_USERS", "10000")),
+        idle_seconds=float(os.getenv("CONVERSATION_IDLE_SECONDS", "3600"))
+    )
+
+
+# Instancia global
+conversation_store = create_conversation_store()
@@ -0,0 +1,149 @@
+"""
+Resumen incremental de la conversación
+Cada N turnos condensa los mensajes recientes junto con el resumen anterior en un
+campo conversation_summary del usuario (users/{phone}), que el agente de diálogo
+incluye en su contexto. Se ejecuta en segundo plano, después de enviar la respuesta
+"""
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+from database import database
+from conversation_store import conversation_store
+from agents import Agent, dialogue_agent, get_system_prompt
+from generation_profiles import get_generation_profile
+
+logger = logging.getLogger(__name__)
+
+_SPEAKERS = {"user": "Usuario", "assistant": "Bot"}
+
+
+class ConversationSummarizer:
+    """Cuenta turnos por teléfono y lanza el resumen en segundo plano cada every_turns"""
+
+    def __init__(
+        self,
+        agent: Agent,
+        every_turns: Optional[int] = None,
+        max_words: Optional[int] = None,
+        max_tracked_phones: int = 10000
+    ):
+        self.agent = agent
+        self.every_turns = every_turns if every_turns is not None else int(os.getenv("SUMMARY_EVERY_TURNS", "10"))
+        self.max_words = max_words or int(os.getenv("SUMMARY_MAX_WORDS", "120"))
+        self.max_tracked_phones = max_tracked_phones
+        self.prompt = get_system_prompt(
+            "conversation_summarizer",
+            """Resumes conversaciones entre un usuario y su mentor de retos diarios.
+
+Recibes el resumen anterior (si existe) y los mensajes nuevos. Devuelve un único resumen actualizado que conserve:
+- Datos personales y preferencias que el usuario haya contado
+- Retos comentados, avances, dificultades y compromisos pendientes
+- El tono y el estado de ánimo del usuario
+
+Escribe en tercera persona, sin saludos ni listas largas. Descarta lo que ya no sea relevante."""
+        )
+        self.profile = get_generation_profile("conversation_summarizer")
+        # phone_number -> turnos desde el último resumen (en memoria, orden LRU)
+        self._turns: "OrderedDict[str, int]" = OrderedDict()
+        self._running: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.summaries = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.every_turns > 0
+
+    def after_reply(self, phone_number: str):
+        """Registra un turno ya respondido y, si toca, programa el resumen sin esperarlo"""
+        if not self.enabled:
+            return
+
+        turns = self._turns.pop(phone_number, 0) + 1
+        if turns < self.every_turns or phone_number in self._running:
+            self._turns[phone_number] = turns
+            while len(self._turns) > self.max_tracked_phones:
+                self._turns.popitem(last=False)
+            return
+
+        self._running.add(phone_number)
+        task = asyncio.create_task(self._run(phone_number))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, phone_number: str):
+        try:
+            await self.update_summary(phone_number)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error resumiendo la conversación de {phone_number}: {str(e)}")
+        finally:
+            self._running.discard(phone_number)
+
+    async def update_summary(self, phone_number: str) -> Optional[str]:
+        """Condensa los turnos recientes con el resumen guardado y lo persiste en el usuario"""
+        user = await database.get_user(phone_number)
+        if not user or not user.get("onboarding_completed", False):
+            return None
+
+        history = await conversation_store.get_history(phone_number)
+        recent = history[-2 * self.every_turns:]
+        if not recent:
+            return None
+
+        summary = await self.summarize(user.get("conversation_summary"), recent)
+        if not summary:
+            self.failures += 1
+            return None
+
+        if await database.update_conversation_summary(phone_number, summary):
+            self.summaries += 1
+            logger.info(f"Resumen de conversación actualizado para {phone_number} ({len(recent)} mensajes)")
+        return summary
+
+    async def summarize(self, previous_summary: Optional[str], messages: List[Dict[str, Any]]) -> Optional[str]:
+        """Pide al modelo el resumen actualizado (sin tools ni streaming)"""
+        transcript = "\n".join(
+            f"{_SPEAKERS[m['role']]}: {m.get('content')}"
+            for m in messages if m.get("role") in _SPEAKERS and m.get("content")
+        )
+        request = (
+            f"Resumen anterior:\n{previous_summary or '(ninguno)'}\n\n"
+            f"Mensajes nuevos:\n{transcript}\n\n"
+            f"Devuelve el resumen actualizado en como máximo {self.max_words} palabras."
+        )
+        summary = await self.agent.complete_text([
+            {"role": "system", "content": self.prompt},
+            {"role": "user", "content": request}
+        ], stage="summary", profile=self.profile)
+        if not summary:
+            return None
+        words = summary.split()
+        # Margen sobre el límite pedido: el modelo no siempre lo respeta
+        if len(words) > self.max_words * 2:
+            summary = " ".join(words[:self.max_words * 2]) + "…"
+        return summary.strip()
+
+    async def close(self, timeout: float = 10.0):
+        """Espera a los resúmenes en curso al apagar la instancia"""
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "every_turns": self.every_turns,
+            "tracked_phones": len(self._turns),
+            "running": len(self._running),
+            "summaries": self.summaries,
+            "failures": self.failures,
+        }
+
+
+# Instancia global
+conversation_summarizer = ConversationSummarizer(dialogue_agent)
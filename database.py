@@ -3,10 +3,17 @@ Módulo de base de datos con Firestore
 Gestiona usuarios y sus datos
 """
 import os
+import time
+import asyncio
+import functools
 import logging
-from typing import Optional, Dict, Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, List
 from datetime import datetime
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.api_core.exceptions import NotFound
 from google.oauth2 import service_account
 from google.auth import default as google_auth_default
 import json
@@ -14,11 +21,82 @@ import subprocess
 
 logger = logging.getLogger(__name__)
 
+class UserCache:
+    """Caché LRU con TTL para los documentos users/{phone}"""
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+    
+    def get(self, phone_number: str) -> Optional[Dict[str, Any]]:
+        """Devuelve una copia del usuario cacheado o None si no está o expiró"""
+        entry = self._entries.get(phone_number)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, user_data = entry
+        if expires_at <= time.monotonic():
+            del self._entries[phone_number]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(phone_number)
+        self.hits += 1
+        return dict(user_data)
+    
+    def put(self, phone_number: str, user_data: Dict[str, Any]):
+        if not self.enabled:
+            return
+        self._entries[phone_number] = (time.monotonic() + self.ttl_seconds, dict(user_data))
+        self._entries.move_to_end(phone_number)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def update(self, phone_number: str, fields: Dict[str, Any]):
+        """Aplica una escritura sobre la entrada cacheada, conservando su TTL"""
+        entry = self._entries.get(phone_number)
+        if entry is not None:
+            entry[1].update(fields)
+    
+    def invalidate(self, phone_number: str):
+        self._entries.pop(phone_number, None)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None
+        }
+
 class Database:
     """Cliente de Firestore para gestionar usuarios"""
     
     def __init__(self):
         self.db = None
+        # El cliente de Firestore es síncrono: sus llamadas se ejecutan en un pool
+        # dedicado y acotado para no bloquear el event loop de uvicorn
+        self.max_workers = int(os.getenv("FIRESTORE_MAX_WORKERS", "16"))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="firestore")
+        # Caché de lectura de usuarios; las escrituras de esta clase la mantienen al día.
+        # Con varias instancias, un cambio hecho en otra se ve como máximo tras el TTL
+        self.user_cache = UserCache(
+            max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", "5000")),
+            ttl_seconds=float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+        )
         self._init_firestore()
     
     def _init_firestore(self):
@@ -125,6 +203,27 @@ class Database:
         """Verifica si la base de datos está conectada"""
         return self.db is not None
     
+    async def run(self, func: Callable, *args, **kwargs):
+        """
+        Ejecuta una llamada bloqueante de Firestore en el pool de threads
+        
+        Args:
+            func: Función síncrona del cliente (p.ej. doc_ref.get)
+            
+        Returns:
+            El resultado de la función
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché de usuarios para el endpoint de salud"""
+        return self.user_cache.stats()
+    
+    def close(self):
+        """Libera el pool de threads (llamar al apagar el servidor)"""
+        self._executor.shutdown(wait=False)
+    
     async def get_user(self, phone_number: str) -> Optional[Dict[str, Any]]:
         """
         Obtiene un usuario por número de teléfono
@@ -139,13 +238,18 @@ class Database:
             logger.error("Firestore no está inicializado")
             return None
         
+        cached = self.user_cache.get(phone_number)
+        if cached is not None:
+            return cached
+        
         try:
             doc_ref = self.db.collection("users").document(phone_number)
-            doc = doc_ref.get()
+            doc = await self.run(doc_ref.get)
             
             if doc.exists:
                 user_data = doc.to_dict()
                 user_data["phone_number"] = phone_number
+                self.user_cache.put(phone_number, user_data)
                 return user_data
             return None
             
@@ -181,7 +285,8 @@ class Database:
             }
             
             doc_ref = self.db.collection("users").document(phone_number)
-            doc_ref.set(user_data)
+            await self.run(doc_ref.set, user_data)
+            self.user_cache.put(phone_number, dict(user_data, phone_number=phone_number))
             
             logger.info(f"Usuario creado: {phone_number} - {name}")
             return True
@@ -207,10 +312,12 @@ class Database:
         
         try:
             doc_ref = self.db.collection("users").document(phone_number)
-            doc_ref.update({
+            fields = {
                 "interests": interests,
                 "updated_at": datetime.now()
-            })
+            }
+            await self.run(doc_ref.update, fields)
+            self.user_cache.update(phone_number, fields)
             
             logger.info(f"Intereses actualizados para usuario {phone_number}")
             return True
@@ -235,21 +342,109 @@ class Database:
         
         try:
             doc_ref = self.db.collection("users").document(phone_number)
-            doc_ref.update({
+            fields = {
                 "last_challenge_date": date,
                 "updated_at": datetime.now()
-            })
+            }
+            await self.run(doc_ref.update, fields)
+            self.user_cache.update(phone_number, fields)
             return True
         except Exception as e:
             logger.error(f"Error actualizando fecha de reto: {str(e)}")
             return False
     
-    async def increment_challenges_completed(self, phone_number: str) -> bool:
+    async def list_users_page(
+        self,
+        page_size: int,
+        start_after: Optional[str] = None,
+        fields: Optional[List[str]] = None
+    ) -> List[Dict[str, Any]]:
         """
-        Incrementa el contador de retos completados
+        Página de usuarios con el onboarding completado, en orden de número de teléfono
+        
+        Args:
+            page_size: Máximo de usuarios de la página
+            start_after: Último teléfono de la página anterior (cursor)
+            fields: Campos a descargar (proyección); None descarga el documento entero
+            
+        Returns:
+            Lista de usuarios con phone_number; vacía al terminar o si Firestore no está inicializado
+            
+        Raises:
+            Los errores de Firestore se propagan: quien pagina decide si reintentar o
+            detenerse sin dar el recorrido por terminado
+        """
+        if not self.db:
+            logger.error("Firestore no está inicializado")
+            return []
+        
+        query = (
+            self.db.collection("users")
+            .where(filter=FieldFilter("onboarding_completed", "==", True))
+            .order_by("__name__")
+            .limit(page_size)
+        )
+        if fields:
+            query = query.select(fields)
+        if start_after:
+            query = query.start_after({"__name__": start_after})
+        
+        snapshots = await self.run(query.get)
+        return [dict(snapshot.to_dict() or {}, phone_number=snapshot.id) for snapshot in snapshots]
+    
+    def challenges_collection(self, phone_number: str):
+        """Subcolección users/{phone}/challenges: un documento por reto enviado (id = fecha)"""
+        return self.db.collection("users").document(phone_number).collection("challenges")
+    
+    async def record_challenge_sent(
+        self,
+        phone_number: str,
+        challenge: Dict[str, Any],
+        date: datetime,
+        clear_ready: bool = False
+    ) -> bool:
+        """
+        Registra el reto enviado en users/{phone}/challenges/{fecha}, lo copia en
+        current_challenge y fija last_challenge_date, en un único WriteBatch
+        
+        Args:
+            phone_number: Número de teléfono del usuario
+            challenge: Reto enviado (con date YYYY-MM-DD)
+            date: Fecha del envío
+            clear_ready: Borra ready_challenge (el reto enviado era el pregenerado)
+            
+        Returns:
+            True si se actualizó correctamente
+        """
+        if not self.db:
+            return False
+        
+        try:
+            user_ref = self.db.collection("users").document(phone_number)
+            fields = {
+                "current_challenge": challenge,
+                "last_challenge_date": date,
+                "updated_at": datetime.now()
+            }
+            if clear_ready:
+                fields["ready_challenge"] = firestore.DELETE_FIELD
+            batch = self.db.batch()
+            batch.set(self.challenges_collection(phone_number).document(challenge.get("date") or date.strftime("%Y-%m-%d")), challenge)
+            batch.update(user_ref, fields)
+            await self.run(batch.commit)
+            self.user_cache.invalidate(phone_number)
+            return True
+        except Exception as e:
+            logger.error(f"Error registrando el reto enviado a {phone_number}: {str(e)}")
+            return False
+    
+    async def store_ready_challenge(self, phone_number: str, challenge: Dict[str, Any]) -> bool:
+        """
+        Guarda un reto pregenerado (status "ready") en ready_challenge hasta que se envíe
         
         Args:
             phone_number: Número de teléfono del usuario
+            challenge: Reto con date y status="ready"
             
         Returns:
             True si se actualizó correctamente
@@ -259,19 +454,155 @@ class Database:
         
         try:
             doc_ref = self.db.collection("users").document(phone_number)
-            doc = doc_ref.get()
+            fields = {
+                "ready_challenge": challenge,
+                "updated_at": datetime.now()
+            }
+            await self.run(doc_ref.update, fields)
+            self.user_cache.update(phone_number, fields)
+            return True
+        except Exception as e:
+            logger.error(f"Error guardando el reto pregenerado de {phone_number}: {str(e)}")
+            return False
+    
+    async def update_interest_cluster(self, phone_number: str, cluster_id: str) -> bool:
+        """
+        Guarda el grupo de intereses del usuario (ver interest_clusters.py)
+        
+        Args:
+            phone_number: Número de teléfono del usuario
+            cluster_id: Id del documento en interest_clusters
             
-            if doc.exists:
-                current_count = doc.to_dict().get("challenges_completed", 0)
-                doc_ref.update({
-                    "challenges_completed": current_count + 1,
-                    "updated_at": datetime.now()
-                })
-                return True
+        Returns:
+            True si se actualizó correctamente
+        """
+        if not self.db:
             return False
+        
+        try:
+            doc_ref = self.db.collection("users").document(phone_number)
+            fields = {"interest_cluster": cluster_id}
+            await self.run(doc_ref.update, fields)
+            self.user_cache.update(phone_number, fields)
+            return True
         except Exception as e:
-            logger.error(f"Error incrementando retos completados: {str(e)}")
+            logger.error(f"Error guardando el grupo de intereses de {phone_number}: {str(e)}")
             return False
+    
+    async def commit_batched(
+        self,
+        writes: Optional[List[tuple]] = None,
+        updates: Optional[List[tuple]] = None,
+        deletes: Optional[List[Any]] = None,
+        batch_size: int = 400
+    ) -> int:
+        """
+        Aplica muchas escrituras en WriteBatch de hasta batch_size operaciones
+        (Firestore admite 500 por lote)
+        
+        Args:
+            writes: Lista de (doc_ref, datos) que se reemplazan con set
+            updates: Lista de (doc_ref, campos) que se actualizan con update
+            deletes: Lista de doc_ref a borrar
+            
+        Returns:
+            Número de operaciones aplicadas
+        """
+        if not self.db:
+            return 0
+        
+        operations = (
+            [("set", ref, data) for ref, data in writes or []]
+            + [("update", ref, data) for ref, data in updates or []]
+            + [("delete", ref, None) for ref in deletes or []]
+        )
+        for start in range(0, len(operations), batch_size):
+            batch = self.db.batch()
+            for kind, ref, data in operations[start:start + batch_size]:
+                if kind == "delete":
+                    batch.delete(ref)
+                else:
+                    getattr(batch, kind)(ref, data)
+            await self.run(batch.commit)
+        # Los usuarios reescritos pueden estar en la caché
+        for ref, _ in updates or []:
+            self.user_cache.invalidate(ref.id)
+        return len(operations)
+    
+    async def update_conversation_summary(self, phone_number: str, summary: str) -> bool:
+        """
+        Guarda el resumen incremental de la conversación junto a los intereses
+        
+        Args:
+            phone_number: Número de teléfono del usuario
+            summary: Resumen actualizado
+            
+        Returns:
+            True si se actualizó correctamente, False en caso contrario
+        """
+        if not self.db:
+            logger.error("Firestore no está inicializado")
+            return False
+        
+        try:
+            doc_ref = self.db.collection("users").document(phone_number)
+            fields = {
+                "conversation_summary": summary,
+                "summary_updated_at": datetime.now()
+            }
+            await self.run(doc_ref.update, fields)
+            self.user_cache.update(phone_number, fields)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error guardando el resumen de {phone_number}: {str(e)}")
+            return False
+    
+    async def increment_counter(self, phone_number: str, field: str, amount: int = 1) -> bool:
+        """
+        Incrementa un contador del usuario de forma atómica en el servidor
+        
+        Usa firestore.Increment en una única escritura: sin lectura previa
+        y sin perder incrementos cuando hay actualizaciones concurrentes
+        
+        Args:
+            phone_number: Número de teléfono del usuario
+            field: Nombre del campo numérico
+            amount: Cantidad a sumar
+            
+        Returns:
+            True si se actualizó correctamente, False si el usuario no existe
+        """
+        if not self.db:
+            return False
+        
+        try:
+            doc_ref = self.db.collection("users").document(phone_number)
+            await self.run(doc_ref.update, {
+                field: firestore.Increment(amount),
+                "updated_at": datetime.now()
+            })
+            # El valor final lo calcula el servidor: la próxima lectura lo trae fresco
+            self.user_cache.invalidate(phone_number)
+            return True
+        except NotFound:
+            logger.warning(f"Usuario {phone_number} no existe, no se incrementa {field}")
+            return False
+        except Exception as e:
+            logger.error(f"Error incrementando {field}: {str(e)}")
+            return False
+    
+    async def increment_challenges_completed(self, phone_number: str) -> bool:
+        """
+        Incrementa el contador de retos completados
+        
+        Args:
+            phone_number: Número de teléfono del usuario
+            
+        Returns:
+            True si se actualizó correctamente
+        """
+        return await self.increment_counter(phone_number, "challenges_completed")
 
 # Instancia global
 database = Database()
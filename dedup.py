@@ -0,0 +1,100 @@
+"""
+Deduplicación de mensajes entrantes por message_id de WhatsApp
+Evita que los reintentos de Meta generen respuestas duplicadas
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any
+
+from google.api_core.exceptions import AlreadyExists
+
+from database import database
+
+logger = logging.getLogger(__name__)
+
+
+class MessageDeduplicator:
+    """Conjunto acotado con TTL en memoria, opcionalmente respaldado en Firestore"""
+
+    def __init__(self, ttl_seconds: Optional[int] = None, max_entries: Optional[int] = None):
+        self.ttl_seconds = ttl_seconds or int(os.getenv("DEDUP_TTL_SECONDS", "86400"))
+        self.max_entries = max_entries or int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))
+        self.use_firestore = os.getenv("DEDUP_FIRESTORE", "false").lower() in ("1", "true", "yes")
+        self.collection = os.getenv("DEDUP_COLLECTION", "processed_messages")
+        # message_id -> instante de expiración (orden de inserción = orden de expiración)
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self.checked = 0
+        self.duplicates = 0
+
+    def _purge(self, now: float):
+        while self._seen:
+            _, expires_at = next(iter(self._seen.items()))
+            if expires_at > now and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def _seen_in_memory(self, message_id: str) -> bool:
+        now = time.monotonic()
+        self._purge(now)
+        if message_id in self._seen:
+            return True
+        self._seen[message_id] = now + self.ttl_seconds
+        self._purge(now)
+        return False
+
+    async def _seen_in_firestore(self, message_id: str) -> bool:
+        """Registra el message_id con create(); si ya existe, otra instancia lo procesó"""
+        if not database.is_connected():
+            return False
+        try:
+            doc_ref = database.db.collection(self.collection).document(message_id)
+            await database.run(doc_ref.create, {
+                "processed_at": datetime.now(),
+                # Campo pensado para una política TTL de Firestore
+                "expires_at": datetime.now() + timedelta(seconds=self.ttl_seconds)
+            })
+            return False
+        except AlreadyExists:
+            return True
+        except Exception as e:
+            logger.error(f"Error registrando mensaje {message_id} en Firestore: {str(e)}")
+            return False
+
+    async def is_duplicate(self, message_id: Optional[str]) -> bool:
+        """
+        Marca el mensaje como visto y devuelve si ya se había recibido antes
+
+        Args:
+            message_id: ID del mensaje de WhatsApp (wamid...)
+
+        Returns:
+            True si el mensaje es un duplicado y debe descartarse
+        """
+        if not message_id:
+            return False
+
+        self.checked += 1
+        duplicate = self._seen_in_memory(message_id)
+        if not duplicate and self.use_firestore:
+            duplicate = await self._seen_in_firestore(message_id)
+
+        if duplicate:
+            self.duplicates += 1
+            logger.info(f"Mensaje duplicado descartado: {message_id}")
+        return duplicate
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._seen),
+            "max_entries": self.max_entries,
+            "firestore": self.use_firestore,
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+        }
+
+
+# Instancia global
+message_deduplicator = MessageDeduplicator()
@@ -0,0 +1,124 @@
+"""
+Perfiles de generación por agente
+Límites de tokens, temperatura, presupuesto de razonamiento y thinking que se
+cargan de generation_profiles.json (junto a system_prompts.json) y se aplican
+igual en OpenAI y en Gemini
+"""
+import os
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+_PROFILES_CACHE: Optional[Dict[str, Dict[str, Any]]] = None
+_PROFILES_PATH = Path(os.getenv("GENERATION_PROFILES_FILE", Path(__file__).resolve().parent / "generation_profiles.json"))
+
+# Valores si el archivo no existe o no define "default"
+DEFAULT_PROFILE = {
+    "max_output_tokens": 2048,
+    "temperature": 1.0,
+    "thinking_budget": None,
+    "reasoning_effort": None,
+    "include_thoughts": False,
+}
+
+# Gemini 3 usa niveles en vez de presupuesto: por debajo de este valor se pide "low"
+GEMINI_LOW_THINKING_BUDGET = 8192
+
+
+def _load_profiles() -> Dict[str, Dict[str, Any]]:
+    global _PROFILES_CACHE
+    if _PROFILES_CACHE is not None:
+        return _PROFILES_CACHE
+
+    try:
+        if not _PROFILES_PATH.exists():
+            logger.warning("Archivo de perfiles de generación no encontrado en %s", _PROFILES_PATH)
+            _PROFILES_CACHE = {}
+        else:
+            with _PROFILES_PATH.open("r", encoding="utf-8") as profiles_file:
+                _PROFILES_CACHE = json.load(profiles_file)
+    except Exception as exc:
+        logger.error("Error cargando perfiles de generación: %s", exc)
+        _PROFILES_CACHE = {}
+
+    return _PROFILES_CACHE
+
+
+def _is_openai_reasoning_model(model: str) -> bool:
+    # o1/o3/o4-mini y gpt-5 aceptan reasoning_effort pero no una temperatura distinta de 1
+    return model.startswith(("o1", "o3", "o4", "gpt-5"))
+
+
+class GenerationProfile:
+    """
+    Parámetros de generación de un agente
+
+    Un perfil puede incluir claves "openai" o "gemini" con valores que solo
+    se aplican a ese proveedor
+    """
+
+    def __init__(self, name: str, settings: Dict[str, Any]):
+        self.name = name
+        self.settings = dict(settings)
+
+    def for_provider(self, provider: str) -> Dict[str, Any]:
+        settings = {k: v for k, v in self.settings.items() if k not in ("openai", "gemini")}
+        settings.update(self.settings.get(provider) or {})
+        return settings
+
+    def openai_kwargs(self, model: str) -> Dict[str, Any]:
+        """Argumentos extra para chat.completions.create"""
+        settings = self.for_provider("openai")
+        kwargs: Dict[str, Any] = {}
+        if settings.get("max_output_tokens"):
+            kwargs["max_completion_tokens"] = settings["max_output_tokens"]
+        if _is_openai_reasoning_model(model):
+            if settings.get("reasoning_effort"):
+                kwargs["reasoning_effort"] = settings["reasoning_effort"]
+        elif settings.get("temperature") is not None:
+            kwargs["temperature"] = settings["temperature"]
+        return kwargs
+
+    def gemini_config(self, model: str) -> Dict[str, Any]:
+        """Campos de GenerateContentConfig (thinking_config como dict, lo valida pydantic)"""
+        settings = self.for_provider("gemini")
+        config: Dict[str, Any] = {}
+        if settings.get("max_output_tokens"):
+            config["max_output_tokens"] = settings["max_output_tokens"]
+        if settings.get("temperature") is not None:
+            config["temperature"] = settings["temperature"]
+
+        thinking: Dict[str, Any] = {}
+        budget = settings.get("thinking_budget")
+        if budget is not None:
+            if "gemini-3" in model:
+                thinking["thinking_level"] = "low" if 0 <= budget < GEMINI_LOW_THINKING_BUDGET else "high"
+            else:
+                thinking["thinking_budget"] = budget
+        if settings.get("include_thoughts"):
+            thinking["include_thoughts"] = True
+        if thinking:
+            config["thinking_config"] = thinking
+        return config
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"name": self.name, **self.settings}
+
+
+def get_generation_profile(profile_key: str) -> GenerationProfile:
+    """Perfil de un agente: "default" del archivo con los valores del agente encima"""
+    profiles = _load_profiles()
+    settings = dict(DEFAULT_PROFILE)
+    settings.update(profiles.get("default") or {})
+    if profile_key in profiles:
+        overrides = profiles[profile_key]
+        for provider in ("openai", "gemini"):
+            if provider in overrides and provider in settings:
+                overrides = dict(overrides, **{provider: {**settings[provider], **overrides[provider]}})
+        settings.update(overrides)
+    elif profile_key != "default":
+        logger.info("Perfil de generación '%s' no definido, usando default", profile_key)
+    return GenerationProfile(profile_key, settings)
@@ -0,0 +1,295 @@
+"""
+Agrupación de usuarios por intereses
+Muchos usuarios describen intereses casi iguales ("me gusta el fútbol y la música"):
+se agrupan para generar un único reto por grupo y personalizarlo solo con el nombre.
+
+Los intereses se tokenizan localmente (sin tildes, sin palabras vacías, con una
+reducción simple de plurales) y cada usuario se asigna al grupo cuyo centroide es
+más parecido o, si ninguno llega al umbral, a un grupo nuevo. Los grupos viven en
+interest_clusters/{id} y cada usuario guarda el suyo en interest_cluster; se
+actualizan al registrarse y cada vez que cambian los intereses. La reconstrucción
+completa (python interest_clusters.py) corrige la deriva de los centroides
+"""
+import os
+import math
+import time
+import uuid
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from database import database
+from model_router import normalize_message
+
+logger = logging.getLogger(__name__)
+
+# Palabras que no distinguen intereses
+STOPWORDS = {
+    "a", "al", "algo", "and", "bastante", "como", "con", "cosas", "de", "del", "el", "ella", "en",
+    "encanta", "encantan", "es", "esta", "este", "gusta", "gustan", "i", "la", "las", "le", "lo",
+    "los", "me", "mi", "mis", "mucho", "muy", "o", "otra", "otras", "para", "pero", "por", "que",
+    "sobre", "soy", "su", "sus", "tambien", "the", "todo", "un", "una", "uno", "y", "ya", "yo",
+}
+
+# Tokens que se conservan en cada centroide (acota el tamaño del documento)
+CENTROID_TOKENS = 40
+KEYWORDS = 8
+
+
+def _stem(token: str) -> str:
+    if len(token) > 4 and token.endswith("es"):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def tokenize_interests(text: Optional[str]) -> Dict[str, float]:
+    """Vector disperso normalizado (token -> peso) de un párrafo de intereses"""
+    tokens = [_stem(t) for t in normalize_message(text or "").split() if t not in STOPWORDS and not t.isdigit()]
+    counts = Counter(t for t in tokens if len(t) > 2)
+    norm = math.sqrt(sum(c * c for c in counts.values())) or 1.0
+    return {token: count / norm for token, count in counts.items()}
+
+
+def _cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(token, 0.0) for token, weight in a.items())
+
+
+def _normalize(vector: Dict[str, float]) -> Dict[str, float]:
+    top = dict(sorted(vector.items(), key=lambda item: item[1], reverse=True)[:CENTROID_TOKENS])
+    norm = math.sqrt(sum(w * w for w in top.values())) or 1.0
+    return {token: weight / norm for token, weight in top.items()}
+
+
+def personalize_challenge(challenge: Dict[str, Any], name: Optional[str]) -> Dict[str, Any]:
+    """Sustituye {nombre} en los textos del reto de un grupo (o lo quita si no hay nombre)"""
+    def _fill(value: Any) -> Any:
+        if isinstance(value, str):
+            if not name:
+                value = value.replace(", {nombre}", "").replace("{nombre}, ", "")
+            return value.replace("{nombre}", name or "")
+        if isinstance(value, dict):
+            return {k: _fill(v) for k, v in value.items()}
+        return value
+
+    return {key: _fill(value) for key, value in challenge.items()}
+
+
+class InterestCluster:
+    def __init__(self, cluster_id: str, centroid: Dict[str, float], members: int = 0, sample_interests: str = ""):
+        self.cluster_id = cluster_id
+        self.centroid = centroid
+        self.members = members
+        self.sample_interests = sample_interests
+
+    @property
+    def keywords(self) -> List[str]:
+        return [t for t, _ in sorted(self.centroid.items(), key=lambda item: item[1], reverse=True)[:KEYWORDS]]
+
+    def add(self, vector: Dict[str, float]):
+        """Media incremental del centroide con el vector del nuevo miembro"""
+        merged = {t: w * self.members for t, w in self.centroid.items()}
+        for token, weight in vector.items():
+            merged[token] = merged.get(token, 0.0) + weight
+        self.centroid = _normalize(merged)
+        self.members += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "centroid": self.centroid,
+            "members": self.members,
+            "sample_interests": self.sample_interests,
+            "keywords": self.keywords,
+            "updated_at": datetime.now(),
+        }
+
+
+class InterestClusters:
+    """Índice en memoria de los grupos, cargado de Firestore y actualizado de forma incremental"""
+
+    def __init__(self, collection: str = "interest_clusters"):
+        self.enabled = os.getenv("INTEREST_CLUSTERS", "true").lower() in ("1", "true", "yes")
+        self.threshold = float(os.getenv("INTEREST_CLUSTER_SIMILARITY", "0.6"))
+        self.reload_seconds = float(os.getenv("INTEREST_CLUSTER_RELOAD_SECONDS", "600"))
+        self.collection = collection
+        self.clusters: Dict[str, InterestCluster] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+        self.assignments = 0
+        self.created = 0
+        self.failures = 0
+
+    def _collection(self):
+        return database.db.collection(self.collection) if database.db else None
+
+    async def _load(self):
+        """Recarga los grupos si la copia en memoria es antigua (otras instancias también crean grupos)"""
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.reload_seconds:
+            return
+        self._loaded_at = time.monotonic()
+        collection = self._collection()
+        if collection is None:
+            return
+        snapshots = await database.run(collection.get)
+        self.clusters = {
+            s.id: InterestCluster(s.id, data.get("centroid") or {}, data.get("members", 0), data.get("sample_interests", ""))
+            for s in snapshots for data in [s.to_dict() or {}]
+        }
+
+    def nearest(self, vector: Dict[str, float]) -> tuple:
+        """(grupo más parecido o None, similitud)"""
+        best, best_score = None, 0.0
+        for cluster in self.clusters.values():
+            score = _cosine(vector, cluster.centroid)
+            if score > best_score:
+                best, best_score = cluster, score
+        return best, best_score
+
+    def _place(self, interests: str, previous_cluster: Optional[str]) -> tuple:
+        """Asigna en memoria; devuelve (grupo, grupos modificados)"""
+        vector = tokenize_interests(interests)
+        changed = []
+        previous = self.clusters.get(previous_cluster) if previous_cluster else None
+        cluster, score = self.nearest(vector)
+        if cluster is None or score < self.threshold:
+            cluster = InterestCluster(uuid.uuid4().hex[:12], {}, 0, interests)
+            self.clusters[cluster.cluster_id] = cluster
+            self.created += 1
+        if previous is cluster:
+            return cluster, changed
+        cluster.add(vector)
+        changed.append(cluster)
+        if previous is not None:
+            previous.members = max(previous.members - 1, 0)
+            changed.append(previous)
+        return cluster, changed
+
+    async def assign(self, phone_number: str, interests: str, previous_cluster: Optional[str] = None) -> Optional[str]:
+        """Asigna (o reasigna) un usuario y persiste el grupo y el campo interest_cluster"""
+        if not self.enabled or not interests:
+            return None
+        async with self._lock:
+            await self._load()
+            cluster, changed = self._place(interests, previous_cluster)
+            collection = self._collection()
+            for c in changed:
+                if not c.members:
+                    self.clusters.pop(c.cluster_id, None)
+                if collection is None:
+                    continue
+                if c.members:
+                    await database.run(collection.document(c.cluster_id).set, c.to_dict())
+                else:
+                    await database.run(collection.document(c.cluster_id).delete)
+        if cluster.cluster_id != previous_cluster:
+            await database.update_interest_cluster(phone_number, cluster.cluster_id)
+        self.assignments += 1
+        return cluster.cluster_id
+
+    def after_interests_update(self, phone_number: str, interests: str, previous_cluster: Optional[str] = None):
+        """Reasigna en segundo plano al registrar al usuario o cambiar sus intereses"""
+        if not self.enabled:
+            return
+
+        async def _run():
+            try:
+                await self.assign(phone_number, interests, previous_cluster)
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Error asignando grupo de intereses a {phone_number}: {str(e)}")
+
+        task = asyncio.create_task(_run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def cluster_of(self, user: Dict[str, Any]) -> Optional[InterestCluster]:
+        """Grupo del usuario; lo asigna si aún no tiene uno válido"""
+        if not self.enabled:
+            return None
+        async with self._lock:
+            await self._load()
+        cluster = self.clusters.get(user.get("interest_cluster"))
+        if cluster is None and user.get("interests"):
+            cluster_id = await self.assign(user["phone_number"], user["interests"], user.get("interest_cluster"))
+            user["interest_cluster"] = cluster_id
+            cluster = self.clusters.get(cluster_id)
+        return cluster
+
+    async def rebuild(self, page_size: int = 500) -> Dict[str, Any]:
+        """Recalcula todos los grupos desde cero y reescribe las asignaciones por lotes"""
+        if not database.db:
+            logger.error("Firestore no está inicializado")
+            return {}
+        async with self._lock:
+            old_ids = set(await self._load_ids())
+            self.clusters = {}
+            assignments: Dict[str, str] = {}
+            cursor = None
+            while True:
+                users = await database.list_users_page(page_size, start_after=cursor, fields=["interests"])
+                for user in users:
+                    if user.get("interests"):
+                        cluster, _ = self._place(user["interests"], None)
+                        assignments[user["phone_number"]] = cluster.cluster_id
+                if len(users) < page_size:
+                    break
+                cursor = users[-1]["phone_number"]
+
+            collection = self._collection()
+            writes = [(collection.document(c.cluster_id), c.to_dict()) for c in self.clusters.values()]
+            deletes = [collection.document(cluster_id) for cluster_id in old_ids - set(self.clusters)]
+            users = database.db.collection("users")
+            updates = [(users.document(phone), {"interest_cluster": cluster_id}) for phone, cluster_id in assignments.items()]
+            await database.commit_batched(writes=writes, updates=updates, deletes=deletes)
+            self._loaded_at = time.monotonic()
+
+        logger.info(f"Grupos de intereses reconstruidos: {len(assignments)} usuarios en {len(self.clusters)} grupos")
+        return {"users": len(assignments), "clusters": len(self.clusters), "removed": len(old_ids - set(self.clusters))}
+
+    async def _load_ids(self) -> List[str]:
+        collection = self._collection()
+        if collection is None:
+            return []
+        return [s.id for s in await database.run(collection.select([]).get)]
+
+    async def close(self, timeout: float = 10.0):
+        """Espera a las asignaciones en curso al apagar la instancia"""
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        members = sum(c.members for c in self.clusters.values())
+        return {
+            "enabled": self.enabled,
+            "clusters": len(self.clusters),
+            "members": members,
+            "avg_cluster_size": round(members / len(self.clusters), 2) if self.clusters else 0.0,
+            "assignments": self.assignments,
+            "created": self.created,
+            "failures": self.failures,
+        }
+
+
+# Instancia global
+interest_clusters = InterestClusters()
+
+
+async def main():
+    try:
+        return await interest_clusters.rebuild(int(os.getenv("BROADCAST_PAGE_SIZE", "500")))
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(name)s - %(message)s")
+    print(asyncio.run(main()))
@@ -17,6 +17,17 @@ from openai import AsyncOpenAI
 from whatsapp_client import whatsapp_client
 from database import database
 from agents import onboarding_agent, dialogue_agent
+from message_queue import message_queue
+from dedup import message_deduplicator
+from request_context import RequestContext
+from conversation_store import conversation_store
+from phone_mailbox import phone_mailbox
+from streaming import StreamedReply, streaming_enabled, streaming_stats
+from conversation_summary import conversation_summarizer
+from interest_clusters import interest_clusters
+from model_router import model_router
+from response_cache import response_cache
+from outbound_dispatcher import outbound_dispatcher
 
 # Cargar variables de entorno
 load_dotenv()
@@ -81,7 +92,6 @@ class MetaWebhookPayload(BaseModel):
 class BotState:
     def __init__(self):
         self.is_connected = False
-        self.active_conversations = {}
 
 bot_state = BotState()
 
@@ -101,7 +111,22 @@ async def health_check():
     return {
         "status": "healthy",
         "connected": bot_state.is_connected,
-        "database_connected": database.is_connected()
+        "database_connected": database.is_connected(),
+        "message_queue": message_queue.stats(),
+        "dedup": message_deduplicator.stats(),
+        "user_cache": database.get_cache_stats(),
+        "conversations": conversation_store.stats(),
+        "conversation_summaries": conversation_summarizer.stats(),
+        "interest_clusters": interest_clusters.stats(),
+        "phone_mailbox": phone_mailbox.stats(),
+        "outbound": outbound_dispatcher.stats(),
+        "streaming": streaming_stats(),
+        "model_router": model_router.stats(),
+        "response_cache": response_cache.stats(),
+        "agents": {
+            "onboarding": onboarding_agent.stats(),
+            "dialogue": dialogue_agent.stats()
+        }
     }
 
 @app.get("/webhook/whatsapp")
@@ -192,6 +217,10 @@ async def receive_whatsapp_webhook(
                             message_id = message.get("id")
                             message_type = message.get("type")
                             
+                            # Descartar reintentos de Meta antes de tocar agentes o base de datos
+                            if await message_deduplicator.is_duplicate(message_id):
+                                continue
+                            
                             # Solo procesar mensajes de texto
                             if message_type == "text":
                                 message_text = message.get("text", {}).get("body", "")
@@ -200,24 +229,18 @@ async def receive_whatsapp_webhook(
                                 logger.info(f"Mensaje recibido de {from_number}: {message_text}")
                                 print(f"[WEBHOOK] Mensaje recibido de {from_number}: {message_text}", flush=True)
                                 
-                                # Generar respuesta con IA
-                                ai_client = init_openai_client()
-                                if not ai_client:
-                                    response_text = "Lo siento, el servicio de IA no está configurado."
-                                else:
-                                    response_text = await generate_ai_response(message_text, from_number)
-                                
-                                # Enviar respuesta automáticamente a WhatsApp
-                                if response_text:
-                                    await whatsapp_client.send_message(from_number, response_text)
-                                    logger.info(f"Respuesta enviada a {from_number}")
+                                # Un solo trabajo a la vez por usuario (y ráfagas agrupadas si está activo):
+                                # si ya hay uno activo, el mensaje queda en su buzón sin ocupar otro worker
+                                if not phone_mailbox.post(from_number, message_text):
+                                    await dispatch_job(phone_mailbox.drain, from_number, process_text_message)
                             
                             # Manejar otros tipos de mensajes (imágenes, audio, etc.)
                             elif message_type in ["image", "audio", "video", "document"]:
                                 logger.info(f"Mensaje de tipo {message_type} recibido, no procesado")
                                 # Opcional: enviar mensaje de que solo se procesan textos
                                 from_number = message.get("from", "")
-                                await whatsapp_client.send_message(
+                                await dispatch_job(
+                                    outbound_dispatcher.send,
                                     from_number,
                                     "Por ahora solo puedo procesar mensajes de texto. Por favor envía tu mensaje en texto."
                                 )
@@ -232,7 +255,43 @@ async def receive_whatsapp_webhook(
         # Aún así responder 200 para que Meta no reintente constantemente
         return {"status": "error", "message": str(e)}
 
-async def generate_ai_response(user_message: str, phone_number: str) -> str:
+async def dispatch_job(handler, *args):
+    """
+    Ejecuta un trabajo del webhook
+    En modo asíncrono (WEBHOOK_ASYNC_PROCESSING) lo encola y retorna de inmediato;
+    si el modo está desactivado o la cola está llena, lo procesa en línea
+    """
+    if message_queue.enabled and message_queue.enqueue(handler, *args):
+        return
+    await handler(*args)
+
+async def process_text_message(from_number: str, message_text: str):
+    """Genera la respuesta con IA para un mensaje de texto y la envía por WhatsApp"""
+    # En modo streaming los fragmentos se envían mientras el modelo genera
+    reply = None
+    if streaming_enabled():
+        reply = StreamedReply(lambda chunk: outbound_dispatcher.send(from_number, chunk))
+    
+    # Generar respuesta con IA
+    ai_client = init_openai_client()
+    if not ai_client:
+        response_text = "Lo siento, el servicio de IA no está configurado."
+    else:
+        response_text = await generate_ai_response(message_text, from_number, reply=reply)
+    
+    # Enviar lo que no se haya transmitido ya
+    if response_text and reply:
+        response_text = reply.unsent_part(response_text)
+    if response_text:
+        await outbound_dispatcher.send(from_number, response_text)
+        logger.info(f"Respuesta enviada a {from_number}")
+    if reply:
+        reply.record_completion()
+    
+    # Fuera del camino crítico: el usuario ya tiene su respuesta
+    conversation_summarizer.after_reply(from_number)
+
+async def generate_ai_response(user_message: str, phone_number: str, reply: Optional[StreamedReply] = None) -> str:
     """
     Genera una respuesta usando los agentes de IA
     Decide qué agente usar según si el usuario está registrado o no
@@ -240,10 +299,11 @@ async def generate_ai_response(user_message: str, phone_number: str) -> str:
     print(f"[PROCESS] Generando respuesta para {phone_number}: {user_message}", flush=True)
     try:
         # Obtener contexto de la conversación si existe
-        conversation_history = bot_state.active_conversations.get(phone_number, [])
+        conversation_history = await conversation_store.get_history(phone_number)
         
-        # Verificar si el usuario existe en la base de datos
-        user = await database.get_user(phone_number)
+        # Cargar el usuario una sola vez para todo el mensaje
+        context = await RequestContext.load(phone_number, conversation_history)
+        context.reply = reply
         
         # Verificar que los agentes estén inicializados
         print(f"[DEBUG] Estado agentes - Onboarding: {onboarding_agent.client is not None}, Diálogo: {dialogue_agent.client is not None}", flush=True)
@@ -262,14 +322,15 @@ async def generate_ai_response(user_message: str, phone_number: str) -> str:
             logger.error(f"OPENAI_API_KEY disponible en runtime: {bool(api_key_check)}, primeros chars: {api_key_check[:10] if api_key_check else 'None'}...")
         
         # Si el usuario no existe o no ha completado el onboarding, usar agente de onboarding
-        if not user or not user.get("onboarding_completed", False):
+        if not context.onboarding_completed:
             logger.info(f"Usuario {phone_number} no registrado o en onboarding, usando agente de onboarding")
             logger.debug(f"Cliente onboarding disponible: {onboarding_agent.client is not None}")
             try:
                 response_text = await onboarding_agent.process_message(
                     user_message, 
                     phone_number, 
-                    conversation_history
+                    conversation_history,
+                    context=context
                 )
             except Exception as e:
                 logger.error(f"Error en onboarding_agent.process_message: {str(e)}")
@@ -277,9 +338,8 @@ async def generate_ai_response(user_message: str, phone_number: str) -> str:
                 logger.error(traceback.format_exc())
                 raise
             
-            # Verificar si el usuario acaba de completar el onboarding
-            user_after = await database.get_user(phone_number)
-            if user_after and user_after.get("onboarding_completed", False):
+            # Verificar si el usuario acaba de completar el onboarding (register_user actualiza el contexto)
+            if context.onboarding_completed:
                 logger.info(f"Usuario {phone_number} completó el onboarding")
                 # Opcional: mensaje de bienvenida al sistema de retos
                 response_text += "\n\n¡Bienvenido al sistema de retos diarios! A partir de ahora recibirás retos personalizados basados en tus intereses."
@@ -291,7 +351,8 @@ async def generate_ai_response(user_message: str, phone_number: str) -> str:
                 response_text = await dialogue_agent.process_message(
                     user_message,
                     phone_number,
-                    conversation_history
+                    conversation_history,
+                    context=context
                 )
             except Exception as e:
                 logger.error(f"Error en dialogue_agent.process_message: {str(e)}")
@@ -299,22 +360,11 @@ async def generate_ai_response(user_message: str, phone_number: str) -> str:
                 logger.error(traceback.format_exc())
                 raise
         
-        # Guardar en historial
-        if phone_number not in bot_state.active_conversations:
-            bot_state.active_conversations[phone_number] = []
-        
-        bot_state.active_conversations[phone_number].append({
-            "role": "user",
-            "content": user_message
-        })
-        bot_state.active_conversations[phone_number].append({
-            "role": "assistant",
-            "content": response_text
-        })
-        
-        # Limitar historial a 20 mensajes (más que antes porque los agentes necesitan más contexto)
-        if len(bot_state.active_conversations[phone_number]) > 20:
-            bot_state.active_conversations[phone_number] = bot_state.active_conversations[phone_number][-20:]
+        # Guardar en historial (el store limita a CONVERSATION_MAX_MESSAGES, 20 por defecto)
+        await conversation_store.append(phone_number, [
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": response_text}
+        ])
         
         return response_text
     
@@ -335,7 +385,7 @@ async def send_whatsapp_message(to: str, message: str):
     try:
         logger.info(f"Enviando mensaje a {to}: {message}")
         
-        success = await whatsapp_client.send_message(to, message)
+        success = await outbound_dispatcher.send(to, message)
         
         if success:
             return {
@@ -360,6 +410,10 @@ async def startup_event():
         logger.info(f"OpenAI API Key presente: {'Sí' if openai_api_key else 'No'}")
         logger.info(f"WhatsApp provider: {os.getenv('WHATSAPP_PROVIDER', 'meta')}")
         logger.info(f"Firestore conectado: {'Sí' if database.is_connected() else 'No'}")
+        await whatsapp_client.start()
+        if message_queue.enabled:
+            await message_queue.start()
+        logger.info(f"Procesamiento asíncrono de webhooks: {'Sí' if message_queue.enabled else 'No'}")
         bot_state.is_connected = True
         logger.info("✅ Servidor listo para recibir mensajes")
         logger.info("=" * 60)
@@ -371,6 +425,11 @@ async def startup_event():
 async def shutdown_event():
     """Limpieza al apagar el servidor"""
     logger.info("Cerrando servidor...")
+    await message_queue.stop()
+    await conversation_summarizer.close()
+    await interest_clusters.close()
+    await whatsapp_client.close()
+    database.close()
     bot_state.is_connected = False
 
 if __name__ == "__main__":
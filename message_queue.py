@@ -0,0 +1,119 @@
+"""
+Cola de trabajos en memoria para procesar mensajes fuera del webhook
+Permite responder 200 a Meta inmediatamente y generar la respuesta en segundo plano
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class MessageJob:
+    """Trabajo encolado: una corrutina a ejecutar con sus argumentos"""
+
+    def __init__(self, handler: Callable[..., Awaitable[Any]], *args: Any):
+        self.handler = handler
+        self.args = args
+        self.enqueued_at = time.perf_counter()
+
+
+class MessageQueue:
+    """Cola asyncio con un pool de workers configurable"""
+
+    def __init__(self, workers: Optional[int] = None, maxsize: Optional[int] = None):
+        self.enabled = os.getenv("WEBHOOK_ASYNC_PROCESSING", "false").lower() in ("1", "true", "yes")
+        self.worker_count = workers or int(os.getenv("WEBHOOK_WORKERS", "8"))
+        self.maxsize = maxsize if maxsize is not None else int(os.getenv("WEBHOOK_QUEUE_MAXSIZE", "1000"))
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+        self.wait_latency = LatencyHistogram()
+        self.job_latency = LatencyHistogram()
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    async def start(self):
+        """Arranca los workers (llamar desde el evento startup de FastAPI)"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._workers = [
+            asyncio.create_task(self._worker(index), name=f"message-worker-{index}")
+            for index in range(self.worker_count)
+        ]
+        logger.info(f"Cola de mensajes iniciada con {self.worker_count} workers (máximo {self.maxsize} trabajos)")
+
+    async def stop(self, timeout: float = 10.0):
+        """Espera a que se vacíe la cola y detiene los workers"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Cerrando cola con {self._queue.qsize()} trabajos pendientes")
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Cola de mensajes detenida")
+
+    def enqueue(self, handler: Callable[..., Awaitable[Any]], *args: Any) -> bool:
+        """
+        Encola un trabajo sin esperar a que se procese
+
+        Returns:
+            True si se encoló, False si la cola no está activa o está llena
+        """
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait(MessageJob(handler, *args))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning("Cola de mensajes llena, el trabajo se procesará en línea")
+            return False
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            started_at = time.perf_counter()
+            self.wait_latency.observe(started_at - job.enqueued_at)
+            try:
+                await job.handler(*job.args)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error en worker {index} procesando trabajo: {str(e)}")
+            finally:
+                self.job_latency.observe(time.perf_counter() - job.enqueued_at)
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        """Estado de la cola para el endpoint de salud"""
+        return {
+            "enabled": self.enabled,
+            "workers": len(self._workers),
+            "depth": self._queue.qsize() if self._queue else 0,
+            "maxsize": self.maxsize,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_latency": self.wait_latency.snapshot(),
+            "job_latency": self.job_latency.snapshot(),
+        }
+
+
+# Instancia global
+message_queue = MessageQueue()
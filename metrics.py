@@ -0,0 +1,83 @@
+"""
+Métricas simples en memoria
+Histogramas de latencia y contadores que se exponen en /health
+"""
+from collections import deque
+from typing import Dict, Any, Optional, Sequence
+
+# Límites de los buckets en milisegundos
+DEFAULT_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class LatencyHistogram:
+    """Histograma de latencias con buckets fijos y percentiles sobre una ventana reciente"""
+
+    def __init__(self, buckets_ms: Sequence[float] = DEFAULT_BUCKETS_MS, window: int = 1000):
+        self.buckets_ms = tuple(buckets_ms)
+        self.bucket_counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        """Registra una latencia expresada en segundos"""
+        value_ms = seconds * 1000
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+        self._recent.append(value_ms)
+
+        for index, limit in enumerate(self.buckets_ms):
+            if value_ms <= limit:
+                self.bucket_counts[index] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Percentil aproximado sobre las últimas muestras"""
+        if not self._recent:
+            return None
+        ordered = sorted(self._recent)
+        index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        buckets = {f"le_{limit}ms": count for limit, count in zip(self.buckets_ms, self.bucket_counts)}
+        buckets["le_inf"] = self.bucket_counts[-1]
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "p50_ms": round(p50, 1) if p50 is not None else None,
+            "p95_ms": round(p95, 1) if p95 is not None else None,
+            "max_ms": round(self.max_ms, 1),
+            "buckets": buckets,
+        }
+
+
+
+class TokenUsage:
+    """Acumula tokens de entrada, salida y cacheados de las completions"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, prompt_tokens: Optional[int], cached_tokens: Optional[int], completion_tokens: Optional[int]):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens or 0
+        self.cached_tokens += cached_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else None,
+        }
@@ -0,0 +1,157 @@
+"""
+Migración de challenges_sent a la subcolección users/{phone}/challenges
+Recorre todos los usuarios por páginas y, para cada uno con el array antiguo:
+- escribe cada reto en users/{phone}/challenges/{fecha}
+- copia el último reto enviado en current_challenge
+- mueve un reto pregenerado pendiente a ready_challenge
+- borra challenges_sent del documento del usuario
+Las escrituras se agrupan en WriteBatch y el cursor se guarda tras cada página, así
+que se puede interrumpir y volver a lanzar (los documentos se sobrescriben igual)
+
+Uso:
+    python migrate_challenges.py [--page-size 200] [--dry-run]
+"""
+import asyncio
+import argparse
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from google.cloud import firestore
+
+from database import database
+from challenge_broadcast import BroadcastCheckpoint, create_checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+def _challenge_id(challenge: Dict[str, Any], index: int, used: set) -> str:
+    """Id del documento: la fecha del reto o, en retos antiguos sin fecha, la de envío"""
+    challenge_id = challenge.get("date")
+    if not isinstance(challenge_id, str):
+        sent_at = challenge.get("sent_at") or challenge.get("date")
+        challenge_id = sent_at.strftime("%Y-%m-%d") if isinstance(sent_at, datetime) else f"legacy-{index:04d}"
+    if challenge_id in used:
+        challenge_id = f"{challenge_id}-{index:04d}"
+    used.add(challenge_id)
+    return challenge_id
+
+
+def plan_user(user: Dict[str, Any]) -> tuple:
+    """
+    Operaciones de un usuario: ([(id, reto), ...] para la subcolección, campos del usuario)
+    """
+    challenges = [c for c in user.get("challenges_sent") or [] if isinstance(c, dict)]
+    sent = [c for c in challenges if c.get("status") != "ready"]
+    pending = [c for c in challenges if c.get("status") == "ready"]
+
+    used: set = set()
+    documents = [(_challenge_id(c, i, used), c) for i, c in enumerate(sent)]
+    fields: Dict[str, Any] = {"challenges_sent": firestore.DELETE_FIELD}
+    if sent and not user.get("current_challenge"):
+        fields["current_challenge"] = sent[-1]
+    if pending and not user.get("ready_challenge"):
+        fields["ready_challenge"] = pending[-1]
+    return documents, fields
+
+
+class ChallengesMigration:
+    """Migración por páginas con checkpoint del último teléfono procesado"""
+
+    def __init__(
+        self,
+        page_size: int = 200,
+        dry_run: bool = False,
+        checkpoint: Optional[BroadcastCheckpoint] = None
+    ):
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.checkpoint = checkpoint or create_checkpoint("migrate-challenges")
+        self.state: Dict[str, Any] = {}
+
+    def _count(self, counter: str, amount: int = 1):
+        self.state[counter] = self.state.get(counter, 0) + amount
+
+    async def _page(self, start_after: Optional[str]) -> List[Dict[str, Any]]:
+        # Todos los usuarios, también los que no terminaron el onboarding
+        query = (
+            database.db.collection("users")
+            .order_by("__name__")
+            .select(["challenges_sent", "current_challenge", "ready_challenge"])
+            .limit(self.page_size)
+        )
+        if start_after:
+            query = query.start_after({"__name__": start_after})
+        snapshots = await database.run(query.get)
+        return [dict(snapshot.to_dict() or {}, phone_number=snapshot.id) for snapshot in snapshots]
+
+    async def migrate_page(self, users: List[Dict[str, Any]]):
+        writes, updates = [], []
+        users_ref = database.db.collection("users")
+        for user in users:
+            if "challenges_sent" not in user:
+                continue
+            documents, fields = plan_user(user)
+            challenges = database.challenges_collection(user["phone_number"])
+            writes.extend((challenges.document(challenge_id), challenge) for challenge_id, challenge in documents)
+            updates.append((users_ref.document(user["phone_number"]), fields))
+            self._count("users_migrated")
+            self._count("challenges_moved", len(documents))
+
+        if writes or updates:
+            if self.dry_run:
+                logger.info(f"[dry-run] {len(updates)} usuarios y {len(writes)} retos en esta página")
+            else:
+                # Los retos van antes que el borrado del array: si se corta, no se pierde nada
+                await database.commit_batched(writes=writes)
+                await database.commit_batched(updates=updates)
+
+    async def run(self) -> Dict[str, Any]:
+        if not database.db:
+            logger.error("Firestore no está inicializado")
+            return {}
+
+        self.state = {} if self.dry_run else await self.checkpoint.load()
+        if self.state.get("status") == "completed":
+            logger.info("La migración ya se completó")
+            return self.state
+        self.state["status"] = "running"
+
+        cursor = self.state.get("cursor")
+        while True:
+            users = await self._page(cursor)
+            if not users:
+                break
+            await self.migrate_page(users)
+            cursor = users[-1]["phone_number"]
+            self.state["cursor"] = cursor
+            self._count("users_scanned", len(users))
+            if not self.dry_run:
+                await self.checkpoint.save(self.state)
+            if len(users) < self.page_size:
+                break
+
+        self.state.update({"status": "completed", "finished_at": datetime.now().isoformat()})
+        if not self.dry_run:
+            await self.checkpoint.save(self.state)
+        logger.info(
+            f"Migración terminada: {self.state.get('users_migrated', 0)} usuarios y "
+            f"{self.state.get('challenges_moved', 0)} retos de {self.state.get('users_scanned', 0)} revisados"
+        )
+        return self.state
+
+
+async def main(page_size: int, dry_run: bool):
+    try:
+        return await ChallengesMigration(page_size, dry_run).run()
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(name)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Mueve challenges_sent a la subcolección users/{phone}/challenges")
+    parser.add_argument("--page-size", type=int, default=200, help="Usuarios por página (y por checkpoint)")
+    parser.add_argument("--dry-run", action="store_true", help="Solo cuenta lo que se migraría")
+    args = parser.parse_args()
+    asyncio.run(main(args.page_size, args.dry_run))
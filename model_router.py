@@ -0,0 +1,121 @@
+"""
+Enrutado de mensajes por coste
+Clasifica cada mensaje con heurísticas locales (sin llamar a ningún modelo):
+agradecimientos y despedidas reciben una respuesta predefinida, los acuses
+cortos ("ok", "vale", un emoji) van a un modelo rápido y el resto al modelo
+principal del agente
+"""
+import os
+import re
+import random
+import unicodedata
+from typing import Dict, Any, Optional
+
+from metrics import LatencyHistogram
+
+ROUTE_CANNED = "canned"
+ROUTE_FAST = "fast"
+ROUTE_FULL = "full"
+
+# Categorías con respuesta predefinida: texto normalizado -> categoría
+_CANNED_MESSAGES = {
+    "gracias": "thanks",
+    "muchas gracias": "thanks",
+    "mil gracias": "thanks",
+    "gracias a ti": "thanks",
+    "ok gracias": "thanks",
+    "vale gracias": "thanks",
+    "perfecto gracias": "thanks",
+    "genial gracias": "thanks",
+    "thanks": "thanks",
+    "thank you": "thanks",
+    "adios": "farewell",
+    "chao": "farewell",
+    "hasta luego": "farewell",
+    "hasta manana": "farewell",
+    "buenas noches": "farewell",
+    "nos vemos": "farewell",
+}
+
+CANNED_REPLIES = {
+    "thanks": [
+        "¡A ti! Aquí sigo si quieres darle otra vuelta al reto.",
+        "¡De nada! 💡 Cuando quieras seguimos pensando juntos.",
+    ],
+    "farewell": [
+        "¡Hasta pronto! Mañana llega tu próximo reto.",
+        "¡Nos vemos! Sigue entrenando la mente. 🧠",
+    ],
+}
+
+# Acuses y saludos cortos que no necesitan el modelo grande
+_ACKNOWLEDGEMENTS = {
+    "ok", "okay", "oki", "vale", "va", "dale", "si", "sip", "claro", "genial",
+    "perfecto", "listo", "entendido", "de acuerdo", "bien", "muy bien", "super",
+    "guay", "jaja", "jeje", "hola", "buenas", "buenos dias", "buenas tardes",
+    "ok perfecto", "vale perfecto", "ok genial", "vale genial",
+}
+
+_LAUGH = re.compile(r"^(ja|je|ji|ha)+$")
+_REPEATED = re.compile(r"(.)\1{2,}")
+
+
+def normalize_message(text: str) -> str:
+    """Minúsculas, sin tildes, emojis ni signos y sin letras repetidas ("graciaaas" -> "gracias")"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    text = _REPEATED.sub(r"\1", text)
+    return " ".join(text.split())
+
+
+class ModelRouter:
+    """Decide, por mensaje, entre respuesta predefinida, modelo rápido o modelo completo"""
+
+    def __init__(self):
+        self.enabled = os.getenv("MODEL_ROUTER", "true").lower() in ("1", "true", "yes")
+        self.canned_enabled = os.getenv("MODEL_ROUTER_CANNED_REPLIES", "true").lower() in ("1", "true", "yes")
+        self.fast_models = {
+            "openai": os.getenv("FAST_OPENAI_MODEL", "gpt-4o-mini"),
+            "gemini": os.getenv("FAST_GEMINI_MODEL", "gemini-2.5-flash"),
+        }
+        # agente -> ruta -> número de mensajes
+        self.decisions: Dict[str, Dict[str, int]] = {}
+        self.latency = {route: LatencyHistogram() for route in (ROUTE_CANNED, ROUTE_FAST, ROUTE_FULL)}
+
+    def classify(self, message: str, allow_canned: bool = True) -> tuple:
+        """Devuelve (ruta, categoría de la respuesta predefinida o None)"""
+        if not self.enabled:
+            return ROUTE_FULL, None
+
+        normalized = normalize_message(message)
+        if allow_canned and self.canned_enabled and normalized in _CANNED_MESSAGES:
+            return ROUTE_CANNED, _CANNED_MESSAGES[normalized]
+
+        # Solo emojis o signos, risas y acuses cortos
+        if not normalized or _LAUGH.match(normalized.replace(" ", "")) or normalized in _ACKNOWLEDGEMENTS:
+            return ROUTE_FAST, None
+        return ROUTE_FULL, None
+
+    def fast_model(self, provider: str) -> Optional[str]:
+        return self.fast_models.get(provider) or None
+
+    def canned_reply(self, category: str) -> str:
+        return random.choice(CANNED_REPLIES[category])
+
+    def record(self, agent_name: str, route: str, seconds: float):
+        counts = self.decisions.setdefault(agent_name, {ROUTE_CANNED: 0, ROUTE_FAST: 0, ROUTE_FULL: 0})
+        counts[route] += 1
+        self.latency[route].observe(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "fast_models": self.fast_models,
+            "decisions": self.decisions,
+            "latency": {route: histogram.snapshot() for route, histogram in self.latency.items()},
+        }
+
+
+# Instancia global
+model_router = ModelRouter()
@@ -0,0 +1,184 @@
+"""
+Envío de mensajes salientes con control de ritmo y reintentos
+Un token bucket global ajustado al throughput del número de WhatsApp, un ritmo
+mínimo por destinatario (que además conserva el orden de sus mensajes) y
+reintentos con backoff exponencial con jitter que respetan Retry-After
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from metrics import LatencyHistogram
+from whatsapp_client import whatsapp_client, SendResult, WhatsAppClient
+
+logger = logging.getLogger(__name__)
+
+# Mensajes por segundo que admite la Cloud API según el throughput del número
+THROUGHPUT_TIERS = {
+    "standard": 80,
+    "high": 1000,
+}
+
+
+class TokenBucket:
+    """Limitador de ritmo; los que esperan se atienden en orden de llegada"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds: float):
+        """Detiene todos los envíos (p.ej. tras un 429 de throughput de Meta)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self) -> float:
+        """Espera a tener un token; devuelve los segundos esperados"""
+        started_at = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return time.monotonic() - started_at
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _Recipient:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.last_sent_at = 0.0
+        self.refs = 0
+
+
+class OutboundDispatcher:
+    """Envía por WhatsApp con límite global, ritmo por destinatario y reintentos"""
+
+    def __init__(self, client: WhatsAppClient):
+        self.client = client
+        tier = os.getenv("WHATSAPP_THROUGHPUT_TIER", "standard").lower()
+        rate = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "0")) or THROUGHPUT_TIERS.get(tier, THROUGHPUT_TIERS["standard"])
+        self.bucket = TokenBucket(rate, capacity=float(os.getenv("OUTBOUND_BURST", str(rate))))
+        self.recipient_interval = float(os.getenv("OUTBOUND_RECIPIENT_INTERVAL_SECONDS", "0.5"))
+        self.max_attempts = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+        self.backoff_base = float(os.getenv("OUTBOUND_BACKOFF_BASE_SECONDS", "0.5"))
+        self.backoff_max = float(os.getenv("OUTBOUND_BACKOFF_MAX_SECONDS", "30"))
+        self._recipients: Dict[str, _Recipient] = {}
+
+        self.send_latency = LatencyHistogram()
+        self.throttle_wait = LatencyHistogram()
+        self.sent = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        self.outside_window = 0
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Full jitter: uniforme entre 0 y el backoff exponencial
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def send(self, to: str, message: str) -> bool:
+        """
+        Envía un mensaje y espera a su resultado final
+
+        Los mensajes al mismo destinatario salen de uno en uno y en orden, con
+        al menos recipient_interval entre ellos; un fallo transitorio se reintenta
+        hasta max_attempts y, si no se consigue, el mensaje se cuenta como descartado
+        """
+        result = await self.send_result(to, message)
+        return result.ok
+
+    async def send_result(self, to: str, message: str) -> SendResult:
+        """Como send, pero devuelve el resultado del último intento (p.ej. para ver outside_window)"""
+        return await self._deliver(to, lambda: self.client.send_once(to, message))
+
+    async def send_template(self, to: str, template: str, parameters: List[str], language: Optional[str] = None) -> SendResult:
+        """Envía una plantilla aprobada con el mismo ritmo y reintentos que send"""
+        return await self._deliver(to, lambda: self.client.send_template(to, template, parameters, language))
+
+    async def _deliver(self, to: str, attempt_send: Callable[[], Awaitable[SendResult]]) -> SendResult:
+        recipient = self._recipients.get(to)
+        if recipient is None:
+            recipient = self._recipients[to] = _Recipient()
+        recipient.refs += 1
+        started_at = time.perf_counter()
+        try:
+            async with recipient.lock:
+                for attempt in range(self.max_attempts):
+                    gap = recipient.last_sent_at + self.recipient_interval - time.monotonic()
+                    if gap > 0:
+                        await asyncio.sleep(gap)
+                    self.throttle_wait.observe(await self.bucket.acquire())
+
+                    result = await attempt_send()
+                    recipient.last_sent_at = time.monotonic()
+                    if result.ok:
+                        self.sent += 1
+                        self.send_latency.observe(time.perf_counter() - started_at)
+                        return result
+                    if not result.retryable or attempt == self.max_attempts - 1:
+                        break
+
+                    delay = self._backoff(attempt, result.retry_after)
+                    if result.rate_limited:
+                        self.rate_limited += 1
+                        self.bucket.pause(delay)
+                    self.retries += 1
+                    logger.warning(
+                        f"Reintentando envío a {to} en {delay:.1f}s "
+                        f"(intento {attempt + 1}/{self.max_attempts}, status {result.status}, código {result.error_code})"
+                    )
+                    await asyncio.sleep(delay)
+
+                if result.outside_window:
+                    # El usuario no ha escrito en 24 h: el texto libre no llega, hace falta una plantilla
+                    self.outside_window += 1
+                    logger.warning(f"Mensaje a {to} rechazado: fuera de la ventana de 24 h ({result.error_code})")
+                    return result
+                self.dropped += 1
+                logger.error(f"Mensaje a {to} descartado tras {attempt + 1} intento(s): {result.error}")
+                return result
+        finally:
+            recipient.refs -= 1
+            if recipient.refs == 0:
+                # Se conserva el último envío durante el intervalo para espaciar el siguiente mensaje
+                asyncio.get_running_loop().call_later(self.recipient_interval, self._release, to, recipient)
+
+    def _release(self, to: str, recipient: _Recipient):
+        if recipient.refs == 0 and self._recipients.get(to) is recipient:
+            del self._recipients[to]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate_per_second": self.bucket.rate,
+            "recipient_interval_seconds": self.recipient_interval,
+            "active_recipients": len(self._recipients),
+            "sent": self.sent,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "dropped": self.dropped,
+            "outside_window": self.outside_window,
+            "send_latency": self.send_latency.snapshot(),
+            "throttle_wait": self.throttle_wait.snapshot(),
+        }
+
+
+# Instancia global
+outbound_dispatcher = OutboundDispatcher(whatsapp_client)
@@ -0,0 +1,100 @@
+"""
+Serialización de mensajes por número de teléfono
+Los mensajes de un mismo usuario se procesan de uno en uno, por un único trabajo
+a la vez, para que el historial no se intercale; opcionalmente las ráfagas se
+agrupan en un solo turno del agente
+"""
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Mailbox:
+    def __init__(self):
+        self.pending: List[str] = []
+
+
+class PhoneMailbox:
+    """Buzón por teléfono: un único trabajo activo por usuario vacía sus mensajes en orden"""
+
+    def __init__(self, coalesce_window_ms: Optional[float] = None):
+        window_ms = coalesce_window_ms if coalesce_window_ms is not None else float(os.getenv("MESSAGE_COALESCE_WINDOW_MS", "0"))
+        self.coalesce_window = window_ms / 1000
+        self._boxes: Dict[str, _Mailbox] = {}
+        self.turns = 0
+        self.coalesced = 0
+        self.absorbed = 0
+
+    @property
+    def coalescing(self) -> bool:
+        return self.coalesce_window > 0
+
+    def post(self, phone_number: str, message_text: str) -> bool:
+        """
+        Deja un mensaje en el buzón del teléfono
+
+        Devuelve True si ya hay un trabajo activo para ese teléfono (que lo procesará
+        en orden) y False si el llamador debe lanzar drain; así una ráfaga de un
+        usuario ocupa un solo worker de la cola en vez de uno por mensaje
+        """
+        box = self._boxes.get(phone_number)
+        if box is not None:
+            box.pending.append(message_text)
+            self.absorbed += 1
+            return True
+        box = self._boxes[phone_number] = _Mailbox()
+        box.pending.append(message_text)
+        return False
+
+    async def drain(
+        self,
+        phone_number: str,
+        handler: Callable[[str, str], Awaitable[Any]]
+    ):
+        """
+        Procesa con handler(phone_number, texto) los mensajes del buzón hasta vaciarlo
+
+        Sin agrupación, un turno por mensaje; con agrupación, cada turno espera la
+        ventana configurada y procesa juntos todos los mensajes acumulados
+        """
+        box = self._boxes.get(phone_number)
+        if box is None:
+            return
+        try:
+            # Entre la comprobación de pending y el borrado del buzón no hay await:
+            # un post concurrente o entra en este bucle o crea un buzón nuevo
+            while box.pending:
+                if self.coalescing:
+                    await asyncio.sleep(self.coalesce_window)
+                    messages, box.pending = box.pending, []
+                else:
+                    messages = [box.pending.pop(0)]
+
+                if len(messages) > 1:
+                    logger.info(f"Agrupando {len(messages)} mensajes de {phone_number} en un solo turno")
+                    self.coalesced += len(messages) - 1
+                self.turns += 1
+                try:
+                    await handler(phone_number, "\n".join(messages))
+                except Exception as e:
+                    # Un fallo no debe perder los mensajes que siguen en el buzón
+                    logger.error(f"Error procesando mensaje de {phone_number}: {str(e)}")
+        finally:
+            if self._boxes.get(phone_number) is box:
+                del self._boxes[phone_number]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "coalesce_window_ms": self.coalesce_window * 1000,
+            "active_phones": len(self._boxes),
+            "turns": self.turns,
+            "coalesced_messages": self.coalesced,
+            "absorbed_messages": self.absorbed,
+        }
+
+
+# Instancia global
+phone_mailbox = PhoneMailbox()
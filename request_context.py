@@ -0,0 +1,52 @@
+"""
+Contexto por mensaje entrante
+Carga el usuario una sola vez y lo comparten main, agentes y tools
+"""
+from typing import Optional, Dict, Any, List
+
+from database import database
+from streaming import StreamedReply
+
+
+class RequestContext:
+    """Estado de un mensaje entrante: teléfono, snapshot del usuario e historial"""
+
+    def __init__(
+        self,
+        phone_number: str,
+        user: Optional[Dict[str, Any]] = None,
+        conversation_history: Optional[List[Dict[str, str]]] = None
+    ):
+        self.phone_number = phone_number
+        self.user = user
+        self.conversation_history = conversation_history or []
+        # Si está presente, los agentes transmiten la respuesta por fragmentos
+        self.reply: Optional[StreamedReply] = None
+        # Modelo elegido por el router para este mensaje (None: el del agente)
+        self.model: Optional[str] = None
+        # Tools ejecutadas y si la respuesta es un mensaje de error (no se cachean)
+        self.tool_calls = 0
+        self.failed = False
+
+    @classmethod
+    async def load(
+        cls,
+        phone_number: str,
+        conversation_history: Optional[List[Dict[str, str]]] = None
+    ) -> "RequestContext":
+        """Crea el contexto leyendo el usuario de Firestore una única vez"""
+        user = await database.get_user(phone_number)
+        return cls(phone_number, user, conversation_history)
+
+    @property
+    def onboarding_completed(self) -> bool:
+        return bool(self.user and self.user.get("onboarding_completed", False))
+
+    def set_user(self, user: Dict[str, Any]):
+        """Reemplaza el snapshot tras crear el usuario"""
+        self.user = dict(user, phone_number=self.phone_number)
+
+    def update_user(self, **fields: Any):
+        """Aplica en el snapshot los cambios ya escritos en Firestore"""
+        if self.user is not None:
+            self.user.update(fields)
@@ -0,0 +1,230 @@
+"""
+Caché de respuestas del modelo
+Reutiliza la respuesta a preguntas repetidas ("¿qué es esto?", "¿cómo funciona?")
+cuando coinciden el agente, el mensaje normalizado y la huella del punto de la
+conversación (último mensaje del asistente y contexto del usuario). Solo se guardan
+respuestas que no pueden llevar datos de un usuario concreto (ver shareable).
+Búsqueda exacta y, opcionalmente, por similitud con embeddings locales
+"""
+import os
+import re
+import math
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from model_router import normalize_message
+
+try:
+    from sentence_transformers import SentenceTransformer
+    HAS_SENTENCE_TRANSFORMERS = True
+except ImportError:
+    HAS_SENTENCE_TRANSFORMERS = False
+
+logger = logging.getLogger(__name__)
+
+NGRAM_DIMENSIONS = 512
+
+
+def _ngram_embedding(text: str) -> List[float]:
+    """Vector normalizado de trigramas de caracteres (hashing trick), sin dependencias"""
+    vector = [0.0] * NGRAM_DIMENSIONS
+    padded = f"  {text} "
+    for i in range(len(padded) - 2):
+        digest = hashlib.blake2b(padded[i:i + 3].encode("utf-8"), digest_size=4).digest()
+        vector[int.from_bytes(digest, "little") % NGRAM_DIMENSIONS] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    # Los vectores llegan normalizados: el producto escalar es el coseno
+    return sum(x * y for x, y in zip(a, b))
+
+
+class _CacheEntry:
+    def __init__(self, response: str, tokens: int, expires_at: float, embedding: Optional[List[float]]):
+        self.response = response
+        self.tokens = tokens
+        self.expires_at = expires_at
+        self.embedding = embedding
+
+
+class ResponseCache:
+    """LRU con TTL; las entradas se agrupan por (agente, huella) para la búsqueda por similitud"""
+
+    def __init__(self):
+        self.enabled = os.getenv("RESPONSE_CACHE", "true").lower() in ("1", "true", "yes")
+        self.max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+        self.ttl = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+        self.max_words = int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "12"))
+        self.similarity_threshold = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.9"))
+        self.embeddings = os.getenv("RESPONSE_CACHE_EMBEDDINGS", "none").lower()
+        self._encoder = None
+        if self.embeddings == "sentence-transformers":
+            if HAS_SENTENCE_TRANSFORMERS:
+                self._encoder = SentenceTransformer(os.getenv(
+                    "RESPONSE_CACHE_EMBEDDING_MODEL", "paraphrase-multilingual-MiniLM-L12-v2"
+                ))
+            else:
+                logger.warning("sentence-transformers no instalado; la caché de respuestas usa trigramas")
+                self.embeddings = "ngram"
+
+        # (agente, huella, mensaje normalizado) -> entrada; orden LRU
+        self._entries: "OrderedDict[tuple, _CacheEntry]" = OrderedDict()
+        self.lookups = 0
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.unshared = 0
+        self.tokens_saved = 0
+
+    def fingerprint(
+        self,
+        normalized_message: str,
+        conversation_history: List[Dict[str, Any]],
+        context_message: Optional[str]
+    ) -> str:
+        """
+        Huella del último mensaje del asistente y del contexto dinámico del usuario
+
+        Los intercambios finales con la misma pregunta no cuentan: repetirla
+        sigue apuntando a la misma entrada
+        """
+        history = list(conversation_history)
+        while (
+            len(history) >= 2
+            and history[-1].get("role") == "assistant"
+            and history[-2].get("role") == "user"
+            and normalize_message(str(history[-2].get("content") or "")) == normalized_message
+        ):
+            history = history[:-2]
+        last_assistant = next((m for m in reversed(history) if m.get("role") == "assistant"), None)
+        digest = hashlib.sha1(normalize_message(str((last_assistant or {}).get("content") or "")).encode("utf-8"))
+        digest.update(b"\n")
+        digest.update((context_message or "").encode("utf-8"))
+        return digest.hexdigest()
+
+    def key(
+        self,
+        agent_name: str,
+        user_message: str,
+        conversation_history: List[Dict[str, Any]],
+        context_message: Optional[str]
+    ) -> Optional[tuple]:
+        """Clave de caché, o None si el mensaje no es cacheable (demasiado largo o vacío)"""
+        if not self.enabled:
+            return None
+        normalized = normalize_message(user_message)
+        if not normalized or len(normalized.split()) > self.max_words:
+            self.bypassed += 1
+            return None
+        return (agent_name, self.fingerprint(normalized, conversation_history, context_message), normalized)
+
+    def shareable(
+        self,
+        response: str,
+        conversation_history: List[Dict[str, Any]],
+        profile_values: List[str]
+    ) -> bool:
+        """
+        Si la respuesta se puede guardar: el historial no tiene mensajes del usuario
+        (nada suyo que el modelo pueda repetir) o la respuesta no contiene ningún
+        dato de su perfil. Sin perfil conocido, solo el primer caso
+        """
+        if not any(m.get("role") == "user" for m in conversation_history):
+            return True
+        values = [normalize_message(str(v)) for v in profile_values if v]
+        values = [v for v in values if len(v) > 2]
+        if not values:
+            self.unshared += 1
+            return False
+        text = normalize_message(response)
+        if any(re.search(rf"\b{re.escape(v)}\b", text) for v in values):
+            self.unshared += 1
+            return False
+        return True
+
+    def bypass(self):
+        """Cuenta un mensaje que no se consulta porque podría necesitar una tool"""
+        self.bypassed += 1
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        if self.embeddings == "ngram":
+            return _ngram_embedding(text)
+        if self._encoder is not None:
+            vector = await asyncio.to_thread(self._encoder.encode, text, normalize_embeddings=True)
+            return [float(v) for v in vector]
+        return None
+
+    def _evict(self, now: float):
+        while self._entries:
+            _, oldest = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and oldest.expires_at > now:
+                break
+            self._entries.popitem(last=False)
+
+    async def lookup(self, key: tuple) -> Optional[str]:
+        """Respuesta cacheada para la clave (exacta o, si está activo, la más parecida)"""
+        self.lookups += 1
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at > now:
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            self.tokens_saved += entry.tokens
+            return entry.response
+
+        if self.embeddings == "none":
+            return None
+
+        embedding = await self._embed(key[2])
+        best_key, best_score = None, self.similarity_threshold
+        for candidate_key, candidate in self._entries.items():
+            if candidate_key[:2] != key[:2] or candidate.expires_at <= now or candidate.embedding is None:
+                continue
+            score = _cosine(embedding, candidate.embedding)
+            if score >= best_score:
+                best_key, best_score = candidate_key, score
+        if best_key is None:
+            return None
+
+        entry = self._entries[best_key]
+        self._entries.move_to_end(best_key)
+        self.similar_hits += 1
+        self.tokens_saved += entry.tokens
+        logger.debug(f"Respuesta cacheada por similitud ({best_score:.2f}): {key[2]!r} ~ {best_key[2]!r}")
+        return entry.response
+
+    async def store(self, key: tuple, response: str, tokens: int):
+        """Guarda una respuesta generada sin tools; tokens es la estimación de lo que costó"""
+        now = time.monotonic()
+        embedding = await self._embed(key[2]) if self.embeddings != "none" else None
+        self._entries[key] = _CacheEntry(response, tokens, now + self.ttl, embedding)
+        self._entries.move_to_end(key)
+        self.stores += 1
+        self._evict(now)
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.similar_hits
+        return {
+            "enabled": self.enabled,
+            "embeddings": self.embeddings,
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "hit_rate": round(hits / self.lookups, 3) if self.lookups else 0.0,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "unshared": self.unshared,
+            "estimated_tokens_saved": self.tokens_saved,
+        }
+
+
+# Instancia global
+response_cache = ResponseCache()
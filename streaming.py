@@ -0,0 +1,128 @@
+"""
+Entrega en streaming de las respuestas del modelo
+Corta el texto en párrafos o frases y lo envía por WhatsApp a medida que llega
+"""
+import os
+import re
+import time
+from typing import Awaitable, Callable, Dict, Any, List, Optional
+
+from metrics import LatencyHistogram
+
+_SENTENCE_END = re.compile(r"[.!?…][\"')\]]*\s")
+
+# Latencias medidas desde que empieza la generación
+first_chunk_latency = LatencyHistogram()
+full_reply_latency = LatencyHistogram()
+
+
+def streaming_enabled() -> bool:
+    return os.getenv("STREAMING_RESPONSES", "false").lower() in ("1", "true", "yes")
+
+
+class ChunkSplitter:
+    """
+    Acumula deltas de texto y devuelve fragmentos listos para enviar
+
+    Corta en el último salto de párrafo una vez superado min_chars; si el buffer
+    crece más allá de max_chars sin párrafo, corta en el último fin de frase
+    """
+
+    def __init__(self, min_chars: Optional[int] = None, max_chars: Optional[int] = None):
+        self.min_chars = min_chars or int(os.getenv("STREAMING_MIN_CHUNK_CHARS", "80"))
+        self.max_chars = max_chars or int(os.getenv("STREAMING_MAX_CHUNK_CHARS", "500"))
+        self._buffer = ""
+
+    def _find_cut(self) -> Optional[int]:
+        paragraph = self._buffer.rfind("\n\n")
+        if paragraph >= self.min_chars:
+            return paragraph + 2
+
+        if len(self._buffer) < self.max_chars:
+            return None
+
+        sentence_ends = [m.end() for m in _SENTENCE_END.finditer(self._buffer) if m.end() >= self.min_chars]
+        if sentence_ends:
+            return sentence_ends[-1]
+        space = self._buffer.rfind(" ", self.min_chars, self.max_chars)
+        return space + 1 if space != -1 else self.max_chars
+
+    def feed(self, delta: str) -> List[str]:
+        self._buffer += delta
+        chunks = []
+        cut = self._find_cut()
+        while cut is not None:
+            chunk = self._buffer[:cut].strip()
+            self._buffer = self._buffer[cut:].lstrip()
+            if chunk:
+                chunks.append(chunk)
+            cut = self._find_cut()
+        return chunks
+
+    def flush(self) -> Optional[str]:
+        remaining = self._buffer.strip()
+        self._buffer = ""
+        return remaining or None
+
+
+class StreamedReply:
+    """Respuesta en curso: recibe deltas del modelo y envía cada fragmento completo"""
+
+    def __init__(self, send: Callable[[str], Awaitable[Any]], splitter: Optional[ChunkSplitter] = None):
+        self._send = send
+        self.splitter = splitter or ChunkSplitter()
+        # Texto de la última completion transmitida (una respuesta con tools hace varias)
+        self.text = ""
+        self.chunks_sent = 0
+        self.started_at = time.perf_counter()
+        self._completion_done = False
+
+    async def _deliver(self, chunk: str):
+        if self.chunks_sent == 0:
+            first_chunk_latency.observe(time.perf_counter() - self.started_at)
+        self.chunks_sent += 1
+        await self._send(chunk)
+
+    async def on_delta(self, delta: str):
+        """Añade texto generado por el modelo y envía los fragmentos ya completos"""
+        if not delta:
+            return
+        if self._completion_done:
+            self.text = ""
+            self._completion_done = False
+        self.text += delta
+        for chunk in self.splitter.feed(delta):
+            await self._deliver(chunk)
+
+    async def finish(self):
+        """Envía lo que quede en el buffer al terminar una completion"""
+        self._completion_done = True
+        remaining = self.splitter.flush()
+        if remaining:
+            await self._deliver(remaining)
+
+    def unsent_part(self, response_text: str) -> Optional[str]:
+        """
+        Parte de la respuesta final que aún no se envió
+
+        Si no se transmitió nada se devuelve la respuesta completa; si la respuesta
+        extiende el texto transmitido (p.ej. el mensaje de bienvenida) solo el sufijo
+        """
+        if not self.chunks_sent:
+            return response_text
+        if response_text.startswith(self.text):
+            return response_text[len(self.text):].strip() or None
+        if response_text.strip() == self.text.strip():
+            return None
+        return response_text
+
+    def record_completion(self):
+        full_reply_latency.observe(time.perf_counter() - self.started_at)
+
+
+def streaming_stats() -> Dict[str, Any]:
+    return {
+        "enabled": streaming_enabled(),
+        "first_chunk_latency": first_chunk_latency.snapshot(),
+        "full_reply_latency": full_reply_latency.snapshot(),
+    }
@@ -0,0 +1,165 @@
+"""
+Prueba de la pregeneración de retos por lotes
+Ejecuta ChallengeBatchJob con FileChallengeBatch (respuestas del modelo simuladas)
+y una base de datos en memoria, y comprueba:
+- una petición por grupo de intereses y una por usuario sin grupo
+- retos envueltos en ```json, personalizados con el nombre y guardados como "ready"
+- respuestas inválidas y usuarios sin petición en el lote contados aparte
+- al reanudar con el batch_id del checkpoint no se envía otro lote
+No necesita OpenAI ni Firestore
+"""
+import asyncio
+import json
+import tempfile
+from datetime import datetime
+
+from database import database
+from agents import challenge_creator_agent
+from challenge_batch import ChallengeBatchJob, FileChallengeBatch
+from challenge_broadcast import FileBroadcastCheckpoint
+from interest_clusters import InterestClusters
+
+RUN_DATE = datetime(2025, 2, 1)
+CHALLENGE_DATE = "2025-02-01"
+
+
+class InMemoryUsers:
+    """Sustituye las operaciones de usuario de Database que usa el lote"""
+
+    def __init__(self):
+        self.users = {}
+        self.ready = {}
+
+    def add(self, phone_number, **fields):
+        self.users[phone_number] = fields
+
+    async def list_users_page(self, page_size, start_after=None, fields=None):
+        phones = sorted(p for p in self.users if start_after is None or p > start_after)[:page_size]
+        return [dict(self.users[p], phone_number=p) for p in phones]
+
+    async def store_ready_challenge(self, phone_number, challenge):
+        self.ready[phone_number] = challenge
+        self.users[phone_number]["ready_challenge"] = challenge
+        return True
+
+    async def update_interest_cluster(self, phone_number, cluster_id):
+        self.users[phone_number]["interest_cluster"] = cluster_id
+        return True
+
+
+class FakeModel:
+    """Responde a cada petición del lote; las de usuarios sin grupo reciben texto sin JSON"""
+
+    def __init__(self):
+        self.requests = 0
+
+    async def respond(self, messages):
+        self.requests += 1
+        prompt = messages[-1]["content"]
+        if "historia" in prompt:
+            return "Aquí tienes:\n```json\n" + json.dumps({
+                "question": "{nombre}, ¿en qué año cayó el Imperio romano de Occidente?",
+                "options": {"A": "476", "B": "1492", "C": "1066"},
+                "correct": "A"
+            }, ensure_ascii=False) + "\n```"
+        if "fútbol" in prompt or "futbol" in prompt:
+            return json.dumps({
+                "question": "¿Cuántos jugadores tiene un equipo de fútbol en el campo?",
+                "options": {"A": "9", "B": "11", "C": "12"},
+                "correct": "B"
+            })
+        return "Lo siento, no puedo generar el reto."
+
+
+class CountingBackend(FileChallengeBatch):
+    """FileChallengeBatch que cuenta los lotes enviados"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = 0
+
+    async def submit(self, requests):
+        self.submitted += 1
+        return await super().submit(requests)
+
+
+def check(condition: bool, description: str, errors: list):
+    print(f"   {'✅' if condition else '❌'} {description}")
+    if not condition:
+        errors.append(description)
+
+
+def new_job(directory: str, backend, clusters) -> ChallengeBatchJob:
+    checkpoint = FileBroadcastCheckpoint(f"batch-{CHALLENGE_DATE}", directory)
+    return ChallengeBatchJob(RUN_DATE, page_size=3, poll_interval=0, max_wait=0,
+                             checkpoint=checkpoint, backend=backend, clusters=clusters)
+
+
+async def run_batch_test():
+    print("=" * 60)
+    print("🧪 Pregeneración de retos por lotes")
+    print("=" * 60)
+
+    db = InMemoryUsers()
+    for method in ("list_users_page", "store_ready_challenge", "update_interest_cluster"):
+        setattr(database, method, getattr(db, method))
+
+    for i in range(4):
+        db.add(f"+3460000010{i}", name=f"Historia{i}", interests="historia antigua, imperios y arqueología")
+    for i in range(3):
+        db.add(f"+3460000020{i}", name=f"Futbol{i}", interests="el fútbol, los partidos y los futbolistas")
+    db.add("+34600000300", name="SinIntereses", interests="")
+    db.add("+34600000400", name="YaEnviado", interests="historia antigua", last_challenge_date=RUN_DATE)
+
+    errors = []
+    directory = tempfile.mkdtemp()
+    model = FakeModel()
+    clusters = InterestClusters()
+    clusters.enabled = True
+    backend = CountingBackend(challenge_creator_agent, directory, model.respond)
+
+    state = await new_job(directory, backend, clusters).run()
+    check(state.get("status") == "completed", f"lote completado ({state.get('status')})", errors)
+    check(state.get("users") == 8, f"8 usuarios necesitan reto; el que ya lo recibió no ({state.get('users')})", errors)
+    check(state.get("requested") == 3, f"3 peticiones: 2 grupos y 1 usuario sin intereses ({state.get('requested')})", errors)
+    check(model.requests == 3, f"el modelo responde una vez por petición ({model.requests})", errors)
+    check(state.get("ready") == 7 and len(db.ready) == 7, f"7 retos listos ({state.get('ready')})", errors)
+    check(state.get("invalid") == 1, f"la respuesta sin JSON cuenta como inválida ({state.get('invalid')})", errors)
+
+    history = db.ready.get("+34600000101") or {}
+    check(history.get("question", "").startswith("Historia1, ¿en qué año"), "reto de ```json personalizado con el nombre", errors)
+    check(history.get("status") == "ready" and history.get("date") == CHALLENGE_DATE, "guardado como ready para la fecha", errors)
+    check(db.ready.get("+34600000201", {}).get("options", {}).get("B") == "11", "los miembros del otro grupo comparten su reto", errors)
+    check("+34600000300" not in db.ready and "+34600000400" not in db.ready, "sin reto para el inválido ni el ya enviado", errors)
+
+    # Reanudación: el checkpoint ya tiene un batch_id enviado antes de un corte
+    directory = tempfile.mkdtemp()
+    model = FakeModel()
+    backend = CountingBackend(challenge_creator_agent, directory, model.respond)
+    for phone in list(db.users):
+        db.users[phone].pop("ready_challenge", None)
+    db.ready.clear()
+    history_cluster = db.users["+34600000100"]["interest_cluster"]
+    batch_id = await backend.submit([new_job(directory, backend, clusters)._request(
+        f"cluster:{history_cluster}", "Reto para el grupo: historia antigua"
+    )])
+    await FileBroadcastCheckpoint(f"batch-{CHALLENGE_DATE}", directory).save({
+        "batch_id": batch_id, "status": "submitted", "submitted_at": "2025-01-31T22:00:00"
+    })
+    backend.submitted = 0
+
+    state = await new_job(directory, backend, clusters).run()
+    check(backend.submitted == 0, "al reanudar no se envía otro lote", errors)
+    check(state.get("batch_id") == batch_id and state.get("status") == "completed", "se completa el lote del checkpoint", errors)
+    check(state.get("ready") == 4, f"4 retos del grupo de historia ({state.get('ready')})", errors)
+    check(state.get("missing") == 4, f"4 usuarios sin petición en el lote ({state.get('missing')})", errors)
+    check(db.ready.get("+34600000100", {}).get("generated_at") == "2025-01-31T22:00:00", "generated_at es el del envío del lote", errors)
+
+    if errors:
+        print(f"❌ {len(errors)} comprobaciones fallidas")
+        raise SystemExit(1)
+    print("✅ El lote genera, valida, personaliza y reanuda los retos")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_batch_test())
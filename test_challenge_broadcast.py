@@ -0,0 +1,130 @@
+"""
+Prueba de corte y reanudación del envío diario
+Lanza ChallengeBroadcast con un FileBroadcastCheckpoint, lo cancela a mitad de
+envío (con páginas a medias) y lo vuelve a lanzar. Comprueba que nadie recibe
+el reto dos veces, que todos lo reciben y que los contadores finales cuadran:
+enviados + ya enviados antes de reanudar = mensajes enviados.
+No necesita OpenAI, Firestore ni WhatsApp: base de datos y envíos en memoria
+"""
+import asyncio
+import random
+import tempfile
+from datetime import datetime
+
+from database import database
+from challenge_broadcast import ChallengeBroadcast, FileBroadcastCheckpoint
+from interest_clusters import interest_clusters
+from whatsapp_client import SendResult
+
+USERS = 120
+PAGE_SIZE = 10
+CRASH_AFTER = 47
+
+
+class InMemoryUsers:
+    """Sustituye las operaciones de usuario de Database que usa el envío"""
+
+    def __init__(self, run_date: datetime):
+        self.users = {f"+3460000{i:04d}": {"name": f"usuario{i}", "interests": "historia"} for i in range(USERS)}
+        # Algunos ya recibieron el reto hoy antes del envío (p.ej. a mano)
+        for phone in list(self.users)[::15]:
+            self.users[phone]["last_challenge_date"] = run_date
+
+    async def list_users_page(self, page_size, start_after=None, fields=None):
+        await asyncio.sleep(random.uniform(0, 0.002))
+        phones = sorted(p for p in self.users if start_after is None or p > start_after)[:page_size]
+        return [dict(self.users[p], phone_number=p) for p in phones]
+
+    async def record_challenge_sent(self, phone_number, challenge, date, clear_ready=False):
+        await asyncio.sleep(random.uniform(0, 0.002))
+        self.users[phone_number]["last_challenge_date"] = date
+        return True
+
+
+class FakeCreator:
+    async def generate_challenge(self, user, date=None):
+        await asyncio.sleep(random.uniform(0, 0.003))
+        return {"question": "¿Cuánto es 2 + 2?", "options": {"A": "3", "B": "4", "C": "5"}}
+
+
+class FakeDispatcher:
+    """Registra los envíos y, al llegar a crash_after, cancela la ejecución en curso"""
+
+    def __init__(self):
+        self.sent = []
+        self.crash_after = None
+        self.run_task = None
+
+    async def send_result(self, to, message):
+        await asyncio.sleep(random.uniform(0, 0.003))
+        if self.crash_after is not None and len(self.sent) >= self.crash_after:
+            self.run_task.cancel()
+            await asyncio.sleep(1)
+        self.sent.append(to)
+        return SendResult(True, status=200)
+
+
+def check(condition: bool, description: str, errors: list):
+    print(f"   {'✅' if condition else '❌'} {description}")
+    if not condition:
+        errors.append(description)
+
+
+async def run_resume_test():
+    print("=" * 60)
+    print(f"🧪 Corte y reanudación del envío diario: {USERS} usuarios, corte tras {CRASH_AFTER} envíos")
+    print("=" * 60)
+
+    run_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    db = InMemoryUsers(run_date)
+    for method in ("list_users_page", "record_challenge_sent"):
+        setattr(database, method, getattr(db, method))
+    interest_clusters.enabled = False
+    pre_sent = sum(1 for user in db.users.values() if user.get("last_challenge_date"))
+
+    errors = []
+    checkpoint = FileBroadcastCheckpoint(run_date.strftime("%Y-%m-%d"), tempfile.mkdtemp())
+    dispatcher = FakeDispatcher()
+
+    def broadcast() -> ChallengeBroadcast:
+        return ChallengeBroadcast(run_date, page_size=PAGE_SIZE, concurrency=8, checkpoint=checkpoint,
+                                  dispatcher=dispatcher, creator=FakeCreator())
+
+    dispatcher.crash_after = CRASH_AFTER
+    dispatcher.run_task = asyncio.create_task(broadcast().run())
+    try:
+        await dispatcher.run_task
+    except asyncio.CancelledError:
+        pass
+    saved = await checkpoint.load()
+    print(f"   Corte: {len(dispatcher.sent)} enviados, cursor {saved.get('cursor')}, estado {saved.get('status')}")
+    check(saved.get("status") == "running", "la ejecución cortada queda a medias en el checkpoint", errors)
+
+    dispatcher.crash_after = None
+    state = await broadcast().run()
+    print(f"   Final: {state}")
+
+    expected = USERS - pre_sent
+    check(len(dispatcher.sent) == len(set(dispatcher.sent)), "nadie recibe el reto dos veces", errors)
+    check(len(dispatcher.sent) == expected, f"todos los pendientes lo reciben ({len(dispatcher.sent)}/{expected})", errors)
+    check(state.get("status") == "completed", "la reanudación completa el envío", errors)
+    check(
+        state.get("sent", 0) + state.get("already_sent", 0) == expected,
+        f"enviados + ya enviados antes de reanudar = {expected} "
+        f"({state.get('sent', 0)} + {state.get('already_sent', 0)})",
+        errors
+    )
+    check(state.get("skipped") == pre_sent, f"solo los que ya tenían reto antes del envío se saltan ({state.get('skipped')})", errors)
+    check(not state.get("failed"), "sin fallos", errors)
+
+    again = await broadcast().run()
+    check(again.get("status") == "completed" and len(dispatcher.sent) == expected, "una ejecución completada no reenvía", errors)
+
+    if errors:
+        print(f"❌ {len(errors)} comprobaciones fallidas")
+        raise SystemExit(1)
+    print("✅ El envío se reanuda sin duplicados y con los contadores correctos")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_resume_test())
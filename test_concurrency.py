@@ -0,0 +1,135 @@
+"""
+Prueba de estrés de concurrencia de los agentes
+Lanza cientos de conversaciones simuladas intercaladas contra las instancias
+globales de los agentes y verifica que ninguna tool escribe en el teléfono
+equivocado ni ve el perfil de otro usuario.
+No necesita OpenAI ni Firestore: usa un cliente LLM y una base de datos en memoria
+"""
+import asyncio
+import json
+import os
+import random
+import re
+from types import SimpleNamespace
+
+from database import database
+from agents import onboarding_agent, dialogue_agent
+
+CONVERSATIONS = int(os.getenv("STRESS_CONVERSATIONS", "300"))
+TURNS_PER_CONVERSATION = int(os.getenv("STRESS_TURNS", "3"))
+
+
+class InMemoryUsers:
+    """Sustituye las operaciones de usuario de Database durante la prueba"""
+
+    def __init__(self):
+        self.users = {}
+        self.writes = []
+
+    async def _latency(self):
+        await asyncio.sleep(random.uniform(0, 0.005))
+
+    async def get_user(self, phone_number):
+        await self._latency()
+        user = self.users.get(phone_number)
+        return dict(user, phone_number=phone_number) if user else None
+
+    async def create_user(self, phone_number, name, interests):
+        await self._latency()
+        self.users[phone_number] = {"name": name, "interests": interests, "onboarding_completed": True}
+        self.writes.append((phone_number, name))
+        return True
+
+    async def update_user_interests(self, phone_number, interests):
+        await self._latency()
+        self.users[phone_number]["interests"] = interests
+        self.writes.append((phone_number, interests))
+        return True
+
+    async def increment_challenges_completed(self, phone_number):
+        await self._latency()
+        return True
+
+
+class FakeCompletions:
+    """Responde según el prompt: registra al usuario o actualiza sus intereses con su propio nombre"""
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(random.uniform(0, 0.01))
+        messages = kwargs["messages"]
+        last = messages[-1]
+
+        if last["role"] == "tool":
+            return self._text(f"ok {json.loads(last['content']).get('success')}")
+
+        user_message = last["content"]
+        if kwargs.get("tools") and kwargs["tools"][0]["function"]["name"] == "register_user":
+            # Onboarding: el mensaje del usuario es "soy <nombre>"
+            name = user_message.split(" ", 1)[1]
+            return self._tool_call("register_user", {"name": name, "interests": f"intereses de {name}"})
+
+        # Diálogo: el nombre visible en el contexto del usuario debe ser el del remitente
+        system_text = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        name_in_prompt = re.search(r"- Nombre: (\S+)", system_text).group(1)
+        return self._tool_call("update_interests", {"interests": f"{name_in_prompt}: {user_message}"})
+
+    def _text(self, content):
+        message = SimpleNamespace(content=content, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    def _tool_call(self, name, arguments):
+        tool_call = SimpleNamespace(
+            id=f"call_{random.randint(0, 10**9)}",
+            type="function",
+            function=SimpleNamespace(name=name, arguments=json.dumps(arguments))
+        )
+        message = SimpleNamespace(content=None, tool_calls=[tool_call])
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+async def run_conversation(index: int):
+    phone_number = f"+34{index:09d}"
+    name = f"usuario{index}"
+    await onboarding_agent.process_message(f"soy {name}", phone_number, [])
+    for turn in range(TURNS_PER_CONVERSATION):
+        await asyncio.sleep(random.uniform(0, 0.005))
+        await dialogue_agent.process_message(f"turno {turn}", phone_number, [])
+
+
+async def run_stress_test():
+    print("=" * 60)
+    print(f"🧪 Estrés de concurrencia: {CONVERSATIONS} conversaciones x {TURNS_PER_CONVERSATION} turnos")
+    print("=" * 60)
+
+    users = InMemoryUsers()
+    for method in ("get_user", "create_user", "update_user_interests", "increment_challenges_completed"):
+        setattr(database, method, getattr(users, method))
+
+    fake_client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    for agent in (onboarding_agent, dialogue_agent):
+        agent.provider = "openai"
+        agent.client = fake_client
+
+    await asyncio.gather(*(run_conversation(i) for i in range(CONVERSATIONS)))
+
+    errors = []
+    for index in range(CONVERSATIONS):
+        phone_number = f"+34{index:09d}"
+        user = users.users.get(phone_number)
+        expected_name = f"usuario{index}"
+        if not user or user["name"] != expected_name:
+            errors.append(f"{phone_number}: registrado como {user and user['name']}")
+        elif not user["interests"].startswith(f"{expected_name}:"):
+            errors.append(f"{phone_number}: intereses de otro usuario ({user['interests']})")
+
+    print(f"   Escrituras: {len(users.writes)}")
+    if errors:
+        print(f"❌ {len(errors)} conversaciones con estado cruzado, por ejemplo:")
+        for error in errors[:5]:
+            print(f"   {error}")
+        raise SystemExit(1)
+    print("✅ Ninguna escritura cruzada entre usuarios")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_stress_test())
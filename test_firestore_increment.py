@@ -0,0 +1,55 @@
+"""
+Prueba de incrementos concurrentes contra el emulador de Firestore
+Verifica que increment_challenges_completed no pierde actualizaciones
+
+Uso:
+    gcloud emulators firestore start --host-port=localhost:8081
+    FIRESTORE_EMULATOR_HOST=localhost:8081 python test_firestore_increment.py
+"""
+import asyncio
+import os
+import sys
+
+CONCURRENT_INCREMENTS = int(os.getenv("INCREMENT_TEST_COUNT", "200"))
+TEST_PHONE = "+10000000000"
+
+
+async def run_increment_test():
+    print("=" * 60)
+    print("🧪 Incrementos concurrentes en el emulador de Firestore")
+    print("=" * 60)
+
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        print("❌ FIRESTORE_EMULATOR_HOST no configurado; esta prueba solo corre contra el emulador")
+        sys.exit(1)
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo-whatsapp-bot")
+
+    from database import database
+
+    if not database.is_connected():
+        print("❌ No se pudo conectar al emulador")
+        sys.exit(1)
+
+    await database.create_user(TEST_PHONE, "Prueba", "incrementos concurrentes")
+
+    results = await asyncio.gather(*(
+        database.increment_challenges_completed(TEST_PHONE) for _ in range(CONCURRENT_INCREMENTS)
+    ))
+
+    database.user_cache.invalidate(TEST_PHONE)
+    user = await database.get_user(TEST_PHONE)
+    count = user.get("challenges_completed")
+    print(f"   Escrituras OK: {sum(results)}/{CONCURRENT_INCREMENTS}")
+    print(f"   Valor final: {count}")
+
+    missing_user = await database.increment_challenges_completed("+19999999999")
+    print(f"   Usuario inexistente devuelve: {missing_user}")
+
+    if count != CONCURRENT_INCREMENTS or missing_user:
+        print("❌ Se perdieron incrementos o se creó un usuario inexistente")
+        sys.exit(1)
+    print("✅ Ningún incremento perdido")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_increment_test())
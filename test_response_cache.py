@@ -0,0 +1,96 @@
+"""
+Prueba de la caché de respuestas
+Comprueba que una pregunta repetida se responde desde la caché (también para otro
+usuario en el mismo punto del onboarding y tras guardarse el turno en el historial)
+y que una respuesta con datos de un usuario no se sirve a otro.
+No necesita OpenAI ni Firestore: usa un cliente LLM falso
+"""
+import asyncio
+from types import SimpleNamespace
+
+from agents import onboarding_agent, dialogue_agent
+from request_context import RequestContext
+from response_cache import response_cache
+
+GREETING = {"role": "assistant", "content": "¡Hola! Soy tu asistente de retos. ¿Cómo te llamas?"}
+
+
+class FakeCompletions:
+    """Cuenta las llamadas y responde con el texto que le indique la prueba"""
+
+    def __init__(self):
+        self.calls = 0
+        self.reply = "Es un bot de retos diarios."
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        message = SimpleNamespace(content=self.reply, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def check(condition: bool, description: str, errors: list):
+    print(f"   {'✅' if condition else '❌'} {description}")
+    if not condition:
+        errors.append(description)
+
+
+async def run_cache_test():
+    print("=" * 60)
+    print("🧪 Caché de respuestas")
+    print("=" * 60)
+
+    completions = FakeCompletions()
+    fake_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    for agent in (onboarding_agent, dialogue_agent):
+        agent.provider = "openai"
+        agent.client = fake_client
+    response_cache.enabled = True
+    errors = []
+
+    # Pregunta repetida: la misma respuesta sin llamar al modelo
+    history = [GREETING]
+    first = await onboarding_agent.process_message("¿Qué es esto?", "+34600000001", list(history))
+    history += [{"role": "user", "content": "¿Qué es esto?"}, {"role": "assistant", "content": first}]
+    again = await onboarding_agent.process_message("¿qué es esto", "+34600000001", list(history))
+    other = await onboarding_agent.process_message("¿Qué es esto?", "+34600000002", [GREETING])
+    check(completions.calls == 1, f"una sola llamada al modelo para tres preguntas iguales ({completions.calls})", errors)
+    check(again == first and other == first, "la repetición y el otro usuario reciben la respuesta cacheada", errors)
+
+    # Onboarding guionizado tras mensajes del usuario: la respuesta puede llevar su nombre
+    scripted = [
+        GREETING,
+        {"role": "user", "content": "Juan"},
+        {"role": "assistant", "content": "¿Qué te interesa?"},
+    ]
+    completions.reply = "Juan, te enviaré un reto cada día."
+    await onboarding_agent.process_message("¿Cómo funciona?", "+34600000003", list(scripted))
+    completions.reply = "María, te enviaré un reto cada día."
+    maria_scripted = [GREETING, {"role": "user", "content": "María"}, scripted[2]]
+    reply = await onboarding_agent.process_message("¿Cómo funciona?", "+34600000004", maria_scripted)
+    check(completions.calls == 3, "la respuesta tras mensajes del usuario no se guarda", errors)
+    check("Juan" not in reply, f"María no recibe la respuesta de Juan ({reply!r})", errors)
+
+    # Diálogo: una respuesta con el nombre del perfil no se guarda; una genérica sí
+    user = {"name": "Ana", "interests": "historia", "challenges_completed": 0}
+    dialogue_history = [{"role": "user", "content": "hola"}, {"role": "assistant", "content": "¡Hola!"}]
+    completions.reply = "Ana, las respuestas van de la A a la C."
+    for _ in range(2):
+        context = RequestContext("+34600000005", dict(user), list(dialogue_history))
+        await dialogue_agent.process_message("¿Cuál es el formato?", "+34600000005", list(dialogue_history), context)
+    check(completions.calls == 5, "la respuesta con el nombre se genera cada vez", errors)
+    completions.reply = "Las respuestas van de la A a la C."
+    for _ in range(2):
+        context = RequestContext("+34600000005", dict(user), list(dialogue_history))
+        await dialogue_agent.process_message("¿Qué formato tiene?", "+34600000005", list(dialogue_history), context)
+    check(completions.calls == 6, "la respuesta genérica se guarda y se reutiliza", errors)
+
+    stats = response_cache.stats()
+    print(f"   Aciertos: {stats['exact_hits']}, guardadas: {stats['stores']}, no compartibles: {stats['unshared']}")
+    if errors:
+        print(f"❌ {len(errors)} comprobaciones fallidas")
+        raise SystemExit(1)
+    print("✅ La caché acierta en preguntas repetidas y no comparte respuestas personales")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_cache_test())
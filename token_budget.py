@@ -0,0 +1,183 @@
+"""
+Presupuesto de tokens para el historial de conversación
+Cuenta tokens con tiktoken si está instalado (si no, con una aproximación local)
+y envía los mensajes más recientes que caben en el presupuesto del modelo; los
+anteriores se condensan en una línea de memoria
+"""
+import os
+import re
+import json
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import tiktoken
+    HAS_TIKTOKEN = True
+except ImportError:
+    HAS_TIKTOKEN = False
+
+logger = logging.getLogger(__name__)
+
+# Tokens fijos que añade cada mensaje (rol y separadores) además de su contenido
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Presupuesto de historial por modelo (el prefijo más largo que coincida gana)
+DEFAULT_HISTORY_BUDGETS = {
+    "gpt-4o-mini": 3000,
+    "gpt-4o": 3000,
+    "gpt-4.1": 4000,
+    "gpt-5": 4000,
+    "gemini": 6000,
+}
+FALLBACK_HISTORY_BUDGET = 3000
+
+_WORD = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def history_budget(model: str) -> int:
+    """
+    Tokens de historial para un modelo
+
+    HISTORY_TOKEN_BUDGET fija el mismo valor para todos; HISTORY_TOKEN_BUDGETS
+    (JSON {"prefijo-modelo": tokens}) ajusta o añade modelos concretos
+    """
+    if os.getenv("HISTORY_TOKEN_BUDGET"):
+        return int(os.getenv("HISTORY_TOKEN_BUDGET"))
+
+    budgets = dict(DEFAULT_HISTORY_BUDGETS)
+    if os.getenv("HISTORY_TOKEN_BUDGETS"):
+        try:
+            budgets.update({k: int(v) for k, v in json.loads(os.getenv("HISTORY_TOKEN_BUDGETS")).items()})
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"HISTORY_TOKEN_BUDGETS inválido, se usan los valores por defecto: {str(e)}")
+
+    matches = [prefix for prefix in budgets if model.startswith(prefix)]
+    if not matches:
+        return FALLBACK_HISTORY_BUDGET
+    return budgets[max(matches, key=len)]
+
+
+class TokenCounter:
+    """Cuenta tokens con el encoding del modelo o, sin tiktoken, por palabras y signos"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = None
+        if HAS_TIKTOKEN:
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                # tiktoken descarga el encoding la primera vez; sin red se aproxima
+                logger.warning(f"No se pudo cargar el encoding de tiktoken, se usa la aproximación: {str(e)}")
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    def count(self, text: Optional[str]) -> int:
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        # Aproximación: cada palabra o signo es al menos un token y las palabras
+        # largas se parten (~4 caracteres por token en español e inglés)
+        return max(len(_WORD.findall(text)), (len(text) + 3) // 4)
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        return MESSAGE_OVERHEAD_TOKENS + self.count(str(message.get("content") or ""))
+
+
+class HistoryBuilder:
+    """Selecciona el historial que cabe en el presupuesto, del más reciente al más antiguo"""
+
+    def __init__(self, model: str, budget: Optional[int] = None, summary_tokens: Optional[int] = None):
+        self.counter = TokenCounter(model)
+        self.budget = budget if budget is not None else history_budget(model)
+        self.summary_tokens = summary_tokens if summary_tokens is not None else int(os.getenv("HISTORY_SUMMARY_TOKENS", "150"))
+        self.builds = 0
+        self.trimmed_builds = 0
+        self.dropped_messages = 0
+
+    def select(self, history: List[Dict[str, Any]], budget: Optional[int] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Divide el historial en (mensajes que caben, mensajes anteriores descartados)"""
+        remaining = self.budget if budget is None else budget
+        start = len(history)
+        while start > 0:
+            cost = self.counter.count_message(history[start - 1])
+            if cost > remaining:
+                break
+            remaining -= cost
+            start -= 1
+        return history[start:], history[:start]
+
+    def summary_line(self, dropped: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Línea de memoria con los mensajes que no caben, sin llamar al modelo
+
+        Cada mensaje aporta su comienzo y se recorta por igual hasta ajustarse
+        a summary_tokens; prevalecen los más recientes si no caben todos
+        """
+        if not dropped or self.summary_tokens <= 0:
+            return None
+
+        header = f"Resumen de {len(dropped)} mensajes anteriores de la conversación:"
+        speakers = {"user": "Usuario", "assistant": "Bot"}
+        turns = [
+            (speakers[m["role"]], " ".join(str(m.get("content") or "").split()))
+            for m in dropped if m.get("role") in speakers and m.get("content")
+        ]
+        if not turns:
+            return None
+
+        budget = self.summary_tokens - self.counter.count(header)
+        per_turn_chars = 160
+        while per_turn_chars >= 20:
+            parts = []
+            used = 0
+            for speaker, text in reversed(turns):
+                snippet = text if len(text) <= per_turn_chars else text[:per_turn_chars].rsplit(" ", 1)[0] + "…"
+                part = f"{speaker}: {snippet}"
+                cost = self.counter.count(part) + 1
+                if used + cost > budget:
+                    break
+                parts.append(part)
+                used += cost
+            if len(parts) == len(turns) or per_turn_chars <= 20:
+                break
+            per_turn_chars //= 2
+        if not parts:
+            return None
+        return header + " " + " | ".join(reversed(parts))
+
+    def build(self, history: List[Dict[str, Any]], summarize: bool = True) -> List[Dict[str, Any]]:
+        """
+        Historial a enviar: los mensajes recientes que caben y, si se descartó algo,
+        una línea de memoria al principio (su tamaño se reserva del presupuesto)
+        """
+        self.builds += 1
+        selected, dropped = self.select(history)
+        if not dropped:
+            return list(selected)
+
+        self.trimmed_builds += 1
+        summary = None
+        if summarize and self.summary_tokens > 0:
+            selected, dropped = self.select(history, max(self.budget - self.summary_tokens, 0))
+            summary = self.summary_line(dropped)
+        self.dropped_messages += len(dropped)
+
+        messages = list(selected)
+        if summary:
+            messages.insert(0, {"role": "system", "content": summary})
+        return messages
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "token_budget": self.budget,
+            "tokenizer": "tiktoken" if self.counter.exact else "approx",
+            "builds": self.builds,
+            "trimmed_builds": self.trimmed_builds,
+            "dropped_messages": self.dropped_messages,
+        }
@@ -3,14 +3,62 @@ Cliente para integrar con WhatsApp
 Soporta múltiples métodos: Twilio, WhatsApp Business API, etc.
 """
 import os
+import json
 import logging
-from typing import Optional
+from typing import List, Optional
 import aiohttp
 from dotenv import load_dotenv
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Códigos de error de la Graph API que indican un fallo transitorio (límites de ritmo o caída temporal)
+RETRYABLE_META_ERROR_CODES = {4, 80007, 130429, 131016, 131056, 133004}
+
+# Fuera de la ventana de 24 h desde el último mensaje del usuario: solo se admiten
+# plantillas aprobadas (Meta 131047, Twilio 63016)
+OUTSIDE_WINDOW_ERROR_CODES = {131047, 63016}
+
+
+class SendResult:
+    """Resultado de un intento de envío, con lo necesario para decidir si reintentar"""
+
+    def __init__(self, ok: bool, status: Optional[int] = None, error_code: Optional[int] = None,
+                 error: Optional[str] = None, retry_after: Optional[float] = None):
+        self.ok = ok
+        self.status = status
+        self.error_code = error_code
+        self.error = error
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        if self.ok:
+            return False
+        # Sin status: error de red o timeout
+        if self.status is None or self.status == 429 or self.status >= 500:
+            return True
+        return self.error_code in RETRYABLE_META_ERROR_CODES
+
+    @property
+    def rate_limited(self) -> bool:
+        return self.status == 429 or self.error_code in (4, 80007, 130429)
+
+    @property
+    def outside_window(self) -> bool:
+        return self.error_code in OUTSIDE_WINDOW_ERROR_CODES
+
+
+def _retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
 class WhatsAppClient:
     """Cliente para enviar mensajes por WhatsApp"""
     
@@ -20,10 +68,46 @@ class WhatsAppClient:
         self.api_secret = os.getenv("WHATSAPP_API_SECRET")
         self.from_number = os.getenv("WHATSAPP_FROM_NUMBER")
         self.phone_number_id = os.getenv("WHATSAPP_PHONE_NUMBER_ID")  # Requerido para Meta
+        self.meta_base_url = os.getenv("WHATSAPP_API_BASE_URL", "https://graph.facebook.com/v21.0")
+        self.template_language = os.getenv("WHATSAPP_TEMPLATE_LANGUAGE", "es")
+        
+        # Sesión HTTP compartida: reutiliza conexiones TCP+TLS entre mensajes
+        self.pool_limit = int(os.getenv("WHATSAPP_HTTP_POOL_LIMIT", "100"))
+        self.pool_limit_per_host = int(os.getenv("WHATSAPP_HTTP_POOL_LIMIT_PER_HOST", "50"))
+        self.keepalive_timeout = float(os.getenv("WHATSAPP_HTTP_KEEPALIVE_SECONDS", "60"))
+        self.dns_cache_ttl = int(os.getenv("WHATSAPP_HTTP_DNS_CACHE_SECONDS", "300"))
+        self.request_timeout = float(os.getenv("WHATSAPP_HTTP_TIMEOUT_SECONDS", "15"))
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Devuelve la sesión compartida, creándola si todavía no existe"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        return self._session
+    
+    async def start(self):
+        """Crea la sesión HTTP (llamar desde el evento startup de FastAPI)"""
+        self._get_session()
+        logger.info(f"Sesión HTTP de WhatsApp creada (límite {self.pool_limit} conexiones, {self.pool_limit_per_host} por host)")
+    
+    async def close(self):
+        """Cierra la sesión HTTP y sus conexiones (llamar en el evento shutdown)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
         
     async def send_message(self, to: str, message: str) -> bool:
         """
-        Envía un mensaje de WhatsApp
+        Envía un mensaje de WhatsApp (un único intento; con reintentos ver outbound_dispatcher)
         
         Args:
             to: Número de teléfono destino (formato: +1234567890)
@@ -32,6 +116,11 @@ class WhatsAppClient:
         Returns:
             True si se envió correctamente, False en caso contrario
         """
+        result = await self.send_once(to, message)
+        return result.ok
+    
+    async def send_once(self, to: str, message: str) -> SendResult:
+        """Un intento de envío que devuelve el status y el Retry-After en lugar de solo un bool"""
         try:
             if self.provider == "twilio":
                 return await self._send_via_twilio(to, message)
@@ -39,16 +128,50 @@ class WhatsAppClient:
                 return await self._send_via_meta(to, message)
             else:
                 logger.warning(f"Proveedor {self.provider} no implementado")
-                return False
+                return SendResult(False, status=0, error="proveedor no implementado")
         except Exception as e:
             logger.error(f"Error enviando mensaje: {str(e)}")
-            return False
+            return SendResult(False, error=str(e))
     
-    async def _send_via_twilio(self, to: str, message: str) -> bool:
-        """Envía mensaje usando Twilio API"""
+    async def send_template(self, to: str, template: str, parameters: List[str], language: Optional[str] = None) -> SendResult:
+        """
+        Un intento de envío de una plantilla aprobada, que llega también fuera de la
+        ventana de 24 h
+
+        Args:
+            to: Número de teléfono destino (formato: +1234567890)
+            template: Nombre de la plantilla en Meta o ContentSid en Twilio
+            parameters: Valores de las variables del cuerpo ({{1}}, {{2}}, ...), en orden
+            language: Código de idioma de la plantilla (Meta); por defecto WHATSAPP_TEMPLATE_LANGUAGE
+        """
+        try:
+            if self.provider == "twilio":
+                variables = {str(i): value for i, value in enumerate(parameters, start=1)}
+                return await self._send_via_twilio(to, None, {"ContentSid": template, "ContentVariables": json.dumps(variables)})
+            elif self.provider == "meta":
+                return await self._send_via_meta(to, None, {
+                    "type": "template",
+                    "template": {
+                        "name": template,
+                        "language": {"code": language or self.template_language},
+                        "components": [{
+                            "type": "body",
+                            "parameters": [{"type": "text", "text": value} for value in parameters]
+                        }]
+                    }
+                })
+            else:
+                logger.warning(f"Proveedor {self.provider} no implementado")
+                return SendResult(False, status=0, error="proveedor no implementado")
+        except Exception as e:
+            logger.error(f"Error enviando plantilla: {str(e)}")
+            return SendResult(False, error=str(e))
+    
+    async def _send_via_twilio(self, to: str, message: Optional[str], content: Optional[dict] = None) -> SendResult:
+        """Envía mensaje usando Twilio API (texto o, con content, una plantilla)"""
         if not self.api_key or not self.api_secret:
             logger.error("Twilio credentials no configuradas")
-            return False
+            return SendResult(False, status=0, error="credenciales no configuradas")
         
         account_sid = self.api_key
         auth_token = self.api_secret
@@ -57,41 +180,54 @@ class WhatsAppClient:
         
         url = f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
         
-        async with aiohttp.ClientSession() as session:
-            auth = aiohttp.BasicAuth(account_sid, auth_token)
-            data = {
-                "From": from_whatsapp,
-                "To": to_whatsapp,
-                "Body": message
-            }
-            
-            async with session.post(url, auth=auth, data=data) as response:
-                if response.status == 201:
-                    logger.info(f"Mensaje enviado a {to} via Twilio")
-                    return True
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Error Twilio: {response.status} - {error_text}")
-                    return False
+        session = self._get_session()
+        auth = aiohttp.BasicAuth(account_sid, auth_token)
+        data = {
+            "From": from_whatsapp,
+            "To": to_whatsapp
+        }
+        if content:
+            data.update(content)
+        else:
+            data["Body"] = message
+        
+        async with session.post(url, auth=auth, data=data) as response:
+            if response.status == 201:
+                logger.info(f"Mensaje enviado a {to} via Twilio")
+                return SendResult(True, status=response.status)
+            else:
+                error_text = await response.text()
+                try:
+                    error_code = json.loads(error_text).get("code")
+                except (ValueError, AttributeError):
+                    error_code = None
+                logger.error(f"Error Twilio: {response.status} - {error_text}")
+                return SendResult(
+                    False,
+                    status=response.status,
+                    error_code=error_code,
+                    error=error_text,
+                    retry_after=_retry_after(response)
+                )
     
-    async def _send_via_meta(self, to: str, message: str) -> bool:
-        """Envía mensaje usando Meta WhatsApp Business API oficial"""
+    async def _send_via_meta(self, to: str, message: Optional[str], content: Optional[dict] = None) -> SendResult:
+        """Envía mensaje usando Meta WhatsApp Business API oficial (texto o, con content, una plantilla)"""
         if not self.api_key:
             logger.error("Meta Access Token no configurado (WHATSAPP_API_KEY)")
-            return False
+            return SendResult(False, status=0, error="access token no configurado")
         
         # Usar valor por defecto si no está configurado (para desarrollo)
         phone_number_id = self.phone_number_id or os.getenv("WHATSAPP_PHONE_NUMBER_ID", "378914085314990")
         
         if not phone_number_id:
             logger.error("Phone Number ID no configurado (WHATSAPP_PHONE_NUMBER_ID)")
-            return False
+            return SendResult(False, status=0, error="phone number id no configurado")
         
         access_token = self.api_key
         # phone_number_id ya está definido arriba con valor por defecto
         
-        # Usar la versión más reciente de la API (v21.0)
-        url = f"https://graph.facebook.com/v21.0/{phone_number_id}/messages"
+        # Usar la versión más reciente de la API (v21.0, configurable con WHATSAPP_API_BASE_URL)
+        url = f"{self.meta_base_url}/{phone_number_id}/messages"
         
         headers = {
             "Authorization": f"Bearer {access_token}",
@@ -111,25 +247,38 @@ class WhatsAppClient:
                 "body": message
             }
         }
+        if content:
+            del payload["text"]
+            payload.update(content)
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=payload) as response:
-                    response_data = await response.json()
-                    
-                    if response.status == 200:
-                        message_id = response_data.get("messages", [{}])[0].get("id", "unknown")
-                        logger.info(f"Mensaje enviado a {to} via Meta (ID: {message_id})")
-                        return True
-                    else:
-                        error_message = response_data.get("error", {}).get("message", "Error desconocido")
-                        error_code = response_data.get("error", {}).get("code", response.status)
-                        logger.error(f"Error Meta API: {error_code} - {error_message}")
-                        logger.debug(f"Payload enviado: {payload}")
-                        return False
+            session = self._get_session()
+            async with session.post(url, headers=headers, json=payload) as response:
+                # Un 5xx del proxy de Meta puede no traer JSON
+                try:
+                    response_data = await response.json(content_type=None) or {}
+                except ValueError:
+                    response_data = {}
+                
+                if response.status == 200:
+                    message_id = response_data.get("messages", [{}])[0].get("id", "unknown")
+                    logger.info(f"Mensaje enviado a {to} via Meta (ID: {message_id})")
+                    return SendResult(True, status=response.status)
+                else:
+                    error_message = response_data.get("error", {}).get("message", "Error desconocido")
+                    error_code = response_data.get("error", {}).get("code", response.status)
+                    logger.error(f"Error Meta API: {error_code} - {error_message}")
+                    logger.debug(f"Payload enviado: {payload}")
+                    return SendResult(
+                        False,
+                        status=response.status,
+                        error_code=error_code,
+                        error=error_message,
+                        retry_after=_retry_after(response)
+                    )
         except Exception as e:
             logger.error(f"Excepción al enviar mensaje via Meta: {str(e)}")
-            return False
+            return SendResult(False, error=str(e))
 
 # Instancia global
 whatsapp_client = WhatsAppClient()